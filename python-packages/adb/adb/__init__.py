@@ -15,13 +15,33 @@
 #
 from __future__ import annotations
 
+import asyncio
 import atexit
 import base64
 import logging
 import os
+import posixpath
 import re
+import shlex
+import shutil
+import stat
 import subprocess
-from typing import Any, Callable
+import tempfile
+import time
+from typing import Any, Callable, Iterator
+
+from .delta_push import DEFAULT_MANIFEST_PATH as DEFAULT_MANIFEST_PATH
+from .delta_push import DeltaPushPlan, ManifestEntry
+from .delta_push import format_manifest, parse_manifest
+from .device_group import DeviceGroup as DeviceGroup
+from .device_group import DeviceGroupError as DeviceGroupError
+from .device_group import DeviceResult as DeviceResult
+from .device_group import DeviceTimeoutError as DeviceTimeoutError
+from .host_protocol import AdbServerClient as AdbServerClient
+from .host_protocol import AdbServerError as AdbServerError
+from .host_protocol import shell_service
+from .shell_stream import AsyncShellStream as AsyncShellStream
+from .shell_stream import ShellStream as ShellStream
 
 
 class FindDeviceError(RuntimeError):
@@ -191,6 +211,43 @@ def version(adb_path: list[str] | None = None) -> int:
     return int(result.group(1))
 
 
+def _walk_push(local: str, remote: str) -> Iterator[tuple[str, str]]:
+    """Yields the (local, remote) file pairs to push for a local path."""
+    if not os.path.isdir(local):
+        yield local, remote
+        return
+    for root, _, files in os.walk(local):
+        rel_dir = os.path.relpath(root, local)
+        remote_dir = remote
+        if rel_dir != os.curdir:
+            remote_dir = posixpath.join(remote, *rel_dir.split(os.sep))
+        for name in sorted(files):
+            yield os.path.join(root, name), posixpath.join(remote_dir, name)
+
+
+def _push_dest(source: str, remote: str, into_dir: bool) -> str:
+    if not into_dir:
+        return remote
+    return posixpath.join(remote, os.path.basename(os.path.normpath(source)))
+
+
+def _push_pairs(
+    sources: list[str], remote: str, into_dir: bool
+) -> Iterator[tuple[str, str]]:
+    """Yields the (local, remote) file pairs for a push of many sources."""
+    for source in sources:
+        yield from _walk_push(source, _push_dest(source, remote, into_dir))
+
+
+def _read_chunks(path: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
 class AndroidDevice(object):
     # Delimiter string to indicate the start of the exit code.
     _RETURN_CODE_DELIMITER = 'x'
@@ -209,12 +266,26 @@ class AndroidDevice(object):
         '{0}255\r\r\n'.format(_RETURN_CODE_DELIMITER))
 
     def __init__(
-        self, serial: str | None, product: str | None = None, adb_path: str = 'adb'
+        self,
+        serial: str | None,
+        product: str | None = None,
+        adb_path: str = 'adb',
+        server: AdbServerClient | None = None,
     ) -> None:
+        """
+        Args:
+            serial: Serial of the device, or None for the only device.
+            product: Product name passed to `adb -p`.
+            adb_path: Path to the adb client binary.
+            server: If set, shell, push, pull and features talk to the adb
+                server through this client instead of running `adb`. Their
+                failures raise AdbServerError.
+        """
         self.serial = serial
         self.product = product
         self.adb_path = adb_path
         self.adb_cmd = [adb_path]
+        self.server = server
 
         if self.serial is not None:
             self.adb_cmd.extend(['-s', self.serial])
@@ -222,25 +293,45 @@ class AndroidDevice(object):
             self.adb_cmd.extend(['-p', self.product])
         self._linesep: str | None = None
         self._features: list[str] | None = None
+        self._has_shell_protocol: bool | None = None
 
     @property
     def linesep(self) -> str:
         if self._linesep is None:
-            self._linesep = subprocess.check_output(
-                self.adb_cmd + ['shell', 'echo'], encoding='utf-8')
+            if self.server is not None:
+                self._linesep = self.server.shell(
+                    self.serial, ['echo'], self.has_shell_protocol()
+                ).stdout.decode('utf-8')
+            else:
+                self._linesep = subprocess.check_output(
+                    self.adb_cmd + ['shell', 'echo'], encoding='utf-8')
         return self._linesep
 
     @property
     def features(self) -> list[str]:
         if self._features is None:
-            try:
-                self._features = split_lines(self._simple_call(['features']))
-            except subprocess.CalledProcessError:
-                self._features = []
+            if self.server is not None:
+                try:
+                    self._features = self.server.features(self.serial)
+                except AdbServerError:
+                    self._features = []
+            else:
+                try:
+                    self._features = split_lines(
+                        self._simple_call(['features']))
+                except subprocess.CalledProcessError:
+                    self._features = []
         return self._features
 
     def has_shell_protocol(self) -> bool:
-        return version(self.adb_cmd) >= 35 and 'shell_v2' in self.features
+        if self._has_shell_protocol is None:
+            if self.server is not None:
+                adb_version = self.server.version()
+            else:
+                adb_version = version(self.adb_cmd)
+            self._has_shell_protocol = (
+                adb_version >= 35 and 'shell_v2' in self.features)
+        return self._has_shell_protocol
 
     def _make_shell_cmd(self, user_cmd: list[str]) -> list[str]:
         command = self.adb_cmd + ['shell'] + user_cmd
@@ -309,6 +400,9 @@ class AndroidDevice(object):
             An (exit_code, stdout, stderr) tuple. Stderr may be combined
             into stdout if the device doesn't support separate streams.
         """
+        if self.server is not None:
+            return self._shell_nocheck_with_server(cmd)
+
         cmd = self._make_shell_cmd(cmd)
         logging.info(' '.join(cmd))
         p = subprocess.Popen(
@@ -320,6 +414,77 @@ class AndroidDevice(object):
             exit_code, stdout = self._parse_shell_output(stdout)
         return exit_code, stdout, stderr
 
+    def _shell_nocheck_with_server(
+        self, cmd: list[str]
+    ) -> tuple[int, str, str]:
+        assert self.server is not None
+        shell_v2 = self.has_shell_protocol()
+        if not shell_v2:
+            cmd = cmd + self._RETURN_CODE_PROBE
+        logging.info('shell: ' + ' '.join(cmd))
+        result = self.server.shell(self.serial, cmd, shell_v2)
+        stdout = result.stdout.decode('utf-8')
+        stderr = result.stderr.decode('utf-8')
+        if shell_v2:
+            return result.exit_code, stdout, stderr
+        exit_code, stdout = self._parse_shell_output(stdout)
+        return exit_code, stdout, stderr
+
+    def shell_stream(
+        self, cmd: list[str], chunk_size: int = 64 * 1024
+    ) -> ShellStream:
+        """Calls `adb shell` and streams its stdout as it arrives.
+
+        Unlike shell_nocheck(), the output is never buffered as a whole. The
+        exit code comes from the shell protocol, or from the end of the
+        stream on devices without it.
+
+        Args:
+            cmd: command to execute as a list of strings.
+            chunk_size: maximum size of the chunks read from adb.
+
+        Returns:
+            A ShellStream which yields stdout chunks (or decoded lines with
+            lines()) and provides exit_code and stderr once exhausted.
+        """
+        shell_v2 = self.has_shell_protocol()
+        if not shell_v2:
+            cmd = cmd + self._RETURN_CODE_PROBE
+        if self.server is not None:
+            logging.info('shell: ' + ' '.join(cmd))
+            return ShellStream.from_packets(
+                self.server.shell_packets(self.serial, cmd, shell_v2),
+                shell_v2)
+
+        command = self.adb_cmd + ['shell'] + cmd
+        logging.info(' '.join(command))
+        p = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return ShellStream.from_process(p, shell_v2, chunk_size)
+
+    async def shell_stream_async(
+        self, cmd: list[str], chunk_size: int = 64 * 1024
+    ) -> AsyncShellStream:
+        """The asyncio counterpart of shell_stream().
+
+        Many commands can be streamed concurrently from one event loop.
+        """
+        loop = asyncio.get_running_loop()
+        shell_v2 = await loop.run_in_executor(None, self.has_shell_protocol)
+        if not shell_v2:
+            cmd = cmd + self._RETURN_CODE_PROBE
+        if self.server is not None:
+            logging.info('shell: ' + ' '.join(cmd))
+            reader, writer = await self.server.open_service_async(
+                self.serial, shell_service(cmd, shell_v2))
+            return AsyncShellStream.from_connection(reader, writer, shell_v2)
+
+        command = self.adb_cmd + ['shell'] + cmd
+        logging.info(' '.join(command))
+        p = await asyncio.create_subprocess_exec(
+            *command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return AsyncShellStream.from_process(p, shell_v2, chunk_size)
+
     def shell_popen(
         self,
         cmd: list[str],
@@ -375,7 +540,15 @@ class AndroidDevice(object):
         cmd.append(filename)
         return self._simple_call(cmd)
 
-    def push(self, local: str | list[str], remote: str, sync: bool = False) -> str:
+    def push(
+        self,
+        local: str | list[str],
+        remote: str,
+        sync: bool = False,
+        delta: bool = False,
+        manifest_path: str = DEFAULT_MANIFEST_PATH,
+        max_workers: int | None = None,
+    ) -> str:
         """Transfer a local file or directory to the device.
 
         Args:
@@ -383,25 +556,208 @@ class AndroidDevice(object):
             remote: The remote path to which local should be transferred.
             sync: If True, only transfers files that are newer on the host than
                   those on the device. If False, transfers all files.
+            delta: If True, only transfers files whose content changed since
+                   they were last pushed with delta=True, regardless of
+                   timestamps. See push_delta().
+            manifest_path: Device path of the manifest used by delta pushes.
+            max_workers: Number of processes hashing files for delta pushes.
 
         Returns:
             Output of the command.
         """
+        sources = [local] if isinstance(local, str) else local
+        if delta:
+            return self.push_delta(sources, remote, manifest_path, max_workers)
+
+        if self.server is not None:
+            return self._push_with_server(sources, remote, sync)
+
         cmd = ['push']
         if sync:
             cmd.append('--sync')
+        cmd.extend(sources)
+        cmd.append(remote)
+        return self._simple_call(cmd)
 
-        if isinstance(local, str):
-            cmd.extend([local, remote])
-        else:
-            cmd.extend(local)
-            cmd.append(remote)
+    def _push_with_server(
+        self, sources: list[str], remote: str, sync: bool
+    ) -> str:
+        assert self.server is not None
+        pushed = 0
+        skipped = 0
+        size = 0
+        with self.server.sync(self.serial) as conn:
+            # Like adb, copy into the remote directory if it exists.
+            into_dir = len(sources) > 1 or conn.stat(remote).is_dir()
+            for local_path, remote_path in _push_pairs(
+                    sources, remote, into_dir):
+                st = os.stat(local_path)
+                mtime = int(st.st_mtime)
+                if sync:
+                    remote_st = conn.stat(remote_path)
+                    if remote_st.mtime == mtime and \
+                            remote_st.size == st.st_size:
+                        skipped += 1
+                        continue
+                logging.info('push: {} -> {}'.format(local_path, remote_path))
+                size += conn.send(_read_chunks(local_path), remote_path,
+                                  st.st_mode, mtime)
+                pushed += 1
+        return '{} file(s) pushed, {} skipped. ({} bytes)\n'.format(
+            pushed, skipped, size)
+
+    def push_delta(
+        self,
+        sources: list[str],
+        remote: str,
+        manifest_path: str = DEFAULT_MANIFEST_PATH,
+        max_workers: int | None = None,
+    ) -> str:
+        """Pushes only the files whose content changed on the host.
+
+        The device keeps a manifest of the SHA-256 digest and size of every
+        file pushed this way. Host files are hashed in a process pool, files
+        matching the manifest (and still present on the device with the same
+        size) are skipped, and the remaining files are sent in one batch.
 
-        return self._simple_call(cmd)
+        Returns:
+            A summary of the pushed and unchanged files and the bytes saved.
+        """
+        if self.server is not None:
+            return self._push_delta_with_server(
+                sources, remote, manifest_path, max_workers)
+
+        into_dir = len(sources) > 1 or self.shell_nocheck(
+            ['test', '-d', shlex.quote(remote)])[0] == 0
+        manifest = self._read_manifest(manifest_path)
+        plan = DeltaPushPlan(_push_pairs(sources, remote, into_dir),
+                             manifest, max_workers)
+        if plan.unchanged:
+            plan.recheck(self._remote_file_sizes(
+                {_push_dest(source, remote, into_dir) for source in sources}))
+
+        # Mirror the changed files into a staging tree rooted at the device's
+        # `/` so that a single `adb push` transfers all of them.
+        size = 0
+        with tempfile.TemporaryDirectory() as staging_dir:
+            def _stage(remote_path: str) -> str:
+                path = os.path.join(
+                    staging_dir, *remote_path.lstrip('/').split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                return path
+
+            for local_path, remote_path in plan.changed:
+                staged = _stage(remote_path)
+                try:
+                    os.link(local_path, staged)
+                except OSError:
+                    shutil.copy2(local_path, staged)
+                size += os.path.getsize(local_path)
+            if plan.changed:
+                tops = [os.path.join(staging_dir, name)
+                        for name in sorted(os.listdir(staging_dir))]
+                self._simple_call(['push'] + tops + ['/'])
+
+            # The manifest only goes out once the files are on the device, so
+            # a failed transfer can't leave it listing files that aren't.
+            manifest.update(plan.entries)
+            manifest_file = os.path.join(staging_dir, 'manifest')
+            with open(manifest_file, 'wb') as f:
+                f.write(format_manifest(manifest))
+            self._simple_call(['push', manifest_file, manifest_path])
+        return plan.report(size)
+
+    def _read_manifest(self, manifest_path: str) -> dict[str, ManifestEntry]:
+        exit_code, stdout, _ = self.shell_nocheck(
+            ['cat', shlex.quote(manifest_path)])
+        if exit_code != 0:
+            return {}
+        return parse_manifest(stdout.encode('utf-8'))
+
+    def _remote_file_sizes(self, roots: set[str]) -> dict[str, int]:
+        cmd = ['find'] + [shlex.quote(root) for root in sorted(roots)]
+        cmd += ['-type', 'f', '-exec', 'stat', '-c', "'%s %n'", '{}', '+']
+        _, stdout, _ = self.shell_nocheck(cmd)
+        sizes = {}
+        for line in split_lines(stdout):
+            size, _, path = line.partition(' ')
+            if size.isdigit() and path:
+                sizes[path] = int(size)
+        return sizes
+
+    def _push_delta_with_server(
+        self,
+        sources: list[str],
+        remote: str,
+        manifest_path: str,
+        max_workers: int | None,
+    ) -> str:
+        assert self.server is not None
+        with self.server.sync(self.serial) as conn:
+            into_dir = len(sources) > 1 or conn.stat(remote).is_dir()
+            manifest: dict[str, ManifestEntry] = {}
+            if conn.stat(manifest_path).exists():
+                manifest = parse_manifest(b''.join(conn.recv(manifest_path)))
+            plan = DeltaPushPlan(_push_pairs(sources, remote, into_dir),
+                                 manifest, max_workers)
+            remote_sizes = {}
+            for _, remote_path in plan.unchanged:
+                remote_st = conn.stat(remote_path)
+                if remote_st.exists():
+                    remote_sizes[remote_path] = remote_st.size
+            plan.recheck(remote_sizes)
+
+            # All files go through the one pooled sync connection.
+            size = 0
+            for local_path, remote_path in plan.changed:
+                st = os.stat(local_path)
+                logging.info('push: {} -> {}'.format(local_path, remote_path))
+                size += conn.send(_read_chunks(local_path), remote_path,
+                                  st.st_mode, int(st.st_mtime))
+            manifest.update(plan.entries)
+            conn.send(iter([format_manifest(manifest)]), manifest_path,
+                      stat.S_IFREG | 0o644, int(time.time()))
+        return plan.report(size)
 
     def pull(self, remote: str, local: str) -> str:
+        if self.server is not None:
+            return self._pull_with_server(remote, local)
         return self._simple_call(['pull', remote, local])
 
+    def _pull_with_server(self, remote: str, local: str) -> str:
+        assert self.server is not None
+        pulled = 0
+        size = 0
+        with self.server.sync(self.serial) as conn:
+            remote_st = conn.stat(remote)
+            if not remote_st.exists():
+                raise AdbServerError(
+                    "remote object '{}' does not exist".format(remote))
+            if os.path.isdir(local):
+                local = os.path.join(
+                    local, posixpath.basename(posixpath.normpath(remote)))
+
+            pending = [(remote, local, remote_st.is_dir())]
+            while pending:
+                remote_path, local_path, is_dir = pending.pop()
+                if is_dir:
+                    os.makedirs(local_path, exist_ok=True)
+                    for entry in conn.list(remote_path):
+                        pending.append((
+                            posixpath.join(remote_path, entry.name),
+                            os.path.join(local_path, entry.name),
+                            stat.S_ISDIR(entry.mode)))
+                    continue
+                logging.info('pull: {} -> {}'.format(
+                    remote_path, local_path))
+                with open(local_path, 'wb') as local_file:
+                    # Always drain the stream to keep the connection usable.
+                    for chunk in conn.recv(remote_path):
+                        local_file.write(chunk)
+                        size += len(chunk)
+                pulled += 1
+        return '{} file(s) pulled. ({} bytes)\n'.format(pulled, size)
+
     def sync(self, directory: str | None = None) -> str:
         cmd = ['sync']
         if directory is not None:
@@ -0,0 +1,127 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Content-hash based incremental pushes.
+
+adb's `--sync` compares timestamps, so a rebuilt tree with identical bytes is
+pushed again in full. A delta push instead keeps a manifest on the device
+which records the content hash and size of every file it pushed, and only
+transfers the files whose host-side hash differs from the manifest.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import json
+import os
+from typing import Iterable, Mapping, NamedTuple
+
+# Kept outside of the pushed trees so that it never shows up in them.
+DEFAULT_MANIFEST_PATH = '/data/local/tmp/.adb_push_manifest'
+
+# Starting worker processes costs more than hashing a handful of files.
+_MIN_FILES_PER_POOL = 16
+
+
+class ManifestEntry(NamedTuple):
+    digest: str
+    size: int
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Returns the hex SHA-256 digest of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_files(
+    paths: Iterable[str], max_workers: int | None = None
+) -> dict[str, str]:
+    """Hashes files in a process pool and maps each path to its digest."""
+    path_list = list(dict.fromkeys(paths))
+    if len(path_list) < _MIN_FILES_PER_POOL or max_workers == 1:
+        return {path: hash_file(path) for path in path_list}
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        digests = executor.map(hash_file, path_list, chunksize=8)
+        return dict(zip(path_list, digests))
+
+
+def parse_manifest(data: bytes) -> dict[str, ManifestEntry]:
+    """Parses a manifest. A missing or corrupt manifest is empty."""
+    try:
+        entries = json.loads(data.decode('utf-8'))
+        return {path: ManifestEntry(digest, size)
+                for path, (digest, size) in entries.items()}
+    except (ValueError, TypeError, AttributeError):
+        return {}
+
+
+def format_manifest(manifest: Mapping[str, ManifestEntry]) -> bytes:
+    entries = {path: list(entry) for path, entry in sorted(manifest.items())}
+    return json.dumps(entries, indent=0).encode('utf-8')
+
+
+class DeltaPushPlan(object):
+    """Splits (local, remote) pairs into files to push and unchanged files.
+
+    A file is unchanged if the manifest has its digest and the file on the
+    device still has the recorded size, which catches files that were deleted
+    or truncated on the device since the manifest was written.
+    """
+
+    def __init__(
+        self,
+        pairs: Iterable[tuple[str, str]],
+        manifest: Mapping[str, ManifestEntry],
+        max_workers: int | None = None,
+    ) -> None:
+        self.pairs = list(pairs)
+        digests = hash_files(
+            (local for local, _ in self.pairs), max_workers)
+        self.entries: dict[str, ManifestEntry] = {}
+        self.changed: list[tuple[str, str]] = []
+        self.unchanged: list[tuple[str, str]] = []
+        for local, remote in self.pairs:
+            entry = ManifestEntry(digests[local], os.path.getsize(local))
+            self.entries[remote] = entry
+            if manifest.get(remote) == entry:
+                self.unchanged.append((local, remote))
+            else:
+                self.changed.append((local, remote))
+
+    def recheck(self, remote_sizes: Mapping[str, int]) -> None:
+        """Pushes unchanged files again if the device copy doesn't match."""
+        unchanged = []
+        for local, remote in self.unchanged:
+            if remote_sizes.get(remote) == self.entries[remote].size:
+                unchanged.append((local, remote))
+            else:
+                self.changed.append((local, remote))
+        self.unchanged = unchanged
+
+    @property
+    def saved_bytes(self) -> int:
+        return sum(self.entries[remote].size for _, remote in self.unchanged)
+
+    def report(self, pushed_bytes: int) -> str:
+        return '{} file(s) pushed, {} unchanged. ({} bytes, {} saved)\n'.format(
+            len(self.changed), len(self.unchanged), pushed_bytes,
+            self.saved_bytes)
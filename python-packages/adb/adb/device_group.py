@@ -0,0 +1,291 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Runs AndroidDevice operations on many devices concurrently."""
+from __future__ import annotations
+
+import concurrent.futures
+import os
+import threading
+import time
+from typing import (
+    TYPE_CHECKING, Callable, Generic, Iterable, Iterator, TypeVar, cast)
+
+if TYPE_CHECKING:
+    from . import AndroidDevice
+    from .host_protocol import AdbServerClient
+
+T = TypeVar('T')
+
+
+class DeviceResult(Generic[T]):
+    """The outcome of an operation on one device.
+
+    Exactly one of `value` and `error` is meaningful: `error` is None if the
+    operation succeeded.
+    """
+
+    def __init__(
+        self,
+        device: AndroidDevice,
+        value: T | None = None,
+        error: BaseException | None = None,
+    ) -> None:
+        self.device = device
+        self.value = value
+        self.error = error
+
+    @property
+    def serial(self) -> str | None:
+        return self.device.serial
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        if self.error is not None:
+            return 'DeviceResult({}, error={!r})'.format(
+                self.serial, self.error)
+        return 'DeviceResult({}, {!r})'.format(self.serial, self.value)
+
+
+class DeviceGroupError(RuntimeError):
+    """Raised by DeviceGroup.check() if the operation failed on any device."""
+
+    def __init__(self, results: list[DeviceResult[T]]) -> None:
+        self.results = results
+        self.failures = [r for r in results if r.error is not None]
+        lines = ['{} of {} devices failed:'.format(
+            len(self.failures), len(results))]
+        for result in self.failures:
+            lines.append('  {}: {}'.format(result.serial, result.error))
+        super(DeviceGroupError, self).__init__('\n'.join(lines))
+
+
+class DeviceTimeoutError(TimeoutError):
+    def __init__(self, serial: str | None, timeout: float) -> None:
+        super(DeviceTimeoutError, self).__init__(
+            'device {} did not finish within {} seconds'.format(
+                serial, timeout))
+        self.serial = serial
+        self.timeout = timeout
+
+
+class DeviceGroup(object):
+    """A set of devices which run the same operation concurrently.
+
+    Each operation returns an iterator which yields a DeviceResult per device
+    as soon as it is available. Pass it to DeviceGroup.check() to wait for
+    all devices and raise DeviceGroupError if any of them failed:
+
+        group = DeviceGroup.from_serials()
+        for result in group.shell(['uptime']):
+            print(result.serial, result.value)
+        props = DeviceGroup.check(group.get_prop('ro.build.id'))
+
+    The AndroidDevice objects are kept, so their cached features, line
+    separators and shell protocol checks are reused across operations.
+    """
+
+    def __init__(
+        self,
+        devices: Iterable[AndroidDevice],
+        max_workers: int | None = None,
+        timeout: float | None = None,
+    ) -> None:
+        """
+        Args:
+            devices: The devices in the group.
+            max_workers: Maximum number of concurrent operations. Defaults to
+                one per device.
+            timeout: Default per-device timeout in seconds.
+        """
+        self.devices = list(devices)
+        self.max_workers = max_workers or max(len(self.devices), 1)
+        self.timeout = timeout
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_serials(
+        cls,
+        serials: Iterable[str] | None = None,
+        adb_path: str = 'adb',
+        server: AdbServerClient | None = None,
+        max_workers: int | None = None,
+        timeout: float | None = None,
+    ) -> DeviceGroup:
+        """Creates a group from serials, or from all connected devices."""
+        from . import AndroidDevice, get_devices
+        if serials is None:
+            serials = get_devices(adb_path=adb_path)
+        devices = [AndroidDevice(serial, adb_path=adb_path, server=server)
+                   for serial in serials]
+        return cls(devices, max_workers, timeout)
+
+    def __enter__(self) -> DeviceGroup:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stops the worker threads once the running operations finish."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix='DeviceGroup')
+            return self._executor
+
+    def map(
+        self,
+        fn: Callable[[AndroidDevice], T],
+        timeout: float | None = None,
+    ) -> Iterator[DeviceResult[T]]:
+        """Calls `fn` for every device and yields results as they complete.
+
+        The calls are submitted immediately, so they run even if the returned
+        iterator is never consumed.
+
+        A device which doesn't finish within `timeout` seconds (after its
+        call started) is reported with a DeviceTimeoutError. Python threads
+        can't be interrupted, so the call itself keeps running in the
+        background and keeps holding its worker thread until it returns.
+        Later operations on the group queue behind it if all `max_workers`
+        threads are held this way.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        executor = self._get_executor()
+        start_times: dict[int, float] = {}
+
+        def _run(index: int, device: AndroidDevice) -> T:
+            start_times[index] = time.monotonic()
+            return fn(device)
+
+        futures = {
+            executor.submit(_run, index, device): (index, device)
+            for index, device in enumerate(self.devices)
+        }
+        return self._iter_results(futures, start_times, timeout)
+
+    @staticmethod
+    def _iter_results(
+        futures: dict[concurrent.futures.Future[T],
+                      tuple[int, AndroidDevice]],
+        start_times: dict[int, float],
+        timeout: float | None,
+    ) -> Iterator[DeviceResult[T]]:
+        pending = set(futures)
+        while pending:
+            wait_timeout = None
+            if timeout is not None:
+                started = [start_times[futures[f][0]] for f in pending
+                           if futures[f][0] in start_times]
+                # Queued calls have no deadline yet; poll until they start.
+                first_deadline = min(started) + timeout if started else \
+                    time.monotonic() + timeout
+                wait_timeout = max(first_deadline - time.monotonic(), 0)
+
+            done, pending = concurrent.futures.wait(
+                pending, wait_timeout,
+                concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                device = futures[future][1]
+                try:
+                    result = DeviceResult(device, future.result())
+                except Exception as e:
+                    result = DeviceResult(device, error=e)
+                yield result
+
+            if timeout is not None:
+                now = time.monotonic()
+                for future in list(pending):
+                    index, device = futures[future]
+                    start_time = start_times.get(index)
+                    if start_time is not None and now - start_time >= timeout:
+                        pending.discard(future)
+                        yield DeviceResult(
+                            device,
+                            error=DeviceTimeoutError(device.serial, timeout))
+
+    @staticmethod
+    def check(results: Iterable[DeviceResult[T]]) -> dict[str | None, T]:
+        """Waits for all results and maps serials to values.
+
+        Raises:
+            DeviceGroupError: the operation failed on at least one device.
+        """
+        result_list = list(results)
+        if any(result.error is not None for result in result_list):
+            raise DeviceGroupError(result_list)
+        return {result.serial: cast(T, result.value)
+                for result in result_list}
+
+    def shell(
+        self, cmd: list[str], timeout: float | None = None
+    ) -> Iterator[DeviceResult[tuple[str, str]]]:
+        """Runs AndroidDevice.shell() on all devices."""
+        return self.map(lambda device: device.shell(cmd), timeout)
+
+    def shell_nocheck(
+        self, cmd: list[str], timeout: float | None = None
+    ) -> Iterator[DeviceResult[tuple[int, str, str]]]:
+        """Runs AndroidDevice.shell_nocheck() on all devices."""
+        return self.map(lambda device: device.shell_nocheck(cmd), timeout)
+
+    def get_prop(
+        self, prop_name: str, timeout: float | None = None
+    ) -> Iterator[DeviceResult[str | None]]:
+        return self.map(lambda device: device.get_prop(prop_name), timeout)
+
+    def push(
+        self,
+        local: str | list[str],
+        remote: str,
+        sync: bool = False,
+        timeout: float | None = None,
+    ) -> Iterator[DeviceResult[str]]:
+        return self.map(
+            lambda device: device.push(local, remote, sync), timeout)
+
+    def pull(
+        self, remote: str, local_dir: str, timeout: float | None = None
+    ) -> Iterator[DeviceResult[str]]:
+        """Pulls `remote` from every device into `local_dir`/<serial>."""
+        def _pull(device: AndroidDevice) -> str:
+            local = os.path.join(local_dir, device.serial or 'default')
+            os.makedirs(local, exist_ok=True)
+            return device.pull(remote, local)
+        return self.map(_pull, timeout)
+
+    def install(
+        self,
+        filename: str,
+        replace: bool = False,
+        timeout: float | None = None,
+    ) -> Iterator[DeviceResult[str]]:
+        return self.map(
+            lambda device: device.install(filename, replace), timeout)
@@ -0,0 +1,405 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Client for the adb server's host protocol.
+
+The adb server (started by `adb start-server`) listens on tcp:5037. Talking to
+it directly avoids spawning an `adb` client process per command. See
+system/core/adb/SERVICES.TXT, SYNC.TXT and shell_protocol.h in the adb
+sources for the protocol descriptions.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import socket
+import stat
+import struct
+import threading
+from typing import Iterator, NamedTuple, NoReturn
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5037
+
+# Shell protocol packet IDs.
+SHELL_ID_STDIN = 0
+SHELL_ID_STDOUT = 1
+SHELL_ID_STDERR = 2
+SHELL_ID_EXIT = 3
+SHELL_ID_CLOSE_STDIN = 4
+
+# Maximum payload of a sync DATA packet.
+SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbServerError(RuntimeError):
+    pass
+
+
+class StatResult(NamedTuple):
+    mode: int
+    size: int
+    mtime: int
+
+    def exists(self) -> bool:
+        return self.mode != 0
+
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.mode)
+
+
+class DirEntry(NamedTuple):
+    name: str
+    mode: int
+    size: int
+    mtime: int
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, SYNC_DATA_MAX))
+        if not chunk:
+            raise AdbServerError('connection closed by adb server')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class _Connection(object):
+    """A socket to the adb server speaking the smart socket protocol."""
+
+    def __init__(self, host: str, port: int, timeout: float | None) -> None:
+        try:
+            self.sock = socket.create_connection((host, port), timeout)
+        except OSError as e:
+            raise AdbServerError(
+                'cannot connect to adb server at {}:{}: {}'.format(
+                    host, port, e))
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def send_request(self, request: str) -> None:
+        """Sends a host request and waits for OKAY."""
+        payload = request.encode('utf-8')
+        self.sock.sendall(b'%04x' % len(payload) + payload)
+        self.read_status()
+
+    def read_status(self) -> None:
+        status = _recv_exactly(self.sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbServerError(self.read_length_prefixed().decode('utf-8'))
+        raise AdbServerError('unexpected adb server status: {!r}'.format(
+            status))
+
+    def read_length_prefixed(self) -> bytes:
+        length = int(_recv_exactly(self.sock, 4), 16)
+        return _recv_exactly(self.sock, length)
+
+
+class SyncConnection(object):
+    """A connection running the sync service of a device.
+
+    A sync connection serves any number of STAT, LIST, SEND and RECV requests
+    until it is closed, so AdbServerClient keeps idle ones in a pool.
+    """
+
+    def __init__(self, conn: _Connection) -> None:
+        self._conn = conn
+
+    def close(self) -> None:
+        try:
+            self._send_request(b'QUIT', b'')
+        except OSError:
+            pass
+        self._conn.close()
+
+    def _send_request(self, request_id: bytes, payload: bytes) -> None:
+        self._conn.sock.sendall(
+            request_id + struct.pack('<I', len(payload)) + payload)
+
+    def _read_header(self) -> tuple[bytes, int]:
+        header = _recv_exactly(self._conn.sock, 8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def _raise_fail(self, length: int) -> NoReturn:
+        message = _recv_exactly(self._conn.sock, length).decode(
+            'utf-8', 'replace')
+        raise AdbServerError(message)
+
+    def stat(self, remote: str) -> StatResult:
+        """Returns the mode, size and mtime of a remote path.
+
+        The mode is 0 if the path does not exist.
+        """
+        self._send_request(b'STAT', remote.encode('utf-8'))
+        response = _recv_exactly(self._conn.sock, 16)
+        if response[:4] != b'STAT':
+            raise AdbServerError('unexpected sync response: {!r}'.format(
+                response[:4]))
+        mode, size, mtime = struct.unpack('<III', response[4:])
+        return StatResult(mode, size, mtime)
+
+    def list(self, remote: str) -> list[DirEntry]:
+        """Lists a remote directory, excluding `.` and `..`."""
+        self._send_request(b'LIST', remote.encode('utf-8'))
+        entries: list[DirEntry] = []
+        while True:
+            response = _recv_exactly(self._conn.sock, 20)
+            response_id = response[:4]
+            if response_id == b'DONE':
+                return entries
+            if response_id == b'FAIL':
+                self._raise_fail(struct.unpack('<I', response[4:8])[0])
+            if response_id != b'DENT':
+                raise AdbServerError('unexpected sync response: {!r}'.format(
+                    response_id))
+            mode, size, mtime, name_length = struct.unpack(
+                '<IIII', response[4:])
+            name = _recv_exactly(self._conn.sock, name_length).decode(
+                'utf-8', 'surrogateescape')
+            if name not in ('.', '..'):
+                entries.append(DirEntry(name, mode, size, mtime))
+
+    def send(
+        self, chunks: Iterator[bytes], remote: str, mode: int, mtime: int
+    ) -> int:
+        """Writes the data from `chunks` to a remote file.
+
+        Returns:
+            The number of bytes transferred.
+        """
+        self._send_request(
+            b'SEND', '{},{}'.format(remote, mode).encode('utf-8'))
+        size = 0
+        for chunk in chunks:
+            for offset in range(0, len(chunk), SYNC_DATA_MAX):
+                data = chunk[offset:offset + SYNC_DATA_MAX]
+                self._send_request(b'DATA', data)
+                size += len(data)
+        self._conn.sock.sendall(b'DONE' + struct.pack('<I', mtime))
+        response_id, length = self._read_header()
+        if response_id == b'FAIL':
+            self._raise_fail(length)
+        if response_id != b'OKAY':
+            raise AdbServerError('unexpected sync response: {!r}'.format(
+                response_id))
+        return size
+
+    def recv(self, remote: str) -> Iterator[bytes]:
+        """Reads a remote file in chunks."""
+        self._send_request(b'RECV', remote.encode('utf-8'))
+        while True:
+            response_id, length = self._read_header()
+            if response_id == b'DONE':
+                return
+            if response_id == b'FAIL':
+                self._raise_fail(length)
+            if response_id != b'DATA':
+                raise AdbServerError('unexpected sync response: {!r}'.format(
+                    response_id))
+            yield _recv_exactly(self._conn.sock, length)
+
+
+def shell_service(cmd: list[str], shell_v2: bool) -> str:
+    """Returns the service name which runs `cmd` without a PTY."""
+    command = ' '.join(cmd)
+    if shell_v2:
+        return 'shell,v2,raw:' + command
+    return 'shell:' + command
+
+
+class ShellResult(NamedTuple):
+    exit_code: int
+    stdout: bytes
+    stderr: bytes
+
+
+class AdbServerClient(object):
+    """Client which talks to a running adb server over a socket.
+
+    Host requests and shell commands take one connection each because the adb
+    server closes the socket once the service completes. Sync connections are
+    long lived and are pooled per device.
+    """
+
+    def __init__(
+        self,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        timeout: float | None = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._version: int | None = None
+        self._sync_pool: dict[str | None, list[SyncConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> _Connection:
+        return _Connection(self.host, self.port, self.timeout)
+
+    def host_request(self, request: str) -> bytes:
+        """Sends a host request and returns its length-prefixed reply."""
+        conn = self._connect()
+        try:
+            conn.send_request(request)
+            return conn.read_length_prefixed()
+        finally:
+            conn.close()
+
+    def version(self) -> int:
+        """Returns the ADB_SERVER_VERSION of the server. Cached."""
+        if self._version is None:
+            self._version = int(self.host_request('host:version'), 16)
+        return self._version
+
+    def devices(self) -> list[tuple[str, str]]:
+        """Returns (serial, state) pairs of the known devices."""
+        devices = []
+        for line in self.host_request('host:devices').decode(
+                'utf-8').splitlines():
+            if line.strip():
+                serial, state = line.split('\t', 1)
+                devices.append((serial, state))
+        return devices
+
+    def features(self, serial: str | None) -> list[str]:
+        """Returns the features supported by both the device and the server."""
+        if serial is None:
+            request = 'host:features'
+        else:
+            request = 'host-serial:{}:features'.format(serial)
+        features = self.host_request(request).decode('utf-8').strip()
+        return features.split(',') if features else []
+
+    def open_service(self, serial: str | None, service: str) -> _Connection:
+        """Switches a new connection to the device and starts a service."""
+        conn = self._connect()
+        try:
+            if serial is None:
+                conn.send_request('host:transport-any')
+            else:
+                conn.send_request('host:transport:{}'.format(serial))
+            conn.send_request(service)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def shell(
+        self, serial: str | None, cmd: list[str], shell_v2: bool = True
+    ) -> ShellResult:
+        """Runs a shell command without a PTY.
+
+        Without the shell protocol stderr is merged into stdout and the exit
+        code is unknown (reported as 0).
+        """
+        stdout = []
+        stderr = []
+        exit_code = 0
+        for packet_id, data in self.shell_packets(serial, cmd, shell_v2):
+            if packet_id == SHELL_ID_STDOUT:
+                stdout.append(data)
+            elif packet_id == SHELL_ID_STDERR:
+                stderr.append(data)
+            elif packet_id == SHELL_ID_EXIT:
+                exit_code = data[0]
+        return ShellResult(exit_code, b''.join(stdout), b''.join(stderr))
+
+    def shell_packets(
+        self, serial: str | None, cmd: list[str], shell_v2: bool = True
+    ) -> Iterator[tuple[int, bytes]]:
+        """Runs a shell command and yields (packet ID, data) as they arrive.
+
+        Without the shell protocol all output is reported as stdout.
+        """
+        conn = self.open_service(serial, shell_service(cmd, shell_v2))
+        try:
+            if not shell_v2:
+                while True:
+                    chunk = conn.sock.recv(SYNC_DATA_MAX)
+                    if not chunk:
+                        return
+                    yield SHELL_ID_STDOUT, chunk
+            while True:
+                header = conn.sock.recv(5)
+                if not header:
+                    return
+                if len(header) < 5:
+                    header += _recv_exactly(conn.sock, 5 - len(header))
+                packet_id = header[0]
+                length = struct.unpack('<I', header[1:])[0]
+                yield packet_id, _recv_exactly(conn.sock, length)
+                if packet_id == SHELL_ID_EXIT:
+                    return
+        finally:
+            conn.close()
+
+    async def open_service_async(
+        self, serial: str | None, service: str
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """The asyncio counterpart of open_service()."""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if serial is None:
+                transport = 'host:transport-any'
+            else:
+                transport = 'host:transport:{}'.format(serial)
+            for request in (transport, service):
+                payload = request.encode('utf-8')
+                writer.write(b'%04x' % len(payload) + payload)
+                await writer.drain()
+                status = await reader.readexactly(4)
+                if status == b'FAIL':
+                    length = int(await reader.readexactly(4), 16)
+                    message = await reader.readexactly(length)
+                    raise AdbServerError(message.decode('utf-8'))
+                if status != b'OKAY':
+                    raise AdbServerError(
+                        'unexpected adb server status: {!r}'.format(status))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    @contextlib.contextmanager
+    def sync(self, serial: str | None) -> Iterator[SyncConnection]:
+        """Borrows a sync connection to the device from the pool."""
+        with self._lock:
+            pool = self._sync_pool.get(serial)
+            sync_conn = pool.pop() if pool else None
+        if sync_conn is None:
+            sync_conn = SyncConnection(self.open_service(serial, 'sync:'))
+        try:
+            yield sync_conn
+        except BaseException:
+            # The connection may be in the middle of a request.
+            sync_conn.close()
+            raise
+        with self._lock:
+            self._sync_pool.setdefault(serial, []).append(sync_conn)
+
+    def close(self) -> None:
+        """Closes the pooled sync connections."""
+        with self._lock:
+            pools = list(self._sync_pool.values())
+            self._sync_pool.clear()
+        for pool in pools:
+            for sync_conn in pool:
+                sync_conn.close()
@@ -0,0 +1,402 @@
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Streaming access to the output of `adb shell` commands."""
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import subprocess
+import threading
+from typing import AsyncIterator, Iterator
+
+from .host_protocol import SHELL_ID_EXIT, SHELL_ID_STDERR, SHELL_ID_STDOUT
+
+# The exit code probe appended on devices without the shell protocol. See
+# AndroidDevice._RETURN_CODE_PROBE.
+_RETURN_CODE_DELIMITER = b'x'
+_RETURN_CODE_SEARCH_LENGTH = len(b'x255\r\r\n')
+
+_LINE_END_RE = re.compile(rb'\r*\n')
+
+
+class _ExitCodeTail(object):
+    """Holds back the end of a legacy shell stream to find the exit code.
+
+    Only the last few bytes are kept, so memory stays bounded no matter how
+    long the output is.
+    """
+
+    def __init__(self) -> None:
+        self.exit_code: int | None = None
+        self._tail = b''
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Returns the part of the output which can be passed on."""
+        data = self._tail + chunk
+        split = max(len(data) - _RETURN_CODE_SEARCH_LENGTH, 0)
+        self._tail = data[split:]
+        return data[:split]
+
+    def finish(self) -> bytes:
+        """Parses the exit code and returns the rest of the output."""
+        before, delimiter, exit_code = self._tail.rpartition(
+            _RETURN_CODE_DELIMITER)
+        if not delimiter:
+            raise RuntimeError('Could not find exit status in shell output.')
+        self.exit_code = int(exit_code)
+        return before
+
+    def strip(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            data = self.feed(chunk)
+            if data:
+                yield data
+        data = self.finish()
+        if data:
+            yield data
+
+
+def _split_lines(chunks: Iterator[bytes], encoding: str) -> Iterator[str]:
+    partial = b''
+    for chunk in chunks:
+        lines = _LINE_END_RE.split(partial + chunk)
+        partial = lines.pop()
+        for line in lines:
+            yield line.decode(encoding)
+    partial = partial.rstrip(b'\r')
+    if partial:
+        yield partial.decode(encoding)
+
+
+def _stop_process(process: subprocess.Popen[bytes]) -> None:
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+    if process.stdout is not None:
+        process.stdout.close()
+    if process.stderr is not None:
+        process.stderr.close()
+
+
+class ShellStream(object):
+    """Iterates over the stdout of a shell command as it arrives.
+
+    Only the chunk being processed is held in memory. `exit_code` and `stderr`
+    are available once the stream is exhausted. Stderr is merged into stdout
+    if the device doesn't support separate streams.
+
+        with device.shell_stream(['logcat', '-d']) as stream:
+            for line in stream.lines():
+                ...
+        print(stream.exit_code)
+    """
+
+    def __init__(self) -> None:
+        self._chunks: Iterator[bytes] = iter(())
+        self._process: subprocess.Popen[bytes] | None = None
+        self._packets: Iterator[tuple[int, bytes]] | None = None
+        self.exit_code: int | None = None
+        self.stderr = b''
+
+    @classmethod
+    def from_process(
+        cls,
+        process: subprocess.Popen[bytes],
+        shell_v2: bool,
+        chunk_size: int = 64 * 1024,
+    ) -> ShellStream:
+        """Streams the output of an `adb shell` process."""
+        stream = cls()
+        stream._process = process
+        stream._chunks = stream._read_process(process, shell_v2, chunk_size)
+        return stream
+
+    @classmethod
+    def from_packets(
+        cls, packets: Iterator[tuple[int, bytes]], shell_v2: bool
+    ) -> ShellStream:
+        """Streams the packets from AdbServerClient.shell_packets()."""
+        stream = cls()
+        stream._packets = packets
+        stream._chunks = stream._read_packets(packets, shell_v2)
+        return stream
+
+    def _read_process(
+        self,
+        process: subprocess.Popen[bytes],
+        shell_v2: bool,
+        chunk_size: int,
+    ) -> Iterator[bytes]:
+        assert process.stdout is not None and process.stderr is not None
+        stdout = process.stdout
+        stderr = process.stderr
+
+        # Drain stderr concurrently so that the process can't block on it.
+        stderr_chunks: list[bytes] = []
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_chunks.append(stderr.read()))
+        stderr_thread.start()
+        try:
+            fd = stdout.fileno()
+            chunks = iter(lambda: os.read(fd, chunk_size), b'')
+            if shell_v2:
+                yield from chunks
+            else:
+                tail = _ExitCodeTail()
+                yield from tail.strip(chunks)
+                self.exit_code = tail.exit_code
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            stderr_thread.join()
+            stdout.close()
+            stderr.close()
+        self.stderr = b''.join(stderr_chunks)
+        if shell_v2:
+            self.exit_code = process.returncode
+
+    def _read_packets(
+        self, packets: Iterator[tuple[int, bytes]], shell_v2: bool
+    ) -> Iterator[bytes]:
+        stderr_chunks = []
+        exit_code = 0
+
+        def _stdout() -> Iterator[bytes]:
+            nonlocal exit_code
+            for packet_id, data in packets:
+                if packet_id == SHELL_ID_STDOUT:
+                    yield data
+                elif packet_id == SHELL_ID_STDERR:
+                    stderr_chunks.append(data)
+                elif packet_id == SHELL_ID_EXIT:
+                    exit_code = data[0]
+
+        try:
+            if shell_v2:
+                yield from _stdout()
+            else:
+                tail = _ExitCodeTail()
+                yield from tail.strip(_stdout())
+                exit_code = tail.exit_code or 0
+        finally:
+            close = getattr(packets, 'close', None)
+            if close is not None:
+                close()
+        self.stderr = b''.join(stderr_chunks)
+        self.exit_code = exit_code
+
+    def __enter__(self) -> ShellStream:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self._chunks
+
+    def lines(self, encoding: str = 'utf-8') -> Iterator[str]:
+        """Iterates over the decoded lines without the line endings."""
+        return _split_lines(self._chunks, encoding)
+
+    def close(self) -> None:
+        """Stops the command if the output wasn't consumed completely.
+
+        This also works if the stream was never iterated over, in which case
+        the generator's own cleanup never runs.
+        """
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
+        if self._process is not None:
+            _stop_process(self._process)
+        close = getattr(self._packets, 'close', None)
+        if close is not None:
+            close()
+
+
+class AsyncShellStream(object):
+    """The asyncio counterpart of ShellStream.
+
+        stream = await device.shell_stream_async(['dumpsys'])
+        async for chunk in stream:
+            ...
+    """
+
+    def __init__(self) -> None:
+        self._chunks: AsyncIterator[bytes] | None = None
+        self._process: asyncio.subprocess.Process | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self.exit_code: int | None = None
+        self.stderr = b''
+
+    @classmethod
+    def from_process(
+        cls,
+        process: asyncio.subprocess.Process,
+        shell_v2: bool,
+        chunk_size: int = 64 * 1024,
+    ) -> AsyncShellStream:
+        stream = cls()
+        stream._process = process
+        stream._chunks = stream._read_process(process, shell_v2, chunk_size)
+        return stream
+
+    @classmethod
+    def from_connection(
+        cls,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        shell_v2: bool,
+    ) -> AsyncShellStream:
+        stream = cls()
+        stream._writer = writer
+        stream._chunks = stream._read_connection(reader, writer, shell_v2)
+        return stream
+
+    async def _strip_exit_code(
+        self, chunks: AsyncIterator[bytes]
+    ) -> AsyncIterator[bytes]:
+        tail = _ExitCodeTail()
+        async for chunk in chunks:
+            data = tail.feed(chunk)
+            if data:
+                yield data
+        data = tail.finish()
+        self.exit_code = tail.exit_code
+        if data:
+            yield data
+
+    async def _read_process(
+        self,
+        process: asyncio.subprocess.Process,
+        shell_v2: bool,
+        chunk_size: int,
+    ) -> AsyncIterator[bytes]:
+        assert process.stdout is not None and process.stderr is not None
+        stdout = process.stdout
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+
+        async def _stdout() -> AsyncIterator[bytes]:
+            while True:
+                chunk = await stdout.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+        finished = False
+        try:
+            if shell_v2:
+                async for chunk in _stdout():
+                    yield chunk
+            else:
+                async for chunk in self._strip_exit_code(_stdout()):
+                    yield chunk
+            finished = True
+        finally:
+            # Only kill a command that was abandoned: Process.kill() polls the
+            # child, which can reap it before the asyncio child watcher does.
+            if not finished and process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+            await process.wait()
+            self.stderr = await stderr_task
+        if shell_v2:
+            self.exit_code = process.returncode
+
+    async def _read_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        shell_v2: bool,
+    ) -> AsyncIterator[bytes]:
+        stderr_chunks = []
+        exit_code = 0
+
+        async def _stdout() -> AsyncIterator[bytes]:
+            nonlocal exit_code
+            if not shell_v2:
+                while True:
+                    chunk = await reader.read(64 * 1024)
+                    if not chunk:
+                        return
+                    yield chunk
+            while True:
+                try:
+                    header = await reader.readexactly(5)
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        raise
+                    return
+                length = int.from_bytes(header[1:], 'little')
+                data = await reader.readexactly(length)
+                if header[0] == SHELL_ID_STDOUT:
+                    yield data
+                elif header[0] == SHELL_ID_STDERR:
+                    stderr_chunks.append(data)
+                elif header[0] == SHELL_ID_EXIT:
+                    exit_code = data[0]
+                    return
+
+        try:
+            if shell_v2:
+                async for chunk in _stdout():
+                    yield chunk
+            else:
+                async for chunk in self._strip_exit_code(_stdout()):
+                    yield chunk
+                exit_code = self.exit_code or 0
+        finally:
+            writer.close()
+        self.stderr = b''.join(stderr_chunks)
+        self.exit_code = exit_code
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        assert self._chunks is not None
+        return self._chunks
+
+    async def lines(self, encoding: str = 'utf-8') -> AsyncIterator[str]:
+        """Iterates over the decoded lines without the line endings."""
+        partial = b''
+        async for chunk in self:
+            lines = _LINE_END_RE.split(partial + chunk)
+            partial = lines.pop()
+            for line in lines:
+                yield line.decode(encoding)
+        partial = partial.rstrip(b'\r')
+        if partial:
+            yield partial.decode(encoding)
+
+    async def aclose(self) -> None:
+        """Stops the command if the output wasn't consumed completely.
+
+        This also works if the stream was never iterated over.
+        """
+        aclose = getattr(self._chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+        process = self._process
+        if process is not None and process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+        if self._writer is not None:
+            self._writer.close()
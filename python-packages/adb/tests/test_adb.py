@@ -13,11 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import asyncio
+import hashlib
 import os
+import socketserver
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
 import unittest
 from unittest.mock import Mock, patch
 
 import adb
+from adb import delta_push
 
 class GetDeviceTest(unittest.TestCase):
     def setUp(self) -> None:
@@ -72,6 +81,362 @@ class GetDeviceTest(unittest.TestCase):
         self.assertRaises(adb.NoUniqueDeviceError, adb.get_device)
 
 
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """An adb server with one device (`foo`) that supports shell v2 and
+    keeps pushed files in memory."""
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeAdbHandler)
+        self.files: dict[str, tuple[int, bytes, int]] = {}
+        self.requests: list[str] = []
+        self.lock = threading.Lock()
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    server: FakeAdbServer
+
+    def _recv(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _read_request(self) -> str:
+        request = self._recv(int(self._recv(4), 16)).decode('utf-8')
+        with self.server.lock:
+            self.server.requests.append(request)
+        return request
+
+    def _reply(self, payload: bytes) -> None:
+        self.request.sendall(b'OKAY%04x' % len(payload) + payload)
+
+    def handle(self) -> None:
+        try:
+            request = self._read_request()
+            if request == 'host:version':
+                self._reply(b'%04x' % 41)
+            elif request == 'host-serial:foo:features':
+                self._reply(b'shell_v2,cmd')
+            elif request == 'host:transport:foo':
+                self.request.sendall(b'OKAY')
+                self._handle_service(self._read_request())
+            else:
+                message = b'unknown request'
+                self.request.sendall(b'FAIL%04x' % len(message) + message)
+        except EOFError:
+            pass
+
+    def _handle_service(self, service: str) -> None:
+        self.request.sendall(b'OKAY')
+        if service.startswith('shell,v2,raw:'):
+            for packet_id, data in ((1, b'hi\n'), (2, b'err'), (3, b'\x03')):
+                self.request.sendall(
+                    struct.pack('<BI', packet_id, len(data)) + data)
+        elif service == 'sync:':
+            while self._handle_sync_request():
+                pass
+
+    def _handle_sync_request(self) -> bool:
+        request_id, length = struct.unpack('<4sI', self._recv(8))
+        path = self._recv(length).decode('utf-8')
+        files = self.server.files
+        if request_id == b'STAT':
+            mode, data, mtime = files.get(path, (0, b'', 0))
+            if any(name.startswith(path + '/') for name in files):
+                mode = stat.S_IFDIR
+            self.request.sendall(
+                b'STAT' + struct.pack('<III', mode, len(data), mtime))
+        elif request_id == b'SEND':
+            path, mode_str = path.rsplit(',', 1)
+            data = b''
+            while True:
+                packet_id, length = struct.unpack('<4sI', self._recv(8))
+                if packet_id == b'DONE':
+                    break
+                data += self._recv(length)
+            files[path] = (int(mode_str), data, length)
+            self.request.sendall(b'OKAY\0\0\0\0')
+        elif request_id == b'RECV':
+            data = files[path][1]
+            self.request.sendall(b'DATA' + struct.pack('<I', len(data)) + data)
+            self.request.sendall(b'DONE\0\0\0\0')
+        elif request_id == b'LIST':
+            prefix = path.rstrip('/') + '/'
+            for name in sorted(files):
+                if name.startswith(prefix):
+                    rest = name[len(prefix):].split('/', 1)
+                    mode = files[name][0] if len(rest) == 1 else stat.S_IFDIR
+                    entry = rest[0].encode('utf-8')
+                    self.request.sendall(b'DENT' + struct.pack(
+                        '<IIII', mode, 0, 0, len(entry)) + entry)
+            self.request.sendall(b'DONE' + b'\0' * 16)
+        else:
+            return False
+        return True
+
+
+class AdbServerClientTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = FakeAdbServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = adb.AdbServerClient(port=self.server.server_address[1])
+        self.device = adb.AndroidDevice('foo', server=self.client)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_shell(self) -> None:
+        self.assertEqual((3, 'hi\n', 'err'),
+                         self.device.shell_nocheck(['echo', 'hi']))
+        self.assertRaises(adb.ShellError, self.device.shell, ['echo', 'hi'])
+        self.assertEqual(['shell_v2', 'cmd'], self.device.features)
+        # The version and the features are requested only once.
+        self.assertEqual(1, self.server.requests.count('host:version'))
+        self.assertEqual(
+            1, self.server.requests.count('host-serial:foo:features'))
+        self.assertIn('shell,v2,raw:echo hi', self.server.requests)
+
+    def test_shell_stream(self) -> None:
+        with self.device.shell_stream(['echo', 'hi']) as stream:
+            self.assertEqual(['hi'], list(stream.lines()))
+        self.assertEqual(3, stream.exit_code)
+        self.assertEqual(b'err', stream.stderr)
+
+    def test_shell_stream_async(self) -> None:
+        async def _run() -> tuple[list[bytes], adb.AsyncShellStream]:
+            stream = await self.device.shell_stream_async(['echo', 'hi'])
+            return [chunk async for chunk in stream], stream
+
+        chunks, stream = asyncio.run(_run())
+        self.assertEqual([b'hi\n'], chunks)
+        self.assertEqual(3, stream.exit_code)
+        self.assertEqual(b'err', stream.stderr)
+
+    def test_error(self) -> None:
+        device = adb.AndroidDevice('bar', server=self.client)
+        self.assertRaises(adb.AdbServerError, device.push, __file__, '/data')
+
+    def test_push_pull(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src_dir = os.path.join(tmp_dir, 'src')
+            os.makedirs(os.path.join(src_dir, 'sub'))
+            for name, content in (('a', b'a' * 100000), ('sub/b', b'b')):
+                with open(os.path.join(src_dir, name), 'wb') as f:
+                    f.write(content)
+
+            self.device.push(src_dir, '/data/dst')
+            self.assertEqual(b'a' * 100000, self.server.files['/data/dst/a'][1])
+            self.assertEqual(b'b', self.server.files['/data/dst/sub/b'][1])
+
+            output = self.device.push(
+                [os.path.join(src_dir, 'a')], '/data/dst', sync=True)
+            self.assertTrue(output.startswith('0 file(s) pushed, 1 skipped.'))
+
+            # An existing remote directory receives a copy of the source.
+            self.device.push(src_dir, '/data/dst')
+            self.assertIn('/data/dst/src/sub/b', self.server.files)
+
+            self.device.pull('/data/dst', os.path.join(tmp_dir, 'out'))
+            with open(os.path.join(tmp_dir, 'out', 'sub', 'b'), 'rb') as f:
+                self.assertEqual(b'b', f.read())
+
+        # One pooled sync connection served all transfers.
+        self.assertEqual(1, self.server.requests.count('sync:'))
+
+    def test_push_delta(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src_dir = os.path.join(tmp_dir, 'src')
+            os.makedirs(src_dir)
+            for name, content in (('a', b'a' * 1000), ('b', b'b')):
+                with open(os.path.join(src_dir, name), 'wb') as f:
+                    f.write(content)
+
+            output = self.device.push(src_dir, '/data/dst', delta=True)
+            self.assertEqual(
+                '2 file(s) pushed, 0 unchanged. (1001 bytes, 0 saved)\n',
+                output)
+            self.assertIn(adb.DEFAULT_MANIFEST_PATH, self.server.files)
+
+            # Rebuilt files with new timestamps but the same content. The
+            # remote directory now exists, so push into it like adb does.
+            os.utime(os.path.join(src_dir, 'a'), (0, 0))
+            with open(os.path.join(src_dir, 'b'), 'wb') as f:
+                f.write(b'B')
+            output = self.device.push(
+                [os.path.join(src_dir, 'a'), os.path.join(src_dir, 'b')],
+                '/data/dst', delta=True)
+            self.assertEqual(
+                '1 file(s) pushed, 1 unchanged. (1 bytes, 1000 saved)\n',
+                output)
+            self.assertEqual(b'B', self.server.files['/data/dst/b'][1])
+
+            # Files removed from the device are pushed again.
+            del self.server.files['/data/dst/a']
+            output = self.device.push(
+                [os.path.join(src_dir, 'a'), os.path.join(src_dir, 'b')],
+                '/data/dst', delta=True)
+            self.assertTrue(output.startswith('1 file(s) pushed, 1 unchanged.'))
+            self.assertEqual(b'a' * 1000, self.server.files['/data/dst/a'][1])
+
+
+class DeltaPushTest(unittest.TestCase):
+    def test_hash_files(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for i in range(20):
+                paths.append(os.path.join(tmp_dir, str(i)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(b'%d' % i)
+            parallel = delta_push.hash_files(paths, max_workers=2)
+            self.assertEqual(
+                delta_push.hash_files(paths, max_workers=1), parallel)
+            self.assertEqual(hashlib.sha256(b'7').hexdigest(),
+                             parallel[paths[7]])
+
+    def test_manifest(self) -> None:
+        manifest = {'/data/a': delta_push.ManifestEntry('00', 1)}
+        self.assertEqual(manifest, delta_push.parse_manifest(
+            delta_push.format_manifest(manifest)))
+        self.assertEqual({}, delta_push.parse_manifest(b'garbage'))
+
+    def test_manifest_pushed_after_files(self) -> None:
+        device = adb.AndroidDevice('foo')
+        pushed: list[str] = []
+
+        def _simple_call(cmd: list[str]) -> str:
+            # Fail the first push, recording the files it would transfer.
+            for top in cmd[1:-1]:
+                for root, _, names in os.walk(top):
+                    pushed.extend(os.path.join(root, name) for name in names)
+            raise subprocess.CalledProcessError(1, cmd)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'a')
+            with open(path, 'wb') as f:
+                f.write(b'a')
+            with patch.object(device, 'shell_nocheck',
+                              return_value=(1, '', '')), \
+                    patch.object(device, '_simple_call',
+                                 side_effect=_simple_call):
+                self.assertRaises(subprocess.CalledProcessError,
+                                  device.push_delta, [path], '/data/a')
+        self.assertEqual(1, len(pushed))
+        self.assertTrue(pushed[0].endswith('/data/a'))
+
+
+class ShellStreamTest(unittest.TestCase):
+    def test_legacy_exit_code(self) -> None:
+        packets = iter([(1, b'hello\r\nwor'), (1, b'ld\nx'), (1, b'12\r\n')])
+        stream = adb.ShellStream.from_packets(packets, shell_v2=False)
+        self.assertEqual(['hello', 'world'], list(stream.lines()))
+        self.assertEqual(12, stream.exit_code)
+
+        stream = adb.ShellStream.from_packets(iter([(1, b'no code')]), False)
+        self.assertRaises(RuntimeError, list, stream)
+
+    def test_process(self) -> None:
+        p = subprocess.Popen(
+            ['sh', '-c', 'printf "a\\nb"; echo err >&2; exit 3'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stream = adb.ShellStream.from_process(p, shell_v2=True, chunk_size=1)
+        self.assertEqual(b'a\nb', b''.join(stream))
+        self.assertEqual(3, stream.exit_code)
+        self.assertEqual(b'err\n', stream.stderr)
+
+    def test_async_process(self) -> None:
+        async def _run() -> tuple[list[str], adb.AsyncShellStream]:
+            p = await asyncio.create_subprocess_exec(
+                'sh', '-c', 'printf "a\\nbx7\\n"',
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stream = adb.AsyncShellStream.from_process(p, shell_v2=False)
+            return [line async for line in stream.lines()], stream
+
+        lines, stream = asyncio.run(_run())
+        self.assertEqual(['a', 'b'], lines)
+        self.assertEqual(7, stream.exit_code)
+
+    def test_close_without_iterating(self) -> None:
+        p = subprocess.Popen(['sleep', '60'], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        with adb.ShellStream.from_process(p, shell_v2=True):
+            pass
+        self.assertIsNotNone(p.returncode)
+        assert p.stdout is not None
+        self.assertTrue(p.stdout.closed)
+
+    def test_async_close_without_iterating(self) -> None:
+        async def _run() -> asyncio.subprocess.Process:
+            p = await asyncio.create_subprocess_exec(
+                'sleep', '60',
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stream = adb.AsyncShellStream.from_process(p, shell_v2=True)
+            await stream.aclose()
+            return p
+
+        p = asyncio.run(asyncio.wait_for(_run(), timeout=10))
+        self.assertIsNotNone(p.returncode)
+
+
+class DeviceGroupTest(unittest.TestCase):
+    def _make_device(self, serial: str) -> Mock:
+        device = Mock(spec=adb.AndroidDevice)
+        device.serial = serial
+        return device
+
+    def test_map(self) -> None:
+        devices = [self._make_device(serial) for serial in ('a', 'b', 'c')]
+        for device in devices:
+            device.get_prop.return_value = device.serial.upper()
+        devices[1].get_prop.side_effect = RuntimeError('offline')
+
+        with adb.DeviceGroup(devices) as group:
+            results = list(group.get_prop('ro.serialno'))
+            self.assertEqual(3, len(results))
+            by_serial = {result.serial: result for result in results}
+            self.assertEqual('A', by_serial['a'].value)
+            self.assertFalse(by_serial['b'].ok)
+
+            with self.assertRaises(adb.DeviceGroupError) as cm:
+                adb.DeviceGroup.check(group.get_prop('ro.serialno'))
+            self.assertEqual(['b'], [r.serial for r in cm.exception.failures])
+            self.assertIn('1 of 3 devices failed', str(cm.exception))
+
+            devices[1].get_prop.side_effect = None
+            self.assertEqual({'a': 'A', 'b': 'B', 'c': 'C'},
+                             adb.DeviceGroup.check(group.get_prop('x')))
+
+    def test_timeout(self) -> None:
+        release = threading.Event()
+        devices = [self._make_device('fast'), self._make_device('slow')]
+        devices[0].shell.return_value = ('', '')
+        devices[1].shell.side_effect = lambda cmd: release.wait()
+
+        with adb.DeviceGroup(devices, timeout=0.2) as group:
+            results = list(group.shell(['true']))
+            release.set()
+        self.assertEqual('fast', results[0].serial)
+        self.assertTrue(results[0].ok)
+        self.assertIsInstance(results[1].error, adb.DeviceTimeoutError)
+
+    def test_map_runs_without_iterating(self) -> None:
+        called = threading.Event()
+        devices = [self._make_device('a')]
+        devices[0].shell.side_effect = lambda cmd: called.set()
+
+        with adb.DeviceGroup(devices) as group:
+            group.shell(['true'])
+            self.assertTrue(called.wait(10))
+
+
 def main() -> None:
     suite = unittest.TestLoader().loadTestsFromName(__name__)
     unittest.TextTestRunner(verbosity=3).run(suite)
@@ -16,22 +16,121 @@
 
 """stack symbolizes native crash dumps."""
 
+import bisect
 import collections
+import contextlib
 import functools
+import glob
+import json
+import mmap
 import os
 import pathlib
 import re
+import shutil
+import struct
 import subprocess
 import symbol
 import tempfile
 import unittest
+import zipfile
 
 import example_crashes
 
-def ConvertTrace(lines):
+def ConvertTrace(lines, jobs=None):
   tracer = TraceConverter()
   print("Reading symbols from", symbol.SYMBOLS_DIR)
-  tracer.ConvertTrace(lines)
+  tracer.ConvertTrace(lines, jobs)
+
+# Files inside a bugreport zip that can contain crashes.
+_BUGREPORT_CRASH_MEMBER = re.compile(r"(^|/)(tombstones/tombstone_\d+|bugreport[^/]*\.txt)$")
+
+def ReadBatchInputs(pattern):
+  """Yield the inputs for ConvertTraces one at a time.
+
+  Args:
+    pattern: a directory, which is searched recursively, a glob pattern or a
+      single file. Zip files are treated as bugreports and the tombstones and
+      logcat captures inside them are returned as separate inputs.
+
+  Yields:
+    Tuples (name, lines).
+  """
+  if os.path.isdir(pattern):
+    paths = sorted(str(path) for path in pathlib.Path(pattern).glob("**/*")
+                   if path.is_file())
+  else:
+    paths = sorted(glob.glob(pattern))
+  for path in paths:
+    if zipfile.is_zipfile(path):
+      with zipfile.ZipFile(path) as zf:
+        for name in sorted(zf.namelist()):
+          if _BUGREPORT_CRASH_MEMBER.search(name):
+            with zf.open(name) as f:
+              yield (path + "!" + name,
+                     [line.decode("utf-8", errors="ignore") for line in f])
+    else:
+      with open(path, "r", errors="ignore") as f:
+        yield path, f.readlines()
+
+def ConvertTraces(pattern, out_dir, jobs=None):
+  """Symbolize many crash files at once.
+
+  Every (library, address) pair is collected from all the inputs first, so
+  each unique address is symbolized exactly once no matter how many crashes
+  it appears in. A symbolized copy of each input is written to out_dir,
+  along with a summary.jsonl file holding one line per input.
+  """
+  print("Reading symbols from", symbol.SYMBOLS_DIR)
+  tracer = TraceConverter()
+  fixed_bitness = symbol.ARCH_IS_32BIT
+
+  def PrepareInput(lines):
+    if fixed_bitness is None:
+      symbol.SetBitness(lines)
+    tracer.UpdateBitnessRegexes()
+    tracer.trace_lines = []
+    tracer.value_lines = []
+    tracer.last_frame = -1
+    tracer.crash_trace_lines = None
+
+  try:
+    addrs_by_lib = collections.defaultdict(set)
+    count = 0
+    for _, lines in ReadBatchInputs(pattern):
+      lines = [tracer.CleanLine(line) for line in lines]
+      PrepareInput(lines)
+      for lib, addrs in tracer.CollectAddresses(lines).items():
+        addrs_by_lib[lib].update(addrs)
+      count += 1
+    print("Symbolizing %d unique addresses from %d inputs" %
+          (sum(len(addrs) for addrs in addrs_by_lib.values()), count))
+    symbol.SymbolInformationForLibs(addrs_by_lib, jobs)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "summary.jsonl"), "w") as summary:
+      for index, (name, lines) in enumerate(ReadBatchInputs(pattern)):
+        lines = [tracer.CleanLine(line) for line in lines]
+        PrepareInput(lines)
+        output = "%05d_%s.txt" % (index, re.sub(r"[^\w.-]", "_", os.path.basename(name)))
+        with open(os.path.join(out_dir, output), "w") as f:
+          with contextlib.redirect_stdout(f):
+            for line in lines:
+              tracer.ProcessLine(line)
+            tracer.PrintOutput(tracer.trace_lines, tracer.value_lines)
+        record = {"input": name, "output": output}
+        for key, regex in (("process", tracer.process_info_line),
+                           ("signal", tracer.signal_line),
+                           ("abort_message", tracer.abort_message_line)):
+          for line in lines:
+            match = regex.search(line)
+            if match:
+              record[key] = match.group(1)
+              break
+        record["frames"] = [list(frame) for frame in tracer.crash_trace_lines or []]
+        summary.write(json.dumps(record) + "\n")
+  finally:
+    # Delete any temporary files created while processing the lines.
+    tracer.DeleteApkTmpFiles()
 
 class TraceConverter:
   process_info_line = re.compile(r"(pid: [0-9]+, tid: [0-9]+.*)")
@@ -46,21 +145,21 @@ class TraceConverter:
   sanitizer_trace_line = re.compile("$a")
   value_line = re.compile("$a")
   code_line = re.compile("$a")
-  zipinfo_central_directory_line = re.compile(r"Central\s+directory\s+entry")
-  zipinfo_central_info_match = re.compile(
-      r"^\s*(\S+)$\s*offset of local header from start of archive:\s*(\d+)"
-      r".*^\s*compressed size:\s+(\d+)", re.M | re.S)
   unreachable_line = re.compile(r"((\d+ bytes in \d+ unreachable allocations)|"
                                 r"(\d+ bytes unreachable at [0-9a-f]+)|"
                                 r"(referencing \d+ unreachable bytes in \d+ allocation(s)?)|"
                                 r"(and \d+ similar unreachable bytes in \d+ allocation(s)?))")
   trace_lines = []
   value_lines = []
+  # The first stack trace printed, usually the crashing thread.
+  crash_trace_lines = None
   last_frame = -1
   width = "{8}"
   spacing = ""
   apk_info = dict()
   lib_to_path = dict()
+  # ResolveTraceLib() results by (area, so_offset, build_id).
+  trace_libs = dict()
 
   register_names = {
     "arm": "r0|r1|r2|r3|r4|r5|r6|r7|r8|r9|sl|fp|ip|sp|lr|pc|cpsr",
@@ -167,6 +266,8 @@ class TraceConverter:
 
   def PrintOutput(self, trace_lines, value_lines):
     if self.trace_lines:
+      if self.crash_trace_lines is None:
+        self.crash_trace_lines = self.trace_lines
       self.PrintTraceLines(self.trace_lines)
     if self.value_lines:
       self.PrintValueLines(self.value_lines)
@@ -175,16 +276,19 @@ class TraceConverter:
     print("\n-----------------------------------------------------\n")
 
   def DeleteApkTmpFiles(self):
-    for _, _, tmp_files in self.apk_info.values():
+    for _, _, _, tmp_files in self.apk_info.values():
       for tmp_file in tmp_files.values():
         os.unlink(tmp_file)
+    # Libraries extracted from apks are gone now.
+    self.trace_libs.clear()
 
-  def ConvertTrace(self, lines):
+  def ConvertTrace(self, lines, jobs=None):
     lines = [self.CleanLine(line) for line in lines]
     try:
       if symbol.ARCH_IS_32BIT is None:
         symbol.SetBitness(lines)
       self.UpdateBitnessRegexes()
+      self.PrefetchSymbols(lines, jobs)
       for line in lines:
         self.ProcessLine(line)
       self.PrintOutput(self.trace_lines, self.value_lines)
@@ -192,6 +296,40 @@ class TraceConverter:
       # Delete any temporary files created while processing the lines.
       self.DeleteApkTmpFiles()
 
+  def CollectAddresses(self, lines):
+    """Find all the addresses that ProcessLine() will need to symbolize.
+
+    Returns:
+      A dictionary of the form {lib: set of hexidecimal addresses}.
+    """
+    addrs_by_lib = collections.defaultdict(set)
+    for line in lines:
+      trace_line_dict = self.MatchTraceLine(line)
+      if trace_line_dict is not None:
+        area = trace_line_dict["dso"]
+        if area not in ("<unknown>", "[heap]", "[stack]"):
+          _, lib, _ = self.ResolveTraceLib(area, trace_line_dict["so_offset"],
+                                           trace_line_dict["build_id"])
+          if lib:
+            addrs_by_lib[lib].add(trace_line_dict["offset"])
+      if self.code_line.match(line):
+        continue
+      match = self.value_line.match(line)
+      if match:
+        (_, _, value, area, _, _) = match.groups()
+        if area and area not in ("<unknown>", "[heap]", "[stack]"):
+          addrs_by_lib[area].add(value)
+    return addrs_by_lib
+
+  def PrefetchSymbols(self, lines, jobs=None):
+    """Symbolize every frame up front, with the libraries in parallel.
+
+    The results land in the symbol module's caches, so the following
+    ProcessLine() calls print the output in the original order without
+    waiting on any tool.
+    """
+    symbol.SymbolInformationForLibs(self.CollectAddresses(lines), jobs)
+
   def MatchTraceLine(self, line):
     match = self.trace_line.match(line)
     if match:
@@ -213,103 +351,99 @@ class TraceConverter:
               "build_id": None}
     return None
 
-  def ExtractLibFromApk(self, apk, shared_lib_name):
-    # Create a temporary file containing the shared library from the apk.
+  # Size of the fixed part of a zip local file header.
+  zip_local_header_size = 30
+
+  def ExtractLibFromApk(self, apk, entry):
+    """Create a temporary file containing the shared library from the apk.
+
+    Libraries stored uncompressed (the usual case with extractNativeLibs=false)
+    are copied straight out of a memory mapping of the apk, anything else is
+    decompressed with zipfile.
+    """
     tmp_file = None
     try:
       tmp_fd, tmp_file = tempfile.mkstemp()
-      if subprocess.call(["unzip", "-p", apk, shared_lib_name], stdout=tmp_fd) == 0:
-        os.close(tmp_fd)
-        shared_file = tmp_file
-        tmp_file = None
-        return shared_file
+      with open(apk, "rb") as apk_file:
+        if entry.compress_type == zipfile.ZIP_STORED:
+          with mmap.mmap(apk_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = mm[entry.header_offset:entry.header_offset + self.zip_local_header_size]
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            data_start = entry.header_offset + self.zip_local_header_size + name_len + extra_len
+            with memoryview(mm) as view:
+              with view[data_start:data_start + entry.file_size] as data:
+                with open(tmp_fd, "wb", closefd=False) as f:
+                  f.write(data)
+        else:
+          with zipfile.ZipFile(apk_file) as zf:
+            with zf.open(entry) as src, open(tmp_fd, "wb", closefd=False) as f:
+              shutil.copyfileobj(src, f)
+      os.close(tmp_fd)
+      shared_file = tmp_file
+      tmp_file = None
+      return shared_file
+    except (IOError, zipfile.BadZipFile, struct.error):
+      return None
     finally:
       if tmp_file:
         os.close(tmp_fd)
         os.unlink(tmp_file)
-    return None
 
-  def ProcessCentralInfo(self, offset_list, central_info):
-    match = self.zipinfo_central_info_match.search(central_info)
-    if not match:
-      raise Exception("Cannot find all info from zipinfo\n" + central_info)
-    name = match.group(1)
-    start = int(match.group(2))
-    end = start + int(match.group(3))
+  def ReadApkIndex(self, apk):
+    """Read the central directory of an apk.
 
-    offset_list.append([name, start, end])
-    return name, start, end
+    Returns:
+      A tuple (starts, entries) of the sorted local header offsets of the
+      entries in the apk and the matching zipfile.ZipInfo objects.
+    """
+    with zipfile.ZipFile(apk) as zf:
+      # The zip file does not guarantee that the entries are in order.
+      entries = sorted(zf.infolist(), key=lambda entry: entry.header_offset)
+    return [entry.header_offset for entry in entries], entries
 
   def GetLibFromApk(self, apk, offset):
     # Convert the string to hex.
     offset = int(offset, 16)
 
-    # Check if we already have information about this offset.
-    if apk in self.apk_info:
-      apk_full_path, offset_list, tmp_files = self.apk_info[apk]
-      for file_name, start, end in offset_list:
-        if offset >= start and offset < end:
-          if file_name in tmp_files:
-            return file_name, tmp_files[file_name]
-          tmp_file = self.ExtractLibFromApk(apk_full_path, file_name)
-          if tmp_file:
-            tmp_files[file_name] = tmp_file
-            return file_name, tmp_file
-          break
-      return None, None
-
-    if not "ANDROID_PRODUCT_OUT" in os.environ:
-      print("ANDROID_PRODUCT_OUT environment variable not set.")
-      return None, None
-    out_dir = os.environ["ANDROID_PRODUCT_OUT"]
-    if not os.path.exists(out_dir):
-      print("ANDROID_PRODUCT_OUT", out_dir, "does not exist.")
-      return None, None
-    if apk.startswith("/"):
-      apk_full_path = out_dir + apk
-    else:
-      apk_full_path = os.path.join(out_dir, apk)
-    if not os.path.exists(apk_full_path):
-      print("Cannot find apk", apk)
-      return None, None
-
-    cmd = subprocess.Popen(["zipinfo", "-v", apk_full_path], stdout=subprocess.PIPE,
-                           encoding='utf8')
-    # Find the first central info marker.
-    for line in cmd.stdout:
-      if self.zipinfo_central_directory_line.search(line):
-        break
-
-    central_info = ""
-    file_name = None
-    offset_list = []
-    for line in cmd.stdout:
-      match = self.zipinfo_central_directory_line.search(line)
-      if match:
-        cur_name, start, end = self.ProcessCentralInfo(offset_list, central_info)
-        if not file_name and offset >= start and offset < end:
-          file_name = cur_name
-        central_info = ""
+    if apk not in self.apk_info:
+      if not "ANDROID_PRODUCT_OUT" in os.environ:
+        print("ANDROID_PRODUCT_OUT environment variable not set.")
+        return None, None
+      out_dir = os.environ["ANDROID_PRODUCT_OUT"]
+      if not os.path.exists(out_dir):
+        print("ANDROID_PRODUCT_OUT", out_dir, "does not exist.")
+        return None, None
+      if apk.startswith("/"):
+        apk_full_path = out_dir + apk
       else:
-        central_info += line
-    if central_info:
-      cur_name, start, end = self.ProcessCentralInfo(offset_list, central_info)
-      if not file_name and offset >= start and offset < end:
-        file_name = cur_name
-
-    # Make sure the offset_list is sorted, the zip file does not guarantee
-    # that the entries are in order.
-    offset_list = sorted(offset_list, key=lambda entry: entry[1])
-
-    # Save the information from the zip.
-    tmp_files = dict()
-    self.apk_info[apk] = [apk_full_path, offset_list, tmp_files]
-    if not file_name:
+        apk_full_path = os.path.join(out_dir, apk)
+      if not os.path.exists(apk_full_path):
+        print("Cannot find apk", apk)
+        return None, None
+
+      # Save the information from the zip.
+      try:
+        starts, entries = self.ReadApkIndex(apk_full_path)
+      except (IOError, zipfile.BadZipFile):
+        print("Cannot read apk", apk)
+        return None, None
+      self.apk_info[apk] = [apk_full_path, starts, entries, dict()]
+
+    # Find the entry whose data contains the offset.
+    apk_full_path, starts, entries, tmp_files = self.apk_info[apk]
+    index = bisect.bisect_right(starts, offset) - 1
+    if index < 0:
+      return None, None
+    entry = entries[index]
+    if offset >= entry.header_offset + entry.compress_size:
       return None, None
-    tmp_shared_lib = self.ExtractLibFromApk(apk_full_path, file_name)
-    if tmp_shared_lib:
-      tmp_files[file_name] = tmp_shared_lib
-      return file_name, tmp_shared_lib
+    file_name = entry.filename
+    if file_name in tmp_files:
+      return file_name, tmp_files[file_name]
+    tmp_file = self.ExtractLibFromApk(apk_full_path, entry)
+    if tmp_file:
+      tmp_files[file_name] = tmp_file
+      return file_name, tmp_file
     return None, None
 
   # Find all files in the symbols directory and group them by basename (without directory).
@@ -408,6 +542,69 @@ class TraceConverter:
     return lib
 
 
+  def ResolveTraceLib(self, area, so_offset, build_id):
+    """Find the library in the symbols directory for a trace line.
+
+    Returns:
+      A tuple (area, lib, lib_name) of the cleaned up map name, the path of
+      the library relative to the symbols directory (or None if it cannot be
+      found) and the name of the library inside an apk (or None). Results
+      are cached, so the frames seen by CollectAddresses() are not resolved
+      again by ProcessLine().
+    """
+    key = (area, so_offset, build_id)
+    if key in self.trace_libs:
+      return self.trace_libs[key]
+
+    # If this is an apk, it usually means that there is actually
+    # a shared so that was loaded directly out of it. In that case,
+    # extract the shared library and the name of the shared library.
+    lib = None
+    # The format of the map name:
+    #   Some.apk!libshared.so
+    # or
+    #   Some.apk
+    if so_offset:
+      # If it ends in apk, we are done.
+      apk = None
+      if area.endswith(".apk"):
+        apk = area
+      else:
+        index = area.rfind(".so!")
+        if index != -1:
+          # Sometimes we'll see something like:
+          #   #01 pc abcd  libart.so!libart.so (offset 0x134000)
+          # Remove everything after the ! and zero the offset value.
+          area = area[0:index + 3]
+          so_offset = 0
+        else:
+          index = area.rfind(".apk!")
+          if index != -1:
+            apk = area[0:index + 4]
+      if apk:
+        lib_name, lib = self.GetLibFromApk(apk, so_offset)
+    else:
+      # Sometimes we'll see something like:
+      #   #01 pc abcd  libart.so!libart.so
+      # Remove everything after the !.
+      index = area.rfind(".so!")
+      if index != -1:
+        area = area[0:index + 3]
+    if not lib:
+      lib = area
+      lib_name = None
+
+    if build_id:
+      # If we have the build_id, do a brute-force search of the symbols directory.
+      basename = os.path.basename(lib)
+      lib = self.GetLibraryByBuildId(symbol.SYMBOLS_DIR, basename, build_id)
+    else:
+      # When using atest, test paths are different between the out/ directory
+      # and device. Apply fixups.
+      lib = self.GetLibPath(lib)
+    self.trace_libs[key] = (area, lib, lib_name)
+    return area, lib, lib_name
+
   def ProcessLine(self, line):
     ret = False
     process_header = self.process_info_line.search(line)
@@ -469,55 +666,10 @@ class TraceConverter:
       if area == "<unknown>" or area == "[heap]" or area == "[stack]":
         self.trace_lines.append((code_addr, "", area))
       else:
-        # If this is an apk, it usually means that there is actually
-        # a shared so that was loaded directly out of it. In that case,
-        # extract the shared library and the name of the shared library.
-        lib = None
-        # The format of the map name:
-        #   Some.apk!libshared.so
-        # or
-        #   Some.apk
-        if so_offset:
-          # If it ends in apk, we are done.
-          apk = None
-          if area.endswith(".apk"):
-            apk = area
-          else:
-            index = area.rfind(".so!")
-            if index != -1:
-              # Sometimes we'll see something like:
-              #   #01 pc abcd  libart.so!libart.so (offset 0x134000)
-              # Remove everything after the ! and zero the offset value.
-              area = area[0:index + 3]
-              so_offset = 0
-            else:
-              index = area.rfind(".apk!")
-              if index != -1:
-                apk = area[0:index + 4]
-          if apk:
-            lib_name, lib = self.GetLibFromApk(apk, so_offset)
-        else:
-          # Sometimes we'll see something like:
-          #   #01 pc abcd  libart.so!libart.so
-          # Remove everything after the !.
-          index = area.rfind(".so!")
-          if index != -1:
-            area = area[0:index + 3]
-        if not lib:
-          lib = area
-          lib_name = None
-
-        if build_id:
-          # If we have the build_id, do a brute-force search of the symbols directory.
-          basename = os.path.basename(lib)
-          lib = self.GetLibraryByBuildId(symbol.SYMBOLS_DIR, basename, build_id)
-          if not lib:
-            print("WARNING: Cannot find {} with build id {} in symbols directory."
-                  .format(basename, build_id))
-        else:
-          # When using atest, test paths are different between the out/ directory
-          # and device. Apply fixups.
-          lib = self.GetLibPath(lib)
+        area, lib, lib_name = self.ResolveTraceLib(area, so_offset, build_id)
+        if build_id and not lib:
+          print("WARNING: Cannot find {} with build id {} in symbols directory."
+                .format(os.path.basename(area), build_id))
 
         # If a calls b which further calls c and c is inlined to b, we want to
         # display "a -> b -> c" in the stack trace instead of just "a -> c"
@@ -647,6 +799,91 @@ class LongASANStackTests(unittest.TestCase):
     self.assertGreater(trace_line_count, 10)
     tc.PrintOutput(tc.trace_lines, tc.value_lines)
 
+class CollectAddressesTests(unittest.TestCase):
+  def test_collect_addresses(self):
+    tc = TraceConverter()
+    lines = example_crashes.arm64.split('\n')
+    symbol.SetBitness(lines)
+    tc.UpdateBitnessRegexes()
+    addrs_by_lib = tc.CollectAddresses(lines)
+    trace_libs = set()
+    for line in lines:
+      trace_line_dict = tc.MatchTraceLine(line)
+      if trace_line_dict and not trace_line_dict["dso"].startswith("["):
+        self.assertIn(trace_line_dict["offset"], addrs_by_lib[trace_line_dict["dso"]])
+        trace_libs.add(trace_line_dict["dso"])
+    self.assertTrue(trace_libs)
+
+  def test_trace_libs_resolved_once(self):
+    tc = TraceConverter()
+    tc.trace_libs = dict()
+    lines = example_crashes.arm64.split('\n')
+    symbol.SetBitness(lines)
+    tc.UpdateBitnessRegexes()
+    resolved = []
+    def GetLibPath(lib):
+      resolved.append(lib)
+      return lib
+    tc.GetLibPath = GetLibPath
+    tc.CollectAddresses(lines)
+    self.assertTrue(resolved)
+    self.assertEqual(len(resolved), len(set(resolved)))
+    num_resolved = len(resolved)
+    for line in lines:
+      trace_line_dict = tc.MatchTraceLine(line)
+      if trace_line_dict and not trace_line_dict["dso"].startswith("["):
+        tc.ResolveTraceLib(trace_line_dict["dso"], trace_line_dict["so_offset"],
+                           trace_line_dict["build_id"])
+    self.assertEqual(num_resolved, len(resolved))
+
+class ReadBatchInputsTests(unittest.TestCase):
+  def test_directory_and_bugreport(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      with open(os.path.join(tmp_dir, "tombstone_00"), "w") as f:
+        f.write("#00 pc 000374e0  /system/lib/libc.so\n")
+      with zipfile.ZipFile(os.path.join(tmp_dir, "bugreport.zip"), "w") as zf:
+        zf.writestr("FS/data/tombstones/tombstone_01", "#00 pc 00012eed  /system/lib/libc.so\n")
+        zf.writestr("FS/data/tombstones/tombstone_01.pb", "binary")
+        zf.writestr("version.txt", "2.0")
+      inputs = list(ReadBatchInputs(tmp_dir))
+    self.assertEqual([os.path.relpath(name, tmp_dir) for name, _ in inputs],
+                     ["bugreport.zip!FS/data/tombstones/tombstone_01", "tombstone_00"])
+    self.assertEqual(inputs[0][1], ["#00 pc 00012eed  /system/lib/libc.so\n"])
+
+class GetLibFromApkTests(unittest.TestCase):
+  def test_get_lib_from_apk(self):
+    with tempfile.TemporaryDirectory() as out_dir:
+      apk = os.path.join(out_dir, "app.apk")
+      with zipfile.ZipFile(apk, "w") as zf:
+        zf.writestr("classes.dex", b"dex" * 1000, zipfile.ZIP_DEFLATED)
+        zf.writestr("lib/arm64-v8a/libstored.so", b"\x7fELF stored", zipfile.ZIP_STORED)
+        zf.writestr("lib/arm64-v8a/libdeflated.so", b"\x7fELF deflated" * 100,
+                    zipfile.ZIP_DEFLATED)
+      with zipfile.ZipFile(apk) as zf:
+        offsets = {info.filename: info.header_offset for info in zf.infolist()}
+
+      tc = TraceConverter()
+      tc.apk_info = dict()
+      old_product_out = os.environ.get("ANDROID_PRODUCT_OUT")
+      os.environ["ANDROID_PRODUCT_OUT"] = out_dir
+      try:
+        name, path = tc.GetLibFromApk("/app.apk", hex(offsets["lib/arm64-v8a/libstored.so"] + 4))
+        self.assertEqual(name, "lib/arm64-v8a/libstored.so")
+        with open(path, "rb") as f:
+          self.assertEqual(f.read(), b"\x7fELF stored")
+        name, path = tc.GetLibFromApk("/app.apk", hex(offsets["lib/arm64-v8a/libdeflated.so"]))
+        self.assertEqual(name, "lib/arm64-v8a/libdeflated.so")
+        with open(path, "rb") as f:
+          self.assertEqual(f.read(), b"\x7fELF deflated" * 100)
+        self.assertEqual(tc.GetLibFromApk("/app.apk", hex(os.path.getsize(apk) * 2)),
+                         (None, None))
+      finally:
+        tc.DeleteApkTmpFiles()
+        if old_product_out is None:
+          del os.environ["ANDROID_PRODUCT_OUT"]
+        else:
+          os.environ["ANDROID_PRODUCT_OUT"] = old_product_out
+
 class ValueLinesTest(unittest.TestCase):
   def test_value_line_skipped(self):
     tc = TraceConverter()
@@ -19,14 +19,25 @@
 The information can include symbol names, offsets, and source locations.
 """
 
+import array
 import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import glob
+import json
 import os
 import platform
 import re
 import shutil
 import signal
+import sqlite3
+import struct
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
 ANDROID_BUILD_TOP = os.environ.get("ANDROID_BUILD_TOP", ".")
@@ -62,6 +73,10 @@ ARCH_IS_32BIT = None
 
 VERBOSE = False
 
+# Find the functions containing addresses by looking them up in the ELF
+# symbol tables instead of disassembling with llvm-objdump.
+USE_ELF_SYMBOL_TABLE = False
+
 # These are private. Do not access them from other modules.
 _CACHED_TOOLCHAIN = None
 _CACHED_CXX_FILT = None
@@ -70,38 +85,374 @@ _CACHED_CXX_FILT = None
 _SYMBOL_INFORMATION_ADDR2LINE_CACHE = {}
 _SYMBOL_INFORMATION_OBJDUMP_CACHE = {}
 _SYMBOL_DEMANGLING_CACHE = {}
+_ELF_SYMBOL_INDEX_CACHE = {}
+
+# Optional on-disk cache shared between runs. See EnablePersistentCache().
+_PERSISTENT_CACHE = None
+
+
+# ELF parsing helpers.
+
+_ELF_MAGIC = b"\x7fELF"
+_EM_ARM = 40
+_SHT_SYMTAB = 2
+_SHT_NOTE = 7
+_SHT_DYNSYM = 11
+_SHN_UNDEF = 0
+_STT_FUNC = 2
+_NT_GNU_BUILD_ID = 3
+
+
+def ReadElfSections(f):
+  """Read the section header table of an ELF file.
+
+  Args:
+    f: file object opened in binary mode.
+
+  Returns:
+    A tuple (endian, is_64bit, machine, sections) where endian is a struct
+    byte order prefix and sections is a list of (name_offset, type, addr,
+    offset, size, link, entsize) tuples, or None if the file is not an ELF
+    file.
+  """
+  ident = f.read(16)
+  if len(ident) < 16 or ident[:4] != _ELF_MAGIC:
+    return None
+  is_64bit = ident[4] == 2
+  endian = "<" if ident[5] == 1 else ">"
+  if is_64bit:
+    header = struct.unpack(endian + "HHIQQQIHHHHHH", f.read(48))
+    shdr_format = endian + "IIQQQQIIQQ"
+  else:
+    header = struct.unpack(endian + "HHIIIIIHHHHHH", f.read(36))
+    shdr_format = endian + "IIIIIIIIII"
+  machine, shoff, shentsize, shnum = header[1], header[5], header[10], header[11]
+  sections = []
+  if shoff == 0 or shentsize < struct.calcsize(shdr_format):
+    return endian, is_64bit, machine, sections
+  f.seek(shoff)
+  table = f.read(shentsize * shnum)
+  for i in range(len(table) // shentsize):
+    (name, sh_type, _, addr, offset, size, link, _, _, entsize) = \
+        struct.unpack_from(shdr_format, table, i * shentsize)
+    sections.append((name, sh_type, addr, offset, size, link, entsize))
+  return endian, is_64bit, machine, sections
+
+
+def _GetBuildIdUncached(path):
+  try:
+    with open(path, "rb") as f:
+      elf = ReadElfSections(f)
+      if not elf:
+        return None
+      endian, _, _, sections = elf
+      for (_, sh_type, _, offset, size, _, _) in sections:
+        if sh_type != _SHT_NOTE:
+          continue
+        f.seek(offset)
+        notes = f.read(size)
+        pos = 0
+        while pos + 12 <= len(notes):
+          namesz, descsz, note_type = struct.unpack_from(endian + "III", notes, pos)
+          pos += 12
+          name = notes[pos:pos + namesz]
+          pos += (namesz + 3) & ~3
+          desc = notes[pos:pos + descsz]
+          pos += (descsz + 3) & ~3
+          if note_type == _NT_GNU_BUILD_ID and name == b"GNU\0":
+            return desc.hex()
+  except (IOError, struct.error):
+    pass
+  return None
+
+
+_BUILD_ID_CACHE = {}
+
+
+def GetBuildId(path):
+  """Return the GNU build id of an ELF file as a hex string, or None."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  key = (path, st.st_size, st.st_mtime_ns)
+  if key not in _BUILD_ID_CACHE:
+    _BUILD_ID_CACHE[key] = _GetBuildIdUncached(path)
+  return _BUILD_ID_CACHE[key]
+
+
+class ElfSymbolIndex:
+  """A sorted index of the functions in an ELF file's symbol tables.
+
+  The function symbols from .symtab and .dynsym are read once and sorted by
+  start address, so that the function containing an address can be found
+  with a binary search instead of disassembling the library.
+  """
+
+  def __init__(self, starts, sizes, names):
+    self._starts = starts
+    self._sizes = sizes
+    self._names = names
+
+  @classmethod
+  def FromFile(cls, path):
+    """Build an index for the ELF file at path.
+
+    Returns:
+      An ElfSymbolIndex, or None if the file has no function symbols.
+    """
+    functions = {}
+    with open(path, "rb") as f:
+      elf = ReadElfSections(f)
+      if not elf:
+        return None
+      endian, is_64bit, machine, sections = elf
+      # Prefer .symtab, which is a superset of .dynsym when it is present.
+      tables = sorted((s for s in sections if s[1] in (_SHT_SYMTAB, _SHT_DYNSYM)),
+                      key=lambda s: s[1] != _SHT_SYMTAB)
+      for (_, _, _, offset, size, link, entsize) in tables:
+        if link >= len(sections):
+          continue
+        f.seek(offset)
+        table = f.read(size)
+        f.seek(sections[link][3])
+        strtab = f.read(sections[link][4])
+        if is_64bit:
+          sym_format = endian + "IBBHQQ"
+        else:
+          sym_format = endian + "IIIBBH"
+        entsize = entsize or struct.calcsize(sym_format)
+        table = table[:len(table) - len(table) % entsize]
+        for entry in struct.iter_unpack(sym_format, table):
+          if is_64bit:
+            (name, info, _, shndx, value, sym_size) = entry
+          else:
+            (name, value, sym_size, info, _, shndx) = entry
+          if info & 0xf != _STT_FUNC or shndx == _SHN_UNDEF:
+            continue
+          if machine == _EM_ARM:
+            # Clear the Thumb bit.
+            value &= ~1
+          # Symbols without a size can't extend past their section.
+          if shndx < len(sections):
+            section_end = sections[shndx][2] + sections[shndx][4]
+          else:
+            section_end = value
+          # Keep the first name seen for aliases, but the largest size.
+          if value in functions:
+            old_name, old_size, _ = functions[value]
+            functions[value] = (old_name, max(old_size, sym_size), section_end)
+          else:
+            end = strtab.find(b"\0", name)
+            functions[value] = (strtab[name:end].decode("utf-8", "replace"),
+                                sym_size, section_end)
+    if not functions:
+      return None
+    starts = array.array("Q", sorted(functions))
+    sizes = array.array("Q")
+    for i, start in enumerate(starts):
+      _, size, section_end = functions[start]
+      if not size:
+        # Symbols without a size extend up to the next symbol.
+        end = starts[i + 1] if i + 1 < len(starts) else section_end
+        size = max(min(end, section_end) - start, 0)
+      sizes.append(size)
+    names = [functions[start][0] for start in starts]
+    return cls(starts, sizes, names)
+
+  def Lookup(self, addr):
+    """Find the function containing an address.
+
+    Args:
+      addr: integer address.
+
+    Returns:
+      A tuple (mangled symbol, offset), or None if no function contains addr.
+    """
+    i = bisect.bisect_right(self._starts, addr) - 1
+    if i < 0:
+      return None
+    start, size = self._starts[i], self._sizes[i]
+    if addr >= start + size:
+      return None
+    return self._names[i], addr - start
+
+
+def GetElfSymbolIndex(symbols):
+  if symbols not in _ELF_SYMBOL_INDEX_CACHE:
+    try:
+      _ELF_SYMBOL_INDEX_CACHE[symbols] = ElfSymbolIndex.FromFile(symbols)
+    except (IOError, struct.error):
+      _ELF_SYMBOL_INDEX_CACHE[symbols] = None
+  return _ELF_SYMBOL_INDEX_CACHE[symbols]
+
+
+class SymbolCache:
+  """A persistent cache of symbolization results keyed by ELF build id.
+
+  Results are stored in an SQLite database so that they can be shared
+  between runs (and between concurrent runs) of the stack tool. Since the
+  key is the build id of the library and not its path, entries stay valid
+  across different symbols directories for the same build.
+
+  The number of entries is bounded by max_entries; once the limit is
+  exceeded the least recently used entries are evicted.
+  """
+
+  # Kinds of cached results.
+  SYMBOLIZER = "symbolizer"
+  OBJDUMP = "objdump"
+
+  # Default bound on the number of cached addresses.
+  DEFAULT_MAX_ENTRIES = 2000000
+
+  def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+    self.path = path
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("PRAGMA synchronous=NORMAL")
+    self._db.execute("CREATE TABLE IF NOT EXISTS symbols ("
+                     "build_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                     "addr TEXT NOT NULL, value TEXT NOT NULL, "
+                     "atime INTEGER NOT NULL, "
+                     "PRIMARY KEY (build_id, kind, addr))")
+    self._db.execute("CREATE INDEX IF NOT EXISTS symbols_atime ON symbols (atime)")
+    self._db.commit()
+
+  def Lookup(self, build_id, kind, addrs):
+    """Return a dictionary {addr: value} for the cached subset of addrs."""
+    with self._lock:
+      return self._LookupLocked(build_id, kind, addrs)
+
+  def _LookupLocked(self, build_id, kind, addrs):
+    result = {}
+    addrs = list(addrs)
+    # Keep well below SQLite's limit on the number of host parameters.
+    for i in range(0, len(addrs), 500):
+      chunk = addrs[i:i + 500]
+      rows = self._db.execute(
+          "SELECT addr, value FROM symbols WHERE build_id = ? AND kind = ? "
+          "AND addr IN (%s)" % ",".join("?" * len(chunk)),
+          [build_id, kind] + chunk)
+      for addr, value in rows:
+        result[addr] = json.loads(value)
+    if result:
+      self._db.executemany(
+          "UPDATE symbols SET atime = ? WHERE build_id = ? AND kind = ? AND addr = ?",
+          [(int(time.time()), build_id, kind, addr) for addr in result])
+      self._db.commit()
+    self.hits += len(result)
+    self.misses += len(addrs) - len(result)
+    return result
+
+  def Store(self, build_id, kind, values):
+    """Store a dictionary {addr: value} of results for the given build id."""
+    if not values:
+      return
+    now = int(time.time())
+    with self._lock:
+      self._db.executemany(
+          "INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?, ?)",
+          [(build_id, kind, addr, json.dumps(value), now)
+           for addr, value in values.items()])
+      self._Evict()
+      self._db.commit()
+
+  def _Evict(self):
+    (count,) = self._db.execute("SELECT COUNT(*) FROM symbols").fetchone()
+    if count <= self.max_entries:
+      return
+    # Evict down to 90% of the limit so that we don't have to evict again
+    # on every subsequent store.
+    excess = count - self.max_entries * 9 // 10
+    self._db.execute(
+        "DELETE FROM symbols WHERE rowid IN "
+        "(SELECT rowid FROM symbols ORDER BY atime LIMIT ?)", (excess,))
+
+  def Close(self):
+    with self._lock:
+      self._db.close()
+
+
+def EnablePersistentCache(path, max_entries=SymbolCache.DEFAULT_MAX_ENTRIES):
+  """Use an on-disk cache at path for symbolization results."""
+  global _PERSISTENT_CACHE
+  _PERSISTENT_CACHE = SymbolCache(path, max_entries)
+  return _PERSISTENT_CACHE
+
+
+def _PersistentCacheLookup(symbols, kind, addrs):
+  """Look up addrs in the persistent cache, if enabled.
+
+  Returns:
+    A tuple (build_id, cached) where build_id is None if the persistent
+    cache cannot be used for this library.
+  """
+  if not _PERSISTENT_CACHE:
+    return None, {}
+  build_id = GetBuildId(symbols)
+  if not build_id:
+    return None, {}
+  return build_id, _PERSISTENT_CACHE.Lookup(build_id, kind, addrs)
 
 # Caches for pipes to subprocesses.
 
 class ProcessCache:
-  _cmd2pipe = {}
-  _lru = []
+  """A thread-safe LRU cache of long-running tool processes.
+
+  Processes are checked out with Process(), which gives the calling thread
+  exclusive use of the process until the with block exits. Processes that
+  are in use are never evicted.
+  """
 
   # Max number of open pipes.
   _PIPE_MAX_OPEN = 10
 
-  def GetProcess(self, cmd):
+  class _Entry:
+    def __init__(self, pipe):
+      self.pipe = pipe
+      self.users = 0
+      self.lock = threading.Lock()
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Maps command tuples to entries, least recently used first.
+    self._cmd2pipe = collections.OrderedDict()
+
+  @contextlib.contextmanager
+  def Process(self, cmd):
     cmd_tuple = tuple(cmd)  # Need to use a tuple as lists can't be dict keys.
-    # Pipe already available?
-    if cmd_tuple in self._cmd2pipe:
-      pipe = self._cmd2pipe[cmd_tuple]
-      # Update LRU.
-      self._lru = [(cmd_tuple, pipe)] + [i for i in self._lru if i[0] != cmd_tuple]
-      return pipe
-
-    # Not cached, yet. Open a new one.
-
-    # Check if too many are open, close the old ones.
-    while len(self._lru) >= self._PIPE_MAX_OPEN:
-      open_cmd, open_pipe = self._lru.pop()
-      del self._cmd2pipe[open_cmd]
-      self.TerminateProcess(open_pipe)
-
-    # Create and put into cache.
-    pipe = self.SpawnProcess(cmd)
-    self._cmd2pipe[cmd_tuple] = pipe
-    self._lru = [(cmd_tuple, pipe)] + self._lru
-    return pipe
+    with self._lock:
+      entry = self._cmd2pipe.get(cmd_tuple)
+      if entry:
+        # Update LRU.
+        self._cmd2pipe.move_to_end(cmd_tuple)
+      else:
+        # Not cached, yet. Check if too many are open, close the old ones.
+        self._EvictLocked()
+        # Create and put into cache.
+        entry = self._Entry(self.SpawnProcess(cmd))
+        self._cmd2pipe[cmd_tuple] = entry
+      entry.users += 1
+    try:
+      with entry.lock:
+        yield entry.pipe
+    finally:
+      with self._lock:
+        entry.users -= 1
+
+  def _EvictLocked(self):
+    for open_cmd in list(self._cmd2pipe):
+      if len(self._cmd2pipe) < self._PIPE_MAX_OPEN:
+        break
+      open_entry = self._cmd2pipe[open_cmd]
+      if open_entry.users == 0:
+        del self._cmd2pipe[open_cmd]
+        self.TerminateProcess(open_entry.pipe)
 
   def SpawnProcess(self, cmd):
      return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
@@ -113,10 +464,10 @@ class ProcessCache:
     pipe.wait()
 
   def KillAllProcesses(self):
-    for _, open_pipe in self._lru:
-      self.TerminateProcess(open_pipe)
-    _cmd2pipe = {}
-    _lru = []
+    with self._lock:
+      for open_entry in self._cmd2pipe.values():
+        self.TerminateProcess(open_entry.pipe)
+      self._cmd2pipe.clear()
 
 
 _PIPE_ADDR2LINE_CACHE = ProcessCache()
@@ -240,6 +591,26 @@ def SymbolInformationForSet(lib, unique_addrs):
   return result
 
 
+def SymbolInformationForLibs(addrs_by_lib, jobs=None):
+  """Look up symbol information for addresses in many libraries in parallel.
+
+  Each library is symbolized by one worker thread, which owns the tool
+  processes for that library while it works on it.
+
+  Args:
+    addrs_by_lib: dictionary of the form {lib: set of hexidecimal addresses}
+    jobs: number of worker threads, defaults to the number of CPUs.
+
+  Returns:
+    A dictionary of the form {lib: result} where result is what
+    SymbolInformationForSet() returns for the library.
+  """
+  libs = sorted(lib for lib in addrs_by_lib if lib)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+    results = executor.map(lambda lib: SymbolInformationForSet(lib, addrs_by_lib[lib]), libs)
+    return dict(zip(libs, results))
+
+
 def CallLlvmSymbolizerForSet(lib, unique_addrs):
   """Look up line and symbol information for a set of addresses.
 
@@ -291,37 +662,100 @@ def CallLlvmSymbolizerForSet(lib, unique_addrs):
   if os.path.isdir(symbols):
     return None
 
+  build_id, cached = _PersistentCacheLookup(symbols, SymbolCache.SYMBOLIZER, addrs)
+  for addr, records in cached.items():
+    records = [tuple(record) for record in records]
+    result[addr] = records
+    addr_cache[addr] = records
+  addrs = [addr for addr in addrs if addr not in cached]
+  if not addrs:
+    return result
+
   cmd = [ToolPath("llvm-symbolizer"), "--functions", "--inlines",
-      "--demangle", "--obj=" + symbols, "--output-style=GNU"]
-  child = _PIPE_ADDR2LINE_CACHE.GetProcess(cmd)
+      "--demangle", "--obj=" + symbols, "--output-style=JSON"]
+  new_records = {}
+  try:
+    with _PIPE_ADDR2LINE_CACHE.Process(cmd) as child:
+      new_records = SymbolizeBatch(child, addrs)
+  except (IOError, ValueError) as e:
+    # Remove the / in front of the library name to match other output.
+    error_records = [(None, lib[1:] + "  ***Error: " + str(e))]
+    for addr in addrs:
+      result[addr] = error_records
+      addr_cache[addr] = error_records
+  for addr, records in new_records.items():
+    result[addr] = records
+    addr_cache[addr] = records
+  if build_id:
+    _PERSISTENT_CACHE.Store(build_id, SymbolCache.SYMBOLIZER, new_records)
+  return result
+
+
+def SymbolizeBatch(child, addrs):
+  """Symbolize a batch of addresses with a single pipe round trip.
+
+  All the addresses are written to the llvm-symbolizer process at once while
+  a reader thread collects the responses. With --output-style=JSON each
+  address produces exactly one line of output, inlined frames included, so
+  the responses can be matched to the requests by their order.
+
+  Args:
+    child: a llvm-symbolizer process started with --output-style=JSON.
+    addrs: list of string hexidecimal addresses.
+
+  Returns:
+    A dictionary of the form {addr: [(symbol, file:line)]}.
+  """
+  responses = []
+  reader_error = []
 
-  for addr in addrs:
+  def ReadResponses():
     try:
-      child.stdin.write("0x%s\n" % addr)
-      child.stdin.flush()
-      records = []
-      first = True
-      while True:
-        symbol = child.stdout.readline().strip()
-        if not symbol:
-          break
-        location = child.stdout.readline().strip()
-        records.append((symbol, location))
-        if first:
-          # Write a blank line as a sentinel so we know when to stop
-          # reading inlines from the output.
-          # The blank line will cause llvm-symbolizer to emit a blank line.
-          child.stdin.write("\n")
-          child.stdin.flush()
-          first = False
+      for _ in addrs:
+        line = child.stdout.readline()
+        if not line:
+          raise IOError("llvm-symbolizer exited unexpectedly")
+        responses.append(line)
     except IOError as e:
-      # Remove the / in front of the library name to match other output.
-      records = [(None, lib[1:] + "  ***Error: " + str(e))]
-    result[addr] = records
-    addr_cache[addr] = records
+      reader_error.append(e)
+
+  reader = threading.Thread(target=ReadResponses, daemon=True)
+  reader.start()
+  try:
+    child.stdin.write("".join("0x%s\n" % addr for addr in addrs))
+    child.stdin.flush()
+  finally:
+    reader.join()
+  if reader_error:
+    raise reader_error[0]
+
+  result = {}
+  for addr, line in zip(addrs, responses):
+    response = json.loads(line)
+    if int(response.get("Address", "0x%s" % addr), 16) != int(addr, 16):
+      raise ValueError("llvm-symbolizer response out of order for 0x%s" % addr)
+    result[addr] = ParseSymbolizerJson(response)
   return result
 
 
+def ParseSymbolizerJson(response):
+  """Convert one llvm-symbolizer JSON response to (symbol, file:line) records.
+
+  The records are formatted the same way as --output-style=GNU would print
+  them, with the most deeply nested inlined frame first.
+  """
+  if "Error" in response:
+    raise ValueError(response["Error"].get("Message", "unknown error"))
+  records = []
+  for frame in response.get("Symbol", []):
+    symbol = frame.get("FunctionName") or "??"
+    location = "%s:%d" % (frame.get("FileName") or "??", frame.get("Line", 0))
+    if frame.get("Discriminator"):
+      location += " (discriminator %d)" % frame["Discriminator"]
+    records.append((symbol, location))
+  return records
+
+
 def CallObjdumpForSet(lib, unique_addrs):
   """Use objdump to find out the names of the containing functions.
 
@@ -364,6 +798,30 @@ def CallObjdumpForSet(lib, unique_addrs):
     if not os.path.exists(symbols):
       return None
 
+  build_id, cached = _PersistentCacheLookup(symbols, SymbolCache.OBJDUMP, addrs)
+  for addr, (object_symbol, object_offset) in cached.items():
+    result[addr] = (object_symbol, object_offset)
+    addr_cache[addr] = result[addr]
+  addrs = [addr for addr in addrs if addr not in cached]
+  if not addrs:
+    return result
+
+  new_entries = {}
+  index = GetElfSymbolIndex(symbols) if USE_ELF_SYMBOL_TABLE else None
+  if index:
+    for addr in addrs:
+      match = index.Lookup(int(addr, 16))
+      if match:
+        name, offset = match
+        if name.startswith("_Z"):
+          name = CallCppFilt(name)
+        result[addr] = (name, offset)
+        addr_cache[addr] = result[addr]
+        new_entries[addr] = result[addr]
+    if build_id:
+      _PERSISTENT_CACHE.Store(build_id, SymbolCache.OBJDUMP, new_entries)
+    return result
+
   start_addr_dec = str(int(addrs[0], 16))
   stop_addr_dec = str(int(addrs[-1], 16) + 8)
   cmd = [ToolPath("llvm-objdump"),
@@ -418,11 +876,14 @@ def CallObjdumpForSet(lib, unique_addrs):
       if i_addr == i_target:
         result[target_addr] = (current_symbol, i_target - current_symbol_addr)
         addr_cache[target_addr] = result[target_addr]
+        new_entries[target_addr] = result[target_addr]
         addr_index += 1
         if addr_index >= len(addrs):
           break
   stream.close()
 
+  if build_id:
+    _PERSISTENT_CACHE.Store(build_id, SymbolCache.OBJDUMP, new_entries)
   return result
 
 
@@ -451,12 +912,12 @@ def CallCppFilt(mangled_symbol):
     _CACHED_CXX_FILT = sorted(toolchains)[-1]
 
   cmd = [_CACHED_CXX_FILT]
-  process = _PIPE_CPPFILT_CACHE.GetProcess(cmd)
-  process.stdin.write(mangled_symbol)
-  process.stdin.write("\n")
-  process.stdin.flush()
+  with _PIPE_CPPFILT_CACHE.Process(cmd) as process:
+    process.stdin.write(mangled_symbol)
+    process.stdin.write("\n")
+    process.stdin.flush()
 
-  demangled_symbol = process.stdout.readline().strip()
+    demangled_symbol = process.stdout.readline().strip()
 
   _SYMBOL_DEMANGLING_CACHE[mangled_symbol] = demangled_symbol
 
@@ -528,6 +989,180 @@ def SetBitness(lines):
         # case, but if we couldn't figure anything else out, go with 32 bit.
         ARCH_IS_32BIT = True
 
+def _MakeElf64(sections):
+  """Build a minimal little-endian ELF64 image for tests.
+
+  Args:
+    sections: list of (type, data, addr, link, entsize) tuples.
+  """
+  body = b""
+  headers = [struct.pack("<IIQQQQIIQQ", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+  for (sh_type, data, addr, link, entsize) in sections:
+    offset = 64 + len(body)
+    body += data
+    headers.append(struct.pack("<IIQQQQIIQQ", 0, sh_type, 0, addr, offset,
+                               len(data), link, 0, 1, entsize))
+  shoff = 64 + len(body)
+  ident = _ELF_MAGIC + bytes([2, 1, 1]) + bytes(9)
+  header = struct.pack("<HHIQQQIHHHHHH", 3, 183, 1, 0, 0, shoff, 0, 64, 0, 0,
+                       64, len(headers), 0)
+  return ident + header + body + b"".join(headers)
+
+
+def _MakeBuildIdNote(build_id):
+  desc = bytes.fromhex(build_id)
+  return struct.pack("<III", 4, len(desc), _NT_GNU_BUILD_ID) + b"GNU\0" + desc
+
+
+class GetBuildIdTests(unittest.TestCase):
+  def test_build_id(self):
+    with tempfile.NamedTemporaryFile(suffix=".so") as f:
+      f.write(_MakeElf64([(_SHT_NOTE, _MakeBuildIdNote("0123456789abcdef"), 0, 0, 0)]))
+      f.flush()
+      self.assertEqual(GetBuildId(f.name), "0123456789abcdef")
+
+  def test_not_elf(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(b"not an elf file")
+      f.flush()
+      self.assertIsNone(GetBuildId(f.name))
+
+  def test_missing(self):
+    self.assertIsNone(GetBuildId("/does/not/exist.so"))
+
+def _MakeSymtab(symbols, shndx=1):
+  """Build .symtab and .strtab contents from (name, value, size) tuples."""
+  strtab = b"\0"
+  symtab = struct.pack("<IBBHQQ", 0, 0, 0, 0, 0, 0)
+  for (name, value, size) in symbols:
+    symtab += struct.pack("<IBBHQQ", len(strtab), _STT_FUNC, 0, shndx, value, size)
+    strtab += name.encode() + b"\0"
+  return symtab, strtab
+
+class ElfSymbolIndexTests(unittest.TestCase):
+  def test_lookup(self):
+    symtab, strtab = _MakeSymtab([("main", 0x1000, 0x10),
+                                  ("foo", 0x1020, 0x20),
+                                  ("foo_alias", 0x1020, 0),
+                                  ("nosize", 0x1100, 0)])
+    with tempfile.NamedTemporaryFile(suffix=".so") as f:
+      # The .text section spans 0x1000-0x1200.
+      f.write(_MakeElf64([(1, bytes(0x200), 0x1000, 0, 0),
+                          (_SHT_SYMTAB, symtab, 0, 3, 24), (3, strtab, 0, 0, 0)]))
+      f.flush()
+      index = ElfSymbolIndex.FromFile(f.name)
+    self.assertEqual(index.Lookup(0x1000), ("main", 0))
+    self.assertEqual(index.Lookup(0x100c), ("main", 12))
+    self.assertIsNone(index.Lookup(0x1010))
+    self.assertEqual(index.Lookup(0x103f), ("foo", 0x1f))
+    self.assertIsNone(index.Lookup(0x1040))
+    self.assertEqual(index.Lookup(0x11ff), ("nosize", 0xff))
+    # The last symbol has no size, but still ends with its section.
+    self.assertIsNone(index.Lookup(0x1200))
+    self.assertIsNone(index.Lookup(0x10))
+
+  def test_no_symbols(self):
+    with tempfile.NamedTemporaryFile(suffix=".so") as f:
+      f.write(_MakeElf64([]))
+      f.flush()
+      self.assertIsNone(ElfSymbolIndex.FromFile(f.name))
+
+class ProcessCacheTests(unittest.TestCase):
+  class FakeProcessCache(ProcessCache):
+    _PIPE_MAX_OPEN = 2
+
+    def __init__(self):
+      super().__init__()
+      self.terminated = []
+
+    def SpawnProcess(self, cmd):
+      return cmd[0]
+
+    def TerminateProcess(self, pipe):
+      self.terminated.append(pipe)
+
+  def test_lru(self):
+    cache = self.FakeProcessCache()
+    for cmd in ("a", "b", "a", "c"):
+      with cache.Process([cmd]) as process:
+        self.assertEqual(process, cmd)
+    self.assertEqual(cache.terminated, ["b"])
+
+  def test_in_use_not_evicted(self):
+    cache = self.FakeProcessCache()
+    with cache.Process(["a"]):
+      with cache.Process(["b"]):
+        with cache.Process(["c"]):
+          pass
+    self.assertEqual(cache.terminated, [])
+    with cache.Process(["d"]):
+      pass
+    self.assertEqual(cache.terminated, ["a", "b"])
+
+class ParseSymbolizerJsonTests(unittest.TestCase):
+  def test_inlined(self):
+    response = json.loads(
+        '{"Address":"0x1040","ModuleName":"/system/lib64/libc.so","Symbol":['
+        '{"Column":69,"Discriminator":0,"FileName":"bionic/libc/foo.cpp",'
+        '"FunctionName":"g","Line":1,"StartAddress":"0x1040",'
+        '"StartFileName":"bionic/libc/foo.cpp","StartLine":1},'
+        '{"Column":34,"Discriminator":2,"FileName":"bionic/libc/foo.cpp",'
+        '"FunctionName":"main","Line":12,"StartAddress":"0x1040",'
+        '"StartFileName":"bionic/libc/foo.cpp","StartLine":10}]}')
+    self.assertEqual(ParseSymbolizerJson(response),
+                     [("g", "bionic/libc/foo.cpp:1"),
+                      ("main", "bionic/libc/foo.cpp:12 (discriminator 2)")])
+
+  def test_unknown(self):
+    response = json.loads(
+        '{"Address":"0x5","ModuleName":"/system/lib64/libc.so","Symbol":['
+        '{"Column":0,"Discriminator":0,"FileName":"","FunctionName":"",'
+        '"Line":0,"StartAddress":"","StartFileName":"","StartLine":0}]}')
+    self.assertEqual(ParseSymbolizerJson(response), [("??", "??:0")])
+
+  def test_error(self):
+    response = json.loads('{"Address":"0x5","Error":{"Message":"No such file"},'
+                          '"ModuleName":"/system/lib64/libc.so"}')
+    self.assertRaises(ValueError, ParseSymbolizerJson, response)
+
+class SymbolCacheTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp_dir.name, "symbols.db")
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_lookup_and_store(self):
+    cache = SymbolCache(self.path)
+    self.assertEqual(cache.Lookup("abcd", SymbolCache.OBJDUMP, ["1000"]), {})
+    cache.Store("abcd", SymbolCache.OBJDUMP, {"1000": ("foo", 4)})
+    self.assertEqual(cache.Lookup("abcd", SymbolCache.OBJDUMP, ["1000", "2000"]),
+                     {"1000": ["foo", 4]})
+    # Different build ids and kinds don't share entries.
+    self.assertEqual(cache.Lookup("ef01", SymbolCache.OBJDUMP, ["1000"]), {})
+    self.assertEqual(cache.Lookup("abcd", SymbolCache.SYMBOLIZER, ["1000"]), {})
+    self.assertEqual(cache.hits, 1)
+    self.assertEqual(cache.misses, 4)
+    cache.Close()
+
+  def test_persists(self):
+    cache = SymbolCache(self.path)
+    cache.Store("abcd", SymbolCache.SYMBOLIZER, {"1000": [("foo", "foo.cpp:1")]})
+    cache.Close()
+    cache = SymbolCache(self.path)
+    self.assertEqual(cache.Lookup("abcd", SymbolCache.SYMBOLIZER, ["1000"]),
+                     {"1000": [["foo", "foo.cpp:1"]]})
+    cache.Close()
+
+  def test_eviction(self):
+    cache = SymbolCache(self.path, max_entries=10)
+    cache.Store("abcd", SymbolCache.OBJDUMP,
+                {"%x" % addr: ("foo", addr) for addr in range(20)})
+    (count,) = cache._db.execute("SELECT COUNT(*) FROM symbols").fetchone()
+    self.assertLessEqual(count, 10)
+    cache.Close()
+
 class FindClangDirTests(unittest.TestCase):
   @unittest.skipIf(ANDROID_BUILD_TOP == '.', 'Test only supported in an Android tree.')
   def test_clang_dir_found(self):
@@ -2,6 +2,7 @@
 
 import argparse
 import datetime
+import heapq
 import re
 import subprocess
 import sys
@@ -11,30 +12,69 @@ import ps
 
 DURATION_RE = re.compile("((\\d+)w)?((\\d+)d)?((\\d+)h)?((\\d+)m)?((\\d+)s)?")
 
+# The number of distinct log texts tracked, which bounds the memory used for long captures.
+DEFAULT_MAX_TEXTS = 10000
+
+# The number of results printed for each table.
+TOP_COUNT = 11
+
 class Bucket(object):
-  """Bucket of stats for a particular key managed by the Stats object."""
-  def __init__(self):
+  """Bucket of stats for a particular key managed by the Stats object.
+
+  Only the first line with the key is kept, as an example of the lines. In a Stats object with a
+  capacity, error is how much count or memory may have been inherited from evicted keys."""
+  def __init__(self, line=None):
     self.count = 0
     self.memory = 0
-    self.lines = []
+    self.line = line
+    self.error = 0
 
   def __str__(self):
     return "(%s,%s)" % (self.count, self.memory)
 
 
 class Stats(object):
-  """A group of stats with a particular key, where both memory and count are tracked."""
-  def __init__(self):
+  """A group of stats with a particular key, where both memory and count are tracked.
+
+  The memory used grows with the number of keys. If a capacity is given, at most that many keys
+  are tracked with the space-saving algorithm: a new key replaces the key with the smallest
+  weight, which is count or memory, and inherits its count and memory. The heaviest keys are
+  then reported with an overestimate of at most the smallest weight."""
+  def __init__(self, capacity=None, weight="count"):
     self._data = dict()
+    self._capacity = capacity
+    self._weight = weight
+    # One (weight, key) entry per key, for finding the key to evict. Weights only grow, so an
+    # entry which is out of date is smaller than the current weight and gets updated when it
+    # reaches the top.
+    self._heap = []
 
   def add(self, key, logLine):
     bucket = self._data.get(key)
     if not bucket:
-      bucket = Bucket()
+      bucket = Bucket(logLine)
+      if self._capacity and len(self._data) >= self._capacity:
+        evicted = self._evict()
+        bucket.count = evicted.count
+        bucket.memory = evicted.memory
+        bucket.error = getattr(evicted, self._weight)
       self._data[key] = bucket
+      if self._capacity:
+        heapq.heappush(self._heap, (getattr(bucket, self._weight), key))
     bucket.count += 1
     bucket.memory += logLine.memory()
-    bucket.lines.append(logLine)
+
+  def _evict(self):
+    """Remove the key with the smallest weight and return its bucket."""
+    while True:
+      weight, key = self._heap[0]
+      bucket = self._data[key]
+      current = getattr(bucket, self._weight)
+      if current == weight:
+        heapq.heappop(self._heap)
+        del self._data[key]
+        return bucket
+      heapq.heapreplace(self._heap, (current, key))
 
   def __iter__(self):
     return self._data.iteritems()
@@ -52,6 +92,12 @@ class Stats(object):
     result.sort(lambda a, b: -cmp(a[1].memory, b[1].memory))
     return result
 
+  def topByCount(self, n):
+    return heapq.nlargest(n, self._data.iteritems(), key=lambda item: item[1].count)
+
+  def topByMemory(self, n):
+    return heapq.nlargest(n, self._data.iteritems(), key=lambda item: item[1].memory)
+
 
 def ParseDuration(s):
   """Parse a date of the format .w.d.h.m.s into the number of seconds."""
@@ -115,6 +161,20 @@ def WriteResult(totalCount, totalMemory, bucket, text):
       FormatMemory(bucket.memory), (100 * bucket.memory / totalMemory), text)
   
 
+def FormatDuplicate(bucket, weight):
+  """Describe the line of a bucket of duplicates. If the bucket inherited some of its count or
+  memory, which is its weight, from evicted lines, the bound on the overestimate is added."""
+  logLine = bucket.line
+  text = "%s/%s: %s" % (logLine.level, logLine.tag, logLine.text)
+  if bucket.error:
+    if weight == "memory":
+      error = FormatMemory(bucket.error).strip()
+    else:
+      error = "%d" % bucket.error
+    text += "  (%s may be up to %s too high)" % (weight, error)
+  return text
+
+
 def ParseArgs(argv):
   parser = argparse.ArgumentParser(description="Process some integers.")
   parser.add_argument("input", type=str, nargs="?",
@@ -125,6 +185,9 @@ def ParseArgs(argv):
                       help="how long to run for (XdXhXmXs)")
   parser.add_argument("--rawlogs", type=str, nargs=1,
                       help="file to put the rawlogs into")
+  parser.add_argument("--max-texts", type=int, default=DEFAULT_MAX_TEXTS,
+                      help="how many distinct log texts to track for the duplicates (default %d)"
+                      % DEFAULT_MAX_TEXTS)
 
   args = parser.parse_args()
 
@@ -171,11 +234,13 @@ def main(argv):
   totalMemory = 0
   byTag = Stats()
   byPid = Stats()
-  byText = Stats()
+  # Texts with numbers in them are mostly unique, so only the heaviest ones are tracked.
+  byText = Stats(args.max_texts, "count")
+  byTextMemory = Stats(args.max_texts, "memory")
 
   startTime = datetime.datetime.now()
 
-  # Read the log lines from the parser and build a big mapping of everything
+  # Read the log lines from the parser and count them, without keeping them
   for logLine in logs.ParseLogcat(infile, processes, args.durationSec):
     if rawlogs:
       rawlogs.write("%-10s %s %-6s %-6s %-6s %s/%s: %s\n" %(logLine.buf, logLine.timestamp,
@@ -186,6 +251,7 @@ def main(argv):
     byTag.add(logLine.tag, logLine)
     byPid.add(logLine.pid, logLine)
     byText.add(logLine.text, logLine)
+    byTextMemory.add(logLine.text, logLine)
 
   endTime = datetime.datetime.now()
 
@@ -197,57 +263,33 @@ def main(argv):
 
   print "Top tags by count"
   print "-----------------"
-  i = 0
-  for k,v in byTag.byCount():
+  for k,v in byTag.topByCount(TOP_COUNT):
     WriteResult(totalCount, totalMemory, v, k)
-    if i >= 10:
-      break
-    i += 1
 
   print
   print "Top tags by memory"
   print "------------------"
-  i = 0
-  for k,v in byTag.byMemory():
+  for k,v in byTag.topByMemory(TOP_COUNT):
     WriteResult(totalCount, totalMemory, v, k)
-    if i >= 10:
-      break
-    i += 1
 
   print
   print "Top Processes by memory"
   print "-----------------------"
-  i = 0
-  for k,v in byPid.byMemory():
+  for k,v in byPid.topByMemory(TOP_COUNT):
     WriteResult(totalCount, totalMemory, v,
         "%-8s %s" % (k, processes.FindPid(k).DisplayName()))
-    if i >= 10:
-      break
-    i += 1
 
   print
   print "Top Duplicates by count"
   print "-----------------------"
-  i = 0
-  for k,v in byText.byCount():
-    logLine = v.lines[0]
-    WriteResult(totalCount, totalMemory, v,
-        "%s/%s: %s" % (logLine.level, logLine.tag, logLine.text))
-    if i >= 10:
-      break
-    i += 1
+  for k,v in byText.topByCount(TOP_COUNT):
+    WriteResult(totalCount, totalMemory, v, FormatDuplicate(v, "count"))
 
   print
   print "Top Duplicates by memory"
   print "-----------------------"
-  i = 0
-  for k,v in byText.byCount():
-    logLine = v.lines[0]
-    WriteResult(totalCount, totalMemory, v,
-        "%s/%s: %s" % (logLine.level, logLine.tag, logLine.text))
-    if i >= 10:
-      break
-    i += 1
+  for k,v in byTextMemory.topByMemory(TOP_COUNT):
+    WriteResult(totalCount, totalMemory, v, FormatDuplicate(v, "memory"))
 
   print
   print "Totals"
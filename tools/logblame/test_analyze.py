@@ -1,6 +1,7 @@
 #!/usr/bin/env python2.7 -B
 
 import analyze_logs
+import logs
 
 
 def test_ParseDuration(s, expected):
@@ -8,6 +9,38 @@ def test_ParseDuration(s, expected):
   if actual != expected:
     raise Exception("expected %s, actual %s" % (expected, actual))
 
+def test_Stats_capacity():
+  """The heaviest keys survive a stream of many more distinct keys than the capacity."""
+  stats = analyze_logs.Stats(10)
+  for i in range(1000):
+    stats.add("frequent", logs.LogLine(tag="tag", text="frequent"))
+    stats.add(i, logs.LogLine(tag="tag", text="unique %d" % i))
+    if i % 2:
+      stats.add("half", logs.LogLine(tag="tag", text="half"))
+  if len(stats.data()) != 10:
+    raise Exception("expected 10 keys, actual %d" % len(stats.data()))
+  top = [key for key, bucket in stats.topByCount(2)]
+  if top != ["frequent", "half"]:
+    raise Exception("expected frequent and half, actual %s" % top)
+  bucket = dict(stats.data())["frequent"]
+  if bucket.count != 1000 or bucket.error != 0 or bucket.line.text != "frequent":
+    raise Exception("expected an exact count, actual %s" % bucket)
+
+def test_FormatDuplicate():
+  """The overestimate bound is printed only for lines which inherited count or memory."""
+  stats = analyze_logs.Stats(2)
+  stats.add("a", logs.LogLine(level="I", tag="tag", text="a"))
+  stats.add("a", logs.LogLine(level="I", tag="tag", text="a"))
+  stats.add("b", logs.LogLine(level="I", tag="tag", text="b"))
+  stats.add("c", logs.LogLine(level="I", tag="tag", text="c"))
+  buckets = dict(stats.data())
+  actual = analyze_logs.FormatDuplicate(buckets["a"], "count")
+  if actual != "I/tag: a":
+    raise Exception("expected no bound, actual %s" % actual)
+  actual = analyze_logs.FormatDuplicate(buckets["c"], "count")
+  if actual != "I/tag: c  (count may be up to 1 too high)":
+    raise Exception("expected a bound of 1, actual %s" % actual)
+
 def main():
   test_ParseDuration("1w", 604800)
   test_ParseDuration("1d", 86400)
@@ -15,6 +48,8 @@ def main():
   test_ParseDuration("1m", 60)
   test_ParseDuration("1s", 1)
   test_ParseDuration("1w1d1h1m1s", 694861)
+  test_Stats_capacity()
+  test_FormatDuplicate()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,43 @@
+import codecs
 import subprocess
 import os
 import pipes
 import threading
 from dataclasses import dataclass, asdict, field
+import json
 import logging
 import sqlite3
 import time
 
+# The resources one ota_from_target_files run needs at its peak. They size
+# the default worker pool, see default_max_workers().
+CPUS_PER_JOB = 4
+MEMORY_PER_JOB = 8 * 1024 ** 3
+
+JOB_COLUMNS = 'ID, TargetPath, IncrementalPath, Verbose, Partial, OutputPath, ' \
+    'Status, Downgrade, OtherFlags, STDOUT, STDERR, StartTime, FinishTime, ' \
+    'Priority, QueueTime'
+
+
+def read_log(path, offset=0, limit=None):
+    """
+    Read the text of a log file from byte <offset> on, at most <limit> bytes.
+    Args:
+        path: string
+        offset: int
+        limit: int, or None to read to the end of the file
+    Return:
+        (text, offset), the offset being where the next read should start.
+        A character which is only partly written yet is left for that read.
+    """
+    with open(path, 'rb') as log:
+        log.seek(offset)
+        data = log.read(-1 if limit is None else limit)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    text = decoder.decode(data)
+    pending, _ = decoder.getstate()
+    return text, offset + len(data) - len(pending)
+
 
 @dataclass
 class JobInfo:
@@ -26,6 +57,8 @@ class JobInfo:
     stderr: str = ''
     start_time: int = 0
     finish_time: int = 0
+    priority: int = 0
+    queue_time: int = 0
     isPartial: bool = False
     isIncremental: bool = False
 
@@ -52,7 +85,8 @@ class JobInfo:
             id: string, target: string, incremental: string, verbose: int,
             partial: string, output:string, status:string,
             downgrade: bool, extra: string, stdout: string, stderr:string,
-            start_time:int, finish_time: int(not required)
+            start_time:int, finish_time: int(not required),
+            priority: int, queue_time: int
         """
         sql_form_dict = asdict(self)
         sql_form_dict['partial'] = ','.join(sql_form_dict['partial'])
@@ -72,20 +106,25 @@ class JobInfo:
             basic_info['incremental_name'] = self.incremental.split('/')[-1]
         return basic_info
 
-    def to_dict_detail(self, target_lib, offset=0):
+    def to_dict_detail(self, target_lib, offset=0, stderr_offset=0, limit=None):
         """
         Convert this instance into a dict, which includes some detailed information
         of the target/source build, i.e. build version and file name.
+        Only the logs from byte <offset> of stdout and byte <stderr_offset> of
+        stderr on are read, at most <limit> bytes of each. stdout_offset and
+        stderr_offset in the dict are where the next read should start.
         """
         detail_info = asdict(self)
         try:
-            with open(self.stdout, 'r') as fout:
-                detail_info['stdout'] = fout.read()
-            with open(self.stderr, 'r') as ferr:
-                detail_info['stderr'] = ferr.read()
+            detail_info['stdout'], detail_info['stdout_offset'] = read_log(
+                self.stdout, offset, limit)
+            detail_info['stderr'], detail_info['stderr_offset'] = read_log(
+                self.stderr, stderr_offset, limit)
         except FileNotFoundError:
             detail_info['stdout'] = 'NO STD OUTPUT IS FOUND'
             detail_info['stderr'] = 'NO STD ERROR IS FOUND'
+            detail_info['stdout_offset'] = offset
+            detail_info['stderr_offset'] = stderr_offset
         target_info = target_lib.get_build_by_path(self.target)
         detail_info['target_name'] = target_info.file_name
         detail_info['target_build_version'] = target_info.build_version
@@ -101,9 +140,26 @@ class DependencyError(Exception):
     pass
 
 
+def default_max_workers():
+    """
+    Return the number of OTA jobs this machine can run at the same time,
+    limited by both the number of CPUs and the physical memory.
+    """
+    workers = (os.cpu_count() or 1) // CPUS_PER_JOB
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        workers = min(workers, memory // MEMORY_PER_JOB)
+    except (AttributeError, ValueError, OSError):
+        pass
+    return max(1, workers)
+
+
 class ProcessesManagement:
     """
     A class manage the ota generate process
+
+    Submitted jobs are queued in the Jobs table and started by priority, then
+    in the order of submission, whenever one of the max_workers slots is free.
     """
 
     @staticmethod
@@ -121,7 +177,8 @@ class ProcessesManagement:
             raise DependencyError(
                 "zip command not found in PATH. Attempt to generate OTA might fail. " + str(e))
 
-    def __init__(self, *, working_dir='output', db_path=None, otatools_dir=None):
+    def __init__(self, *, working_dir='output', db_path=None, otatools_dir=None,
+                 max_workers=None):
         """
         create a table if not exist
         """
@@ -129,6 +186,10 @@ class ProcessesManagement:
         self.working_dir = working_dir
         self.logs_dir = os.path.join(working_dir, 'logs')
         self.otatools_dir = otatools_dir
+        self.max_workers = max_workers or default_max_workers()
+        # Guards the running processes and the status changes of the jobs
+        self._lock = threading.Lock()
+        self._running = {}
         os.makedirs(self.working_dir, exist_ok=True)
         os.makedirs(self.logs_dir, exist_ok=True)
         if not db_path:
@@ -150,22 +211,44 @@ class ProcessesManagement:
                 STDOUT TEXT,
                 STDERR TEXT,
                 StartTime INTEGER,
-                FinishTime INTEGER
+                FinishTime INTEGER,
+                Priority INTEGER DEFAULT 0,
+                QueueTime INTEGER DEFAULT 0,
+                Command TEXT
             )
             """)
+            # Databases created by older versions lack the scheduler columns
+            cursor.execute("PRAGMA table_info(Jobs)")
+            columns = [column[1] for column in cursor.fetchall()]
+            for column, column_type in [('Priority', 'INTEGER DEFAULT 0'),
+                                        ('QueueTime', 'INTEGER DEFAULT 0'),
+                                        ('Command', 'TEXT')]:
+                if column not in columns:
+                    cursor.execute(
+                        "ALTER TABLE Jobs ADD COLUMN {} {}".format(column, column_type))
+            # The processes of the jobs still marked as running died with the
+            # previous server, while the queued jobs can still be started.
+            cursor.execute("""
+                UPDATE Jobs SET Status='Error', FinishTime=(?)
+                WHERE Status='Running'
+                """, (int(time.time()),))
+        self._schedule()
 
-    def insert_database(self, job_info):
+    def insert_database(self, job_info, command=None):
         """
         Insert the job_info into the database
         Args:
             job_info: JobInfo
+            command: List[string], the command to run once the job is started
         """
+        sql_form_dict = job_info.to_sql_form_dict()
+        sql_form_dict['command'] = json.dumps(command) if command else None
         with sqlite3.connect(self.path) as connect:
             cursor = connect.cursor()
             cursor.execute("""
-                    INSERT INTO Jobs (ID, TargetPath, IncrementalPath, Verbose, Partial, OutputPath, Status, Downgrade, OtherFlags, STDOUT, STDERR, StartTime, Finishtime)
-                    VALUES (:id, :target, :incremental, :verbose, :partial, :output, :status, :downgrade, :extra, :stdout, :stderr, :start_time, :finish_time)
-                """, job_info.to_sql_form_dict())
+                    INSERT INTO Jobs (ID, TargetPath, IncrementalPath, Verbose, Partial, OutputPath, Status, Downgrade, OtherFlags, STDOUT, STDERR, StartTime, Finishtime, Priority, QueueTime, Command)
+                    VALUES (:id, :target, :incremental, :verbose, :partial, :output, :status, :downgrade, :extra, :stdout, :stderr, :start_time, :finish_time, :priority, :queue_time, :command)
+                """, sql_form_dict)
 
     def get_status_by_ID(self, id):
         """
@@ -179,9 +262,9 @@ class ProcessesManagement:
             cursor = connect.cursor()
             logging.info(id)
             cursor.execute("""
-            SELECT ID, TargetPath, IncrementalPath, Verbose, Partial, OutputPath, Status, Downgrade, OtherFlags, STDOUT, STDERR, StartTime, FinishTime
+            SELECT {}
             FROM Jobs WHERE ID=(?)
-            """, (str(id),))
+            """.format(JOB_COLUMNS), (str(id),))
             row = cursor.fetchone()
         status = JobInfo(*row)
         return status
@@ -195,13 +278,53 @@ class ProcessesManagement:
         with sqlite3.connect(self.path) as connect:
             cursor = connect.cursor()
             cursor.execute("""
-            SELECT ID, TargetPath, IncrementalPath, Verbose, Partial, OutputPath, Status, Downgrade, OtherFlags, STDOUT, STDERR, StartTime, FinishTime
+            SELECT {}
             FROM Jobs
-            """)
+            """.format(JOB_COLUMNS))
             rows = cursor.fetchall()
         statuses = [JobInfo(*row) for row in rows]
         return statuses
 
+    def get_metrics(self):
+        """
+        Return the queue depth and the runtime statistics of the jobs
+        Format:
+            max_workers: int, running: int, queued: int,
+            oldest_queued_seconds: int, finished: int,
+            average_wait_seconds: float, average_runtime_seconds: float,
+            max_runtime_seconds: int
+        """
+        now = int(time.time())
+        with sqlite3.connect(self.path) as connect:
+            cursor = connect.cursor()
+            cursor.execute("""
+            SELECT COUNT(*), MIN(QueueTime) FROM Jobs WHERE Status='Queued'
+            """)
+            queued, oldest_queue_time = cursor.fetchone()
+            # Jobs queued before the scheduler existed have no QueueTime
+            cursor.execute("""
+            SELECT AVG(StartTime - QueueTime) FROM Jobs
+            WHERE Status IN ('Running', 'Finished', 'Error') AND QueueTime > 0
+            """)
+            average_wait, = cursor.fetchone()
+            cursor.execute("""
+            SELECT COUNT(*), AVG(FinishTime - StartTime), MAX(FinishTime - StartTime)
+            FROM Jobs WHERE Status='Finished'
+            """)
+            finished, average_runtime, max_runtime = cursor.fetchone()
+        with self._lock:
+            running = len(self._running)
+        return {
+            'max_workers': self.max_workers,
+            'running': running,
+            'queued': queued,
+            'oldest_queued_seconds': now - oldest_queue_time if queued else 0,
+            'finished': finished,
+            'average_wait_seconds': average_wait or 0,
+            'average_runtime_seconds': average_runtime or 0,
+            'max_runtime_seconds': max_runtime or 0,
+        }
+
     def update_status(self, id, status, finish_time):
         """
         Change the status and finish time of job <id> in the database
@@ -218,10 +341,63 @@ class ProcessesManagement:
                 """,
                            (status, finish_time, id))
 
+    def cancel(self, id):
+        """
+        Cancel job <id>. A queued job is taken off the queue and a running job
+        is terminated.
+        Args:
+            id: string
+        Return:
+            True if the job was queued or running, otherwise False
+        """
+        with self._lock:
+            with sqlite3.connect(self.path) as connect:
+                cursor = connect.cursor()
+                cursor.execute("""
+                    UPDATE Jobs SET Status='Cancelled', FinishTime=(?)
+                    WHERE ID=(?) AND Status IN ('Queued', 'Running')
+                    """, (int(time.time()), id))
+                if cursor.rowcount == 0:
+                    return False
+            proc = self._running.get(id)
+            if proc:
+                proc.terminate()
+        logging.info('Cancelled job %s', id)
+        return True
+
+    def _schedule(self):
+        """
+        Start the queued jobs, highest priority first and first come first
+        served within a priority, until all the workers are busy.
+        """
+        with self._lock:
+            while len(self._running) < self.max_workers:
+                with sqlite3.connect(self.path) as connect:
+                    cursor = connect.cursor()
+                    cursor.execute("""
+                    SELECT ID, Command, STDOUT, STDERR FROM Jobs
+                    WHERE Status='Queued'
+                    ORDER BY Priority DESC, QueueTime, rowid
+                    LIMIT 1
+                    """)
+                    row = cursor.fetchone()
+                    if not row:
+                        return
+                    id, command, stdout, stderr = row
+                    cursor.execute("""
+                    UPDATE Jobs SET Status='Running', StartTime=(?)
+                    WHERE ID=(?)
+                    """, (int(time.time()), id))
+                try:
+                    self.ota_run(json.loads(command), id, stdout, stderr)
+                except Exception:
+                    # ota_run has marked the job as failed, try the next one
+                    continue
+
     def ota_run(self, command, id, stdout_path, stderr_path):
         """
         Initiate a subprocess to run the ota generation. Wait until it finished and update
-        the record in the database.
+        the record in the database, then start the next queued job.
         """
         stderr_pipes = pipes.Template()
         stdout_pipes = pipes.Template()
@@ -243,23 +419,31 @@ class ProcessesManagement:
             logging.error('Failed to execute ota_from_target_files %s', e)
             self.update_status(id, 'Error', int(time.time()))
             raise
+        self._running[id] = proc
 
         def wait_result():
             exit_code = proc.wait()
-            if exit_code == 0:
-                self.update_status(id, 'Finished', int(time.time()))
-            else:
-                self.update_status(id, 'Error', int(time.time()))
+            with self._lock:
+                del self._running[id]
+                # Keep the status of a job which was cancelled while running
+                if self.get_status_by_ID(id).status != 'Cancelled':
+                    if exit_code == 0:
+                        self.update_status(id, 'Finished', int(time.time()))
+                    else:
+                        self.update_status(id, 'Error', int(time.time()))
+            self._schedule()
         threading.Thread(target=wait_result).start()
 
     def ota_generate(self, args, id):
         """
-        Read in the arguments from the frontend and start running the OTA
-        generation process, then update the records in database.
+        Read in the arguments from the frontend and queue the OTA generation
+        process, then update the records in database. The job is started as
+        soon as a worker is free.
         Format of args:
             output: string, extra_keys: List[string], extra: string,
             isIncremental: bool, isPartial: bool, partial: List[string],
-            incremental: string, target: string, verbose: bool
+            incremental: string, target: string, verbose: bool,
+            priority: int (optional, higher runs first, default 0)
         args:
             args: dict
             id: string
@@ -289,6 +473,7 @@ class ProcessesManagement:
         command.append(os.path.realpath(args['output']))
         stdout = os.path.join(self.logs_dir, 'stdout.' + str(id))
         stderr = os.path.join(self.logs_dir, 'stderr.' + str(id))
+        queue_time = int(time.time())
         job_info = JobInfo(id,
                            target=args['target'],
                            incremental=args['incremental'] if args['isIncremental'] else '',
@@ -296,14 +481,16 @@ class ProcessesManagement:
                            partial=args['partial'] if args['isPartial'] else [
                            ],
                            output=args['output'],
-                           status='Running',
+                           status='Queued',
                            extra=args['extra'],
-                           start_time=int(time.time()),
+                           start_time=queue_time,
                            stdout=stdout,
-                           stderr=stderr
+                           stderr=stderr,
+                           priority=int(args.get('priority', 0)),
+                           queue_time=queue_time
                            )
-        self.ota_run(command, id, job_info.stdout, job_info.stderr)
-        self.insert_database(job_info)
+        self.insert_database(job_info, command)
         logging.info(
-            'Starting generating OTA package with id {}: \n {}'
+            'Queued OTA package generation with id {}: \n {}'
             .format(id, command))
+        self._schedule()
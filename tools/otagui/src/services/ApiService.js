@@ -4,6 +4,8 @@ const baseURL = process.env.NODE_ENV === 'production' ? '' : 'http://localhost:5
 
 console.log(`Build mode: ${process.env.NODE_ENV}, API base url ${baseURL}`);
 
+const UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024;
+
 const apiClient = axios.create({
   baseURL,
   withCredentials: false,
@@ -23,6 +25,14 @@ export default {
   getJobById(id) {
     return apiClient.get("/check/" + id)
   },
+  streamJobLogs(id, job) {
+    // Server-sent events with the log output after the offsets of job
+    return new EventSource(`${baseURL}/logs/${id}` +
+      `?stdout_offset=${job.stdout_offset}&stderr_offset=${job.stderr_offset}`)
+  },
+  cancelJob(id) {
+    return apiClient.post("/cancel/" + id)
+  },
   async getBuildList() {
     let resp = await apiClient.get("/file");
     return resp.data || [];
@@ -31,14 +41,45 @@ export default {
     let resp = await apiClient.get("/reconstruct_build_list");
     return resp.data;
   },
-  uploadTarget(file, onUploadProgress) {
-    let formData = new FormData()
-    formData.append('file', file)
-    return apiClient.post("/file/" + file.name,
-      formData,
-      {
-        onUploadProgress
-      })
+  async uploadTarget(file, onUploadProgress) {
+    // Upload in chunks, starting after the bytes the backend already has,
+    // so that an interrupted upload is resumed when it is tried again. The
+    // size and modification time tell the backend which file the bytes it
+    // has belong to.
+    let url = "/upload/" + encodeURIComponent(file.name)
+    let identity = { size: file.size, modified: file.lastModified }
+    let offset = (await apiClient.get(url, { params: identity })).data.offset
+    for (;;) {
+      let start = offset
+      let end = Math.min(start + UPLOAD_CHUNK_SIZE, file.size)
+      try {
+        let resp = await apiClient.put(url, file.slice(start, end), {
+          params: {
+            ...identity,
+            offset: start,
+            complete: end == file.size ? 1 : 0
+          },
+          headers: { 'Content-Type': 'application/octet-stream' },
+          onUploadProgress: (event) => onUploadProgress({
+            loaded: start + event.loaded,
+            total: file.size
+          })
+        })
+        if (end == file.size) {
+          return resp
+        }
+        offset = end
+      } catch (error) {
+        // Continue from the bytes the backend has, e.g. none if it has
+        // discarded the bytes of another file with the same name
+        let response = error.response
+        if (!response || response.status != 409 ||
+            response.data.offset === undefined) {
+          throw error
+        }
+        offset = response.data.offset
+      }
+    }
   },
   async postInput(input, id) {
     try {
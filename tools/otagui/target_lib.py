@@ -1,17 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict, field
 import sqlite3
+import threading
 import time
 import logging
 import os
 import zipfile
-import re
 import json
 
+# The build.prop properties which are analysed, and the BuildInfo fields
+# they are stored in
+BUILD_PROPS = {
+    'ro.build.id': 'build_id',
+    'ro.build.version.incremental': 'build_version',
+    'ro.build.flavor': 'build_flavor',
+}
+# The number of builds analysed at the same time
+ANALYSE_WORKERS = 4
+
 
 class BuildFileInvalidError(Exception):
     pass
 
 
+def parse_build_prop(lines):
+    """
+    Extract all the ro.* properties of a build.prop in a single pass
+    Args:
+        lines: an iterable of the lines of build.prop, as bytes
+    Return:
+        A dict of property names to values
+    """
+    props = {}
+    for line in lines:
+        if not line.startswith(b'ro.'):
+            continue
+        name, separator, value = line.partition(b'=')
+        if separator:
+            props[name.decode('utf-8').strip()] = value.strip().decode('utf-8')
+    return props
+
+
 @dataclass
 class BuildInfo:
     """
@@ -30,28 +59,12 @@ class BuildInfo:
         Analyse the build's version info and partitions included
         Then write them into the build_info
         """
-        def extract_info(pattern, lines):
-            # Try to match a regex in a list of string
-            line = list(filter(pattern.search, lines))[0]
-            if line:
-                return pattern.search(line).group(0)
-            else:
-                return ''
-
         with zipfile.ZipFile(self.path) as build:
             try:
                 with build.open('SYSTEM/build.prop', 'r') as build_prop:
-                    raw_info = build_prop.readlines()
-                    pattern_id = re.compile(b'(?<=ro\.build\.id\=).+')
-                    pattern_version = re.compile(
-                        b'(?<=ro\.build\.version\.incremental\=).+')
-                    pattern_flavor = re.compile(b'(?<=ro\.build\.flavor\=).+')
-                    self.build_id = extract_info(
-                        pattern_id, raw_info).decode('utf-8')
-                    self.build_version = extract_info(
-                        pattern_version, raw_info).decode('utf-8')
-                    self.build_flavor = extract_info(
-                        pattern_flavor, raw_info).decode('utf-8')
+                    props = parse_build_prop(build_prop)
+                    for prop, name in BUILD_PROPS.items():
+                        setattr(self, name, props.get(prop, ''))
                 with build.open('META/ab_partitions.txt', 'r') as partition_info:
                     raw_info = partition_info.readlines()
                     for line in raw_info:
@@ -79,6 +92,10 @@ class BuildInfo:
 class TargetLib:
     """
     A class that manages the builds in database.
+
+    The database doubles as an index of the analysed files, keyed by their
+    path, size and modification time, so that unchanged builds are never
+    reopened. Builds are analysed by a pool of ANALYSE_WORKERS threads.
     """
 
     def __init__(self, working_dir="target", db_path=None):
@@ -89,6 +106,10 @@ class TargetLib:
         if db_path is None:
             db_path = os.path.join(working_dir, "ota_database.db")
         self.db_path = db_path
+        self._executor = ThreadPoolExecutor(ANALYSE_WORKERS)
+        # The paths being analysed, to their futures
+        self._pending = {}
+        self._lock = threading.Lock()
         with sqlite3.connect(self.db_path) as connect:
             cursor = connect.cursor()
             cursor.execute("""
@@ -99,17 +120,33 @@ class TargetLib:
                 BuildID TEXT,
                 BuildVersion TEXT,
                 BuildFlavor TEXT,
-                Partitions TEXT
+                Partitions TEXT,
+                FileSize INTEGER,
+                ModifiedTime INTEGER,
+                Sha256 TEXT
             )
             """)
+            # Databases created by older versions lack the index columns
+            cursor.execute("PRAGMA table_info(Builds)")
+            columns = [column[1] for column in cursor.fetchall()]
+            for column, column_type in [('FileSize', 'INTEGER'),
+                                        ('ModifiedTime', 'INTEGER'),
+                                        ('Sha256', 'TEXT')]:
+                if column not in columns:
+                    cursor.execute(
+                        "ALTER TABLE Builds ADD COLUMN {} {}".format(column, column_type))
 
-    def new_build(self, filename, path):
+    def new_build(self, filename, path, sha256=None):
         """
         Insert a new build into the database
         Args:
             filename: the name of the file
             path: the relative path of the file
+            sha256: the hex SHA-256 of the file, if it is known
+        Return:
+            The BuildInfo of the build, with the path it was moved to
         """
+        file_stat = os.stat(path)
         build_info = BuildInfo(filename, path, int(time.time()))
         build_info.analyse_buildprop()
         # Ignore name specified by user, instead use a standard format
@@ -117,35 +154,91 @@ class TargetLib:
             build_info.build_flavor, build_info.build_id, build_info.build_version))
         if path != build_info.path:
             os.rename(path, build_info.path)
+        sql_form_dict = build_info.to_sql_form_dict()
+        sql_form_dict['file_size'] = file_stat.st_size
+        sql_form_dict['modified_time'] = file_stat.st_mtime_ns
+        sql_form_dict['sha256'] = sha256
         with sqlite3.connect(self.db_path) as connect:
             cursor = connect.cursor()
+            # Replace the entry of a file which changed since it was indexed
             cursor.execute("""
-            SELECT * FROM Builds WHERE FileName=:file_name and Path=:path
-            """, build_info.to_sql_form_dict())
-            if cursor.fetchall():
-                cursor.execute("""
-                DELETE FROM Builds WHERE FileName=:file_name and Path=:path
-                """, build_info.to_sql_form_dict())
+            DELETE FROM Builds WHERE Path=:path
+            """, sql_form_dict)
             cursor.execute("""
-            INSERT INTO Builds (FileName, UploadTime, Path, BuildID, BuildVersion, BuildFlavor, Partitions)
-            VALUES (:file_name, :time, :path, :build_id, :build_version, :build_flavor, :partitions)
-            """, build_info.to_sql_form_dict())
+            INSERT INTO Builds (FileName, UploadTime, Path, BuildID, BuildVersion, BuildFlavor, Partitions, FileSize, ModifiedTime, Sha256)
+            VALUES (:file_name, :time, :path, :build_id, :build_version, :build_flavor, :partitions, :file_size, :modified_time, :sha256)
+            """, sql_form_dict)
+        return build_info
+
+    def new_build_async(self, filename, path, sha256=None):
+        """
+        Analyse a new build in the worker pool and insert it into the database
+        Args:
+            filename: the name of the file
+            path: the relative path of the file
+            sha256: the hex SHA-256 of the file, if it is known
+        Return:
+            A future of the BuildInfo, done once the build is in the database
+        """
+        with self._lock:
+            future = self._pending.get(path)
+            if future:
+                return future
+            future = self._executor.submit(
+                self.new_build, filename, path, sha256)
+            self._pending[path] = future
+
+        def done(future):
+            with self._lock:
+                del self._pending[path]
+            if future.exception():
+                logging.error('Failed to analyse build %s: %s',
+                              path, future.exception())
+        future.add_done_callback(done)
+        return future
+
+    def get_index(self):
+        """
+        Get the size and modification time of the files when they were analysed
+        Return:
+            A dict of paths to (FileSize, ModifiedTime)
+        """
+        with sqlite3.connect(self.db_path) as connect:
+            cursor = connect.cursor()
+            cursor.execute("""
+            SELECT Path, FileSize, ModifiedTime FROM Builds""")
+            return {path: (size, mtime) for path, size, mtime in cursor.fetchall()}
+
+    def is_indexed(self, path, index=None):
+        """
+        Return whether the file at <path> was analysed with its current size
+        and modification time
+        """
+        if index is None:
+            index = self.get_index()
+        file_stat = os.stat(path)
+        return index.get(path) == (file_stat.st_size, file_stat.st_mtime_ns)
 
     def new_build_from_dir(self):
         """
-        Update the database using files under a directory
+        Update the database using files under a directory. The builds which
+        are new or have changed since they were indexed are analysed in the
+        background, so the result only includes the builds indexed so far.
         Args:
             path: a directory
         """
         build_dir = self.working_dir
+        index = self.get_index()
         if os.path.isdir(build_dir):
             builds_name = os.listdir(build_dir)
             for build_name in builds_name:
                 path = os.path.join(build_dir, build_name)
-                if build_name.endswith(".zip") and zipfile.is_zipfile(path):
-                    self.new_build(build_name, path)
+                if build_name.endswith(".zip") and not self.is_indexed(path, index) \
+                        and zipfile.is_zipfile(path):
+                    self.new_build_async(build_name, path)
         elif os.path.isfile(build_dir) and build_dir.endswith(".zip"):
-            self.new_build(os.path.split(build_dir)[-1], build_dir)
+            if not self.is_indexed(build_dir, index):
+                self.new_build_async(os.path.split(build_dir)[-1], build_dir)
         return self.get_builds()
 
     def sql_to_buildinfo(self, row):
@@ -180,3 +273,18 @@ class TargetLib:
             FROM Builds WHERE Path==(?)
             """, (path, ))
         return self.sql_to_buildinfo(cursor.fetchone())
+
+    def get_build_by_hash(self, sha256):
+        """
+        Get a build in the database by the SHA-256 of its file
+        Return:
+            A build_info, or None if no uploaded build has this hash
+        """
+        with sqlite3.connect(self.db_path) as connect:
+            cursor = connect.cursor()
+            cursor.execute("""
+            SELECT FileName, Path, UploadTime, BuildID, BuildVersion, BuildFlavor, Partitions
+            FROM Builds WHERE Sha256==(?)
+            """, (sha256, ))
+            row = cursor.fetchone()
+        return self.sql_to_buildinfo(row) if row else None
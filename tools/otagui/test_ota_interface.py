@@ -1,9 +1,10 @@
 import unittest
-from ota_interface import JobInfo, ProcessesManagement
+from ota_interface import JobInfo, ProcessesManagement, read_log
 from unittest.mock import patch, mock_open, Mock, MagicMock
 import os
 import sqlite3
 import copy
+import threading
 
 class TestJobInfo(unittest.TestCase):
     def setUp(self):
@@ -178,6 +179,27 @@ class TestJobInfo(unittest.TestCase):
             'the ' + key + ' is not converted to detailed dict correctly'
         )
 
+    def test_to_dict_detail_offset(self):
+        with open('test_stdout', 'wb') as fout, open('test_stderr', 'wb') as ferr:
+            fout.write(b'line 1\nline 2\n')
+            ferr.write('error \u00e9'.encode('utf-8')[:-1])
+        self.addCleanup(os.remove, 'test_stdout')
+        self.addCleanup(os.remove, 'test_stderr')
+        job_info = self.setup_job(stdout='test_stdout', stderr='test_stderr')
+        mock_target_lib = Mock()
+        mock_target_lib.get_build_by_path = Mock(
+            return_value=Mock(file_name='build.zip', build_version=''))
+        dict_detail = job_info.to_dict_detail(mock_target_lib, offset=7)
+        self.assertEqual(dict_detail['stdout'], 'line 2\n')
+        self.assertEqual(dict_detail['stdout_offset'], 14)
+        # The character which is not completely written is left for later
+        self.assertEqual(dict_detail['stderr'], 'error ')
+        self.assertEqual(dict_detail['stderr_offset'], 6)
+        with open('test_stderr', 'ab') as ferr:
+            ferr.write('\u00e9'.encode('utf-8')[-1:] + b'!')
+        self.assertEqual(read_log('test_stderr', 6), ('\u00e9!', 9))
+        self.assertEqual(read_log('test_stdout', 0, limit=4), ('line', 4))
+
 class TestProcessesManagement(unittest.TestCase):
     def setUp(self):
         if os.path.isfile('test_process.db'):
@@ -326,5 +348,124 @@ class TestProcessesManagement(unittest.TestCase):
             'The subprocess command is not in its good shape'
         )
 
+class FakeProcess:
+    """
+    A subprocess.Popen stand-in which runs until finish() or terminate()
+    """
+    def __init__(self, *args, **kwargs):
+        self.command = args[0]
+        self.exit_code = None
+        self.finished = threading.Event()
+
+    def finish(self, exit_code=0):
+        self.exit_code = exit_code
+        self.finished.set()
+
+    def terminate(self):
+        self.finish(-15)
+
+    def wait(self):
+        self.finished.wait()
+        return self.exit_code
+
+class TestJobScheduler(unittest.TestCase):
+    def setUp(self):
+        if os.path.isfile('test_scheduler.db'):
+            os.remove('test_scheduler.db')
+        self.procs = []
+        def popen(*args, **kwargs):
+            proc = FakeProcess(*args, **kwargs)
+            self.procs.append(proc)
+            return proc
+        patchers = [
+            patch.object(ProcessesManagement, 'check_external_dependencies'),
+            patch('subprocess.Popen', Mock(side_effect=popen)),
+            patch('pipes.Template', Mock()),
+            patch('os.path.isfile', Mock(return_value=True)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.processes = ProcessesManagement(
+            db_path='test_scheduler.db', max_workers=2)
+
+    def tearDown(self):
+        # Stop all the jobs before their database is removed
+        for job in self.processes.get_status():
+            self.processes.cancel(job.id)
+        for proc in self.procs:
+            proc.finish()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+        os.remove('test_scheduler.db')
+
+    def submit(self, id, priority=0):
+        self.processes.ota_generate({
+            'output': id + '.zip',
+            'extra_keys': [],
+            'extra': '',
+            'isIncremental': False,
+            'isPartial': False,
+            'partial': [],
+            'incremental': '',
+            'target': 'target/build.zip',
+            'verbose': False,
+            'priority': priority
+        }, id=id)
+
+    def wait_for_status(self, id, status):
+        for _ in range(100):
+            if self.processes.get_status_by_ID(id).status == status:
+                return
+            threading.Event().wait(0.01)
+        self.fail('job ' + id + ' did not become ' + status)
+
+    def test_queue(self):
+        for id in ['a', 'b', 'c', 'd']:
+            self.submit(id)
+        self.submit('urgent', priority=1)
+        self.assertEqual(len(self.procs), 2,
+            'More jobs are running than the workers available'
+        )
+        metrics = self.processes.get_metrics()
+        self.assertEqual(metrics['running'], 2)
+        self.assertEqual(metrics['queued'], 3)
+        self.assertEqual(self.processes.get_status_by_ID('c').status, 'Queued')
+        # A free worker takes the job with the highest priority first,
+        # then the jobs in the order of submission
+        self.procs[0].finish()
+        self.wait_for_status('urgent', 'Running')
+        self.wait_for_status('a', 'Finished')
+        self.procs[1].finish(1)
+        self.wait_for_status('c', 'Running')
+        self.wait_for_status('b', 'Error')
+        self.assertEqual(self.processes.get_status_by_ID('d').status, 'Queued')
+        self.assertEqual(self.processes.get_metrics()['finished'], 1)
+
+    def test_cancel(self):
+        for id in ['a', 'b', 'c']:
+            self.submit(id)
+        self.assertTrue(self.processes.cancel('c'))
+        self.assertEqual(self.processes.get_status_by_ID('c').status, 'Cancelled')
+        self.assertTrue(self.processes.cancel('a'))
+        self.wait_for_status('a', 'Cancelled')
+        self.assertEqual(self.procs[0].exit_code, -15)
+        self.assertFalse(self.processes.cancel('a'))
+        # The cancelled job is never started
+        self.procs[1].finish()
+        self.wait_for_status('b', 'Finished')
+        self.assertEqual(len(self.procs), 2)
+
+    def test_recover(self):
+        for id in ['a', 'b', 'c']:
+            self.submit(id)
+        # A new server fails the jobs which were running and resumes the queue
+        processes = ProcessesManagement(
+            db_path='test_scheduler.db', max_workers=2)
+        self.assertEqual(processes.get_status_by_ID('a').status, 'Error')
+        self.assertEqual(processes.get_status_by_ID('c').status, 'Running')
+        self.assertEqual(self.procs[-1].command[-1], os.path.realpath('c.zip'))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,10 +1,11 @@
 import unittest
 from unittest.mock import patch, mock_open, Mock, MagicMock
-from target_lib import BuildInfo, TargetLib
+from target_lib import BuildInfo, TargetLib, parse_build_prop
 import zipfile
 import os
 import sqlite3
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import NamedTemporaryFile, mkdtemp
 
 class CreateTestBuild():
     def __init__(self, include_build_prop=True, include_ab_partitions=True):
@@ -188,5 +189,58 @@ class TestTargetLib(unittest.TestCase):
         test_build.clean()
 
 
+class TestBuildIndex(unittest.TestCase):
+    def setUp(self):
+        self.working_dir = mkdtemp()
+        self.target_lib = TargetLib(working_dir=self.working_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def create_build(self, name):
+        path = os.path.join(self.working_dir, name)
+        with zipfile.ZipFile(path, mode='w') as package:
+            package.write('test/test_build.prop', 'SYSTEM/build.prop')
+            package.write('test/test_ab_partitions.txt',
+                'META/ab_partitions.txt')
+        return path
+
+    def reconstruct(self):
+        self.target_lib.new_build_from_dir()
+        for future in list(self.target_lib._pending.values()):
+            future.result()
+        return self.target_lib.get_builds()
+
+    def test_parse_build_prop(self):
+        with open('test/test_build.prop', 'rb') as build_prop:
+            props = parse_build_prop(build_prop)
+        self.assertEqual(props['ro.build.id'], 'AOSP.MASTER')
+        self.assertEqual(props['ro.build.flavor'],
+            'aosp_cf_x86_64_phone-userdebug')
+        self.assertTrue(all(name.startswith('ro.') for name in props))
+
+    def test_new_build_from_dir(self):
+        self.create_build('upload.zip')
+        builds = self.reconstruct()
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(builds[0].build_version, '7392671')
+        self.assertTrue(self.target_lib.is_indexed(builds[0].path))
+        # Unchanged builds are not analysed again
+        with patch('target_lib.BuildInfo.analyse_buildprop') as analyse:
+            self.assertEqual(self.reconstruct(), builds)
+        analyse.assert_not_called()
+        # A modified build is
+        os.utime(builds[0].path, ns=(0, 0))
+        self.assertFalse(self.target_lib.is_indexed(builds[0].path))
+        self.assertEqual(len(self.reconstruct()), 1)
+        self.assertTrue(self.target_lib.is_indexed(builds[0].path))
+
+    def test_get_build_by_hash(self):
+        path = self.create_build('upload.zip')
+        build = self.target_lib.new_build('upload.zip', path, sha256='abc')
+        self.assertEqual(self.target_lib.get_build_by_hash('abc'), build)
+        self.assertIsNone(self.target_lib.get_build_by_hash('def'))
+
+
 if __name__ == '__main__':
     unittest.main()
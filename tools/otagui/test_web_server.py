@@ -0,0 +1,194 @@
+import unittest
+from unittest.mock import Mock
+from concurrent.futures import Future
+from http.client import HTTPConnection
+from io import BytesIO
+from tempfile import mkdtemp
+import hashlib
+import json
+import os
+import shutil
+import threading
+import web_server
+
+
+class QuietRequestHandler(web_server.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FormDataHandler(web_server.RequestHandler):
+    """
+    A request handler which only parses a multipart/form-data body
+    """
+
+    def __init__(self, body, boundary):
+        self.headers = {
+            'Content-Type': 'multipart/form-data; boundary=' + boundary,
+            'Content-Length': str(len(body)),
+        }
+        self.rfile = BytesIO(body)
+
+
+def build_form_data(boundary, content):
+    return (b'--' + boundary.encode() + b'\r\n'
+            b'Content-Disposition: form-data; name="file"; '
+            b'filename="build.zip"\r\n'
+            b'Content-Type: application/zip\r\n'
+            b'\r\n' +
+            content +
+            b'\r\n--' + boundary.encode() + b'--\r\n')
+
+
+class TestReceiveFormData(unittest.TestCase):
+    def receive(self, content, boundary='----boundary1234'):
+        handler = FormDataHandler(build_form_data(boundary, content), boundary)
+        upload = web_server.Upload()
+        output_file = BytesIO()
+        handler._receive_form_data(upload, output_file)
+        self.assertEqual(hashlib.sha256(content).hexdigest(),
+                         upload.sha256.hexdigest())
+        return output_file.getvalue()
+
+    def test_small_file(self):
+        # The whole file is shorter than the tail read after it
+        self.assertEqual(b'', self.receive(b''))
+        self.assertEqual(b'PK\x03\x04', self.receive(b'PK\x03\x04'))
+
+    def test_large_file(self):
+        content = os.urandom(3 * web_server.UPLOAD_BUFFER_SIZE // 2)
+        self.assertEqual(content, self.receive(content))
+
+    def test_delimiter_like_content(self):
+        # Only the last delimiter ends the file
+        content = b'a\r\n--' + b'----boundary1234' + b'\r\nb\r\n--'
+        self.assertEqual(content, self.receive(content))
+
+    def test_missing_delimiter(self):
+        body = build_form_data('----boundary1234', b'content')
+        handler = FormDataHandler(body[:-30], '----boundary1234')
+        with self.assertRaises(ValueError):
+            handler._receive_form_data(web_server.Upload(), BytesIO())
+
+
+class TestResumableUpload(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = mkdtemp()
+        os.chdir(self.tmp_dir)
+        os.mkdir('target')
+        self.build = Mock()
+        self.build.path = os.path.join(self.tmp_dir, 'target', 'build.zip')
+        self.build.to_dict.return_value = {'file_name': 'build.zip'}
+        web_server.target_lib = Mock()
+        web_server.target_lib.get_build_by_hash.return_value = None
+        web_server.target_lib.new_build_async.side_effect = self.new_build
+        web_server.uploads.clear()
+        self.server = web_server.ThreadedHTTPServer(
+            ('127.0.0.1', 0), QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        web_server.uploads.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def new_build(self, file_name, path, sha256):
+        os.rename(path, self.build.path)
+        future = Future()
+        future.set_result(self.build)
+        return future
+
+    def request(self, method, query, body=None):
+        connection = HTTPConnection('127.0.0.1', self.server.server_port)
+        try:
+            connection.request(method, '/upload/build.zip?' + query, body)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def get_offset(self, identity):
+        status, body = self.request('GET', identity)
+        self.assertEqual(200, status)
+        return json.loads(body)['offset']
+
+    def put(self, identity, offset, chunk, complete=False):
+        return self.request(
+            'PUT', '{}&offset={}&complete={}'.format(
+                identity, offset, int(complete)), chunk)
+
+    def test_upload(self):
+        identity = 'size=6&modified=1'
+        self.assertEqual(0, self.get_offset(identity))
+        self.assertEqual((200, b'{"offset": 3}'),
+                         self.put(identity, 0, b'abc'))
+        self.assertEqual(3, self.get_offset(identity))
+        status, _ = self.put(identity, 3, b'def', complete=True)
+        self.assertEqual(201, status)
+        web_server.target_lib.new_build_async.assert_called_once_with(
+            'build.zip', os.path.join('target', 'build.zip.part'),
+            hashlib.sha256(b'abcdef').hexdigest())
+        self.assertEqual(['build.zip'], os.listdir('target'))
+
+    def test_offset_mismatch(self):
+        identity = 'size=6&modified=1'
+        self.put(identity, 0, b'abc')
+        self.assertEqual((409, b'{"offset": 3}'),
+                         self.put(identity, 1, b'bcd'))
+        self.assertEqual((409, b'{"offset": 3}'),
+                         self.put(identity, 6, b''))
+        self.assertEqual(3, self.get_offset(identity))
+
+    def test_resume_after_restart(self):
+        identity = 'size=6&modified=1'
+        self.put(identity, 0, b'abc')
+        # The partial file is hashed again after a restart
+        web_server.uploads.clear()
+        self.assertEqual(3, self.get_offset(identity))
+        status, _ = self.put(identity, 3, b'def', complete=True)
+        self.assertEqual(201, status)
+        web_server.target_lib.new_build_async.assert_called_once_with(
+            'build.zip', os.path.join('target', 'build.zip.part'),
+            hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_other_file(self):
+        self.put('size=6&modified=1', 0, b'abc')
+        for restart in (False, True):
+            if restart:
+                web_server.uploads.clear()
+            # A file with the same name but another size or modification
+            # time doesn't resume the partial file
+            identity = 'size=4&modified=2'
+            self.assertEqual(0, self.get_offset(identity))
+            self.assertEqual((409, b'{"offset": 0}'),
+                             self.put(identity, 3, b'x'))
+            self.put('size=6&modified=1', 0, b'abc')
+        identity = 'size=4&modified=2'
+        status, _ = self.put(identity, 0, b'wxyz', complete=True)
+        self.assertEqual(201, status)
+        web_server.target_lib.new_build_async.assert_called_once_with(
+            'build.zip', os.path.join('target', 'build.zip.part'),
+            hashlib.sha256(b'wxyz').hexdigest())
+
+    def test_duplicate(self):
+        with open(self.build.path, 'wb') as build_file:
+            build_file.write(b'abcdef')
+        web_server.target_lib.get_build_by_hash.return_value = self.build
+        identity = 'size=6&modified=1'
+        status, body = self.put(identity, 0, b'abcdef', complete=True)
+        self.assertEqual(200, status)
+        self.assertEqual({'file_name': 'build.zip'}, json.loads(body))
+        web_server.target_lib.get_build_by_hash.assert_called_once_with(
+            hashlib.sha256(b'abcdef').hexdigest())
+        web_server.target_lib.new_build_async.assert_not_called()
+        # The duplicate is not kept
+        self.assertEqual(['build.zip'], os.listdir('target'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,19 +6,34 @@ Usage::
   python ./web_server.py [<port>]
 
 API::
-  GET /check : check the status of all jobs
-  GET /check/<id> : check the status of the job with <id>
+  GET /check : check the status of all jobs, and the queue depth and
+               runtime metrics of the job scheduler
+  GET /check/<id> : check the status of the job with <id>. The query
+                   parameters stdout_offset/stderr_offset (in bytes) skip
+                   the log output the client has already read
+  GET /logs/<id> : stream the new log output of the job with <id> as
+                   server-sent events until the job ends
   GET /file : fetch the target file list
   GET /file/<path> : Add build file(s) in <path>, and return the target file list
   GET /download/<id> : download the ota package with <id>
   POST /run/<id> : submit a job with <id>,
                  arguments set in a json uploaded together
-  POST /file/<filename> : upload a target file
-  [TODO] POST /cancel/<id> : cancel a job with <id>
+  POST /file/<filename> : upload a target file as multipart/form-data
+  GET /upload/<filename>?size=<size>&modified=<time> : get the number of
+                           bytes received so far of a resumable upload
+  PUT /upload/<filename>?size=<size>&modified=<time>&offset=<offset>[&complete=1] :
+                           append the body to a resumable upload at byte
+                           <offset>. The last chunk sets complete=1 to add
+                           the build
+  POST /cancel/<id> : cancel a queued or running job with <id>
+
+Uploads are hashed while they are written, and a build which is already in
+the library is not added again. A resumable upload is bound to the size and
+modification time of the file, so a partial file left behind by a different
+file with the same name is discarded instead of resumed.
 
 TODO:
   - Avoid unintentionally path leakage
-  - Avoid overwriting build when uploading build with same file name
 
 Other GET request will be redirected to the static request under 'dist' directory
 """
@@ -26,16 +41,124 @@ Other GET request will be redirected to the static request under 'dist' director
 from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 from threading import Lock
-from ota_interface import ProcessesManagement
-from target_lib import TargetLib
+from urllib.parse import urlsplit, parse_qs, unquote
+from ota_interface import ProcessesManagement, read_log
+from target_lib import BuildFileInvalidError, TargetLib
 import logging
 import json
 import cgi
+import hashlib
 import os
 import stat
+import time
 import zipfile
 
 LOCAL_ADDRESS = '0.0.0.0'
+# How often /logs/<id> checks a running job for new output, in seconds
+LOG_POLL_INTERVAL = 0.5
+# The most log output sent in one server-sent event, in bytes
+LOG_CHUNK_SIZE = 1024 * 1024
+# The size of the buffer which uploads are streamed through, in bytes
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+# The resumable uploads in progress, by the path of their partial file. Each
+# one has the SHA-256 of the bytes received so far. The partial file of an
+# upload missing in here, i.e. started before a restart, is hashed again.
+uploads = {}
+uploads_lock = Lock()
+
+
+class Upload:
+    """
+    A partially received target file
+    """
+
+    def __init__(self, identity=None):
+        self.lock = Lock()
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+        self.identity = identity
+
+    @staticmethod
+    def identity_path(path):
+        """
+        Return the path where the identity of the file uploaded to the
+        partial file at <path> is stored
+        """
+        return path + '.id'
+
+    @classmethod
+    def read_identity(cls, path):
+        """
+        Return the identity stored with the partial file at <path>, or None
+        """
+        try:
+            with open(cls.identity_path(path)) as identity_file:
+                return identity_file.read()
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def resume(cls, path, identity):
+        """
+        Continue the upload of the file with <identity> to the partial file
+        at <path>. A partial file of another file is discarded.
+        """
+        upload = cls(identity)
+        if os.path.exists(path) and cls.read_identity(path) == identity:
+            with open(path, 'rb') as partial_file:
+                upload.write_from(partial_file, os.path.getsize(path))
+            return upload
+        if os.path.exists(path):
+            os.remove(path)
+        with open(cls.identity_path(path), 'w') as identity_file:
+            identity_file.write(identity)
+        return upload
+
+    def remove_identity(self, path):
+        try:
+            os.remove(self.identity_path(path))
+        except FileNotFoundError:
+            pass
+
+    def write_from(self, source, length, output_file=None):
+        """
+        Copy <length> bytes from <source> to <output_file>, and hash them.
+        The bytes go through a single reused buffer.
+        """
+        buffer = memoryview(bytearray(min(length, UPLOAD_BUFFER_SIZE)))
+        while length > 0:
+            size = source.readinto(buffer[:min(length, len(buffer))])
+            if not size:
+                raise ConnectionError('The upload ended early')
+            self.sha256.update(buffer[:size])
+            if output_file:
+                output_file.write(buffer[:size])
+            self.offset += size
+            length -= size
+
+
+def add_uploaded_build(file_name, path, sha256):
+    """
+    Add an uploaded file to the build library, unless a build with the same
+    SHA-256 is already there.
+    Return:
+        (BuildInfo, True if the build is new)
+    """
+    build = target_lib.get_build_by_hash(sha256)
+    if build and os.path.exists(build.path):
+        os.remove(path)
+        return build, False
+    # Analysed in the worker pool, which bounds concurrent uploads. Only the
+    # central directory and the entries needed are read from the zip.
+    try:
+        return target_lib.new_build_async(file_name, path, sha256).result(), True
+    except zipfile.BadZipFile as e:
+        os.remove(path)
+        raise BuildFileInvalidError("Invalid build due to " + str(e))
+    except BuildFileInvalidError:
+        os.remove(path)
+        raise
 
 
 class CORSSimpleHTTPHandler(SimpleHTTPRequestHandler):
@@ -57,7 +180,7 @@ class RequestHandler(CORSSimpleHTTPHandler):
 
     def do_OPTIONS(self):
         self.send_response(200)
-        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, OPTIONS')
         self.send_header("Access-Control-Allow-Headers", "X-Requested-With")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
         self.end_headers()
@@ -67,16 +190,39 @@ class RequestHandler(CORSSimpleHTTPHandler):
             statuses = jobs.get_status()
             self._set_response(type='application/json')
             self.wfile.write(
-                json.dumps([status.to_dict_basic()
-                            for status in statuses]).encode()
+                json.dumps({
+                    'jobs': [status.to_dict_basic() for status in statuses],
+                    'scheduler': jobs.get_metrics()
+                }).encode()
             )
         elif self.path.startswith('/check/'):
-            id = self.path[7:]
+            url = urlsplit(self.path)
+            id = url.path[7:]
+            query = parse_qs(url.query)
             status = jobs.get_status_by_ID(id=id)
             self._set_response(type='application/json')
             self.wfile.write(
-                json.dumps(status.to_dict_detail(target_lib)).encode()
+                json.dumps(status.to_dict_detail(
+                    target_lib,
+                    offset=int(query.get('stdout_offset', ['0'])[0]),
+                    stderr_offset=int(query.get('stderr_offset', ['0'])[0])
+                )).encode()
             )
+        elif self.path.startswith('/logs/'):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            offsets = {
+                'stdout': int(query.get('stdout_offset', ['0'])[0]),
+                'stderr': int(query.get('stderr_offset', ['0'])[0])
+            }
+            # A reconnecting EventSource resumes from the last event it got
+            if self.headers['Last-Event-ID']:
+                offsets['stdout'], offsets['stderr'] = map(
+                    int, self.headers['Last-Event-ID'].split(','))
+            try:
+                self._stream_logs(url.path[6:], offsets)
+            except ConnectionError:
+                pass
         elif self.path.startswith('/file') or self.path.startswith("/reconstruct_build_list"):
             if self.path == '/file' or self.path == '/file/':
                 file_list = target_lib.get_builds()
@@ -92,6 +238,21 @@ class RequestHandler(CORSSimpleHTTPHandler):
                 str(self.path), str(self.headers), file_list
             )
             return
+        elif self.path.startswith('/upload/'):
+            url = urlsplit(self.path)
+            path = self._upload_path(url.path[8:])
+            identity = self._upload_identity(parse_qs(url.query))
+            with uploads_lock:
+                upload = uploads.get(path)
+            if upload:
+                offset = upload.offset if upload.identity == identity else 0
+            elif os.path.exists(path) and \
+                    Upload.read_identity(path) == identity:
+                offset = os.path.getsize(path)
+            else:
+                offset = 0
+            self._set_response(type='application/json')
+            self.wfile.write(json.dumps({'offset': offset}).encode())
         elif self.path.startswith('/download'):
             self.path = self.path[10:]
             return CORSSimpleHTTPHandler.do_GET(self)
@@ -103,6 +264,136 @@ class RequestHandler(CORSSimpleHTTPHandler):
                 self.path = '/dist' + self.path
             return CORSSimpleHTTPHandler.do_GET(self)
 
+    def _stream_logs(self, id, offsets):
+        """
+        Send the log output of job <id> after the given offsets as
+        server-sent events, until the job ends. Each event is a JSON object
+        with the new stdout/stderr text, the offsets to resume from and the
+        job status. The last event carries the final status.
+        """
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        while True:
+            # Read the status first, so no output is missed after the job ends
+            status = jobs.get_status_by_ID(id=id)
+            event = {'status': status.status}
+            for name, path in [('stdout', status.stdout),
+                               ('stderr', status.stderr)]:
+                try:
+                    event[name], offsets[name] = read_log(
+                        path, offsets[name], LOG_CHUNK_SIZE)
+                except FileNotFoundError:
+                    event[name] = ''
+                event[name + '_offset'] = offsets[name]
+            ended = status.status not in ('Queued', 'Running')
+            if event['stdout'] or event['stderr'] or ended:
+                self.wfile.write('id: {},{}\ndata: {}\n\n'.format(
+                    offsets['stdout'], offsets['stderr'],
+                    json.dumps(event)).encode())
+                self.wfile.flush()
+            if event['stdout'] or event['stderr']:
+                continue
+            if ended:
+                return
+            time.sleep(LOG_POLL_INTERVAL)
+
+    def _upload_path(self, file_name):
+        """
+        Return the path where an upload is received before it is analysed
+        """
+        return os.path.join(
+            'target', os.path.basename(unquote(file_name)) + '.part')
+
+    def _upload_identity(self, query):
+        """
+        Return the identity of the uploaded file from the size and
+        modification time in the query of a resumable upload
+        """
+        return '{}:{}'.format(query.get('size', [''])[0],
+                              query.get('modified', [''])[0])
+
+    def _receive_form_data(self, upload, output_file):
+        """
+        Write the file in the multipart/form-data body to <output_file>, as
+        it is received. The file has to be the last part of the form.
+        Please refer to the following link for the format:
+        https://datatracker.ietf.org/doc/html/rfc7578
+        """
+        _, params = cgi.parse_header(self.headers['Content-Type'])
+        delimiter = b'\r\n--' + params['boundary'].encode()
+        length = int(self.headers['Content-Length'])
+        # The part headers end with an empty line
+        line = self.rfile.readline()
+        length -= len(line)
+        while line not in (b'\r\n', b'\n', b''):
+            line = self.rfile.readline()
+            length -= len(line)
+        # The file ends at the last delimiter, which is in the end of the body
+        tail_length = min(length, len(delimiter) + 64)
+        upload.write_from(self.rfile, length - tail_length, output_file)
+        tail = self.rfile.read(tail_length)
+        end = tail.rfind(delimiter)
+        if end < 0:
+            raise ValueError('The end of the uploaded file is not found')
+        upload.sha256.update(tail[:end])
+        output_file.write(tail[:end])
+
+    def do_PUT(self):
+        if not self.path.startswith('/upload/'):
+            self.send_error(400)
+            return
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        file_name = os.path.basename(unquote(url.path[8:]))
+        path = self._upload_path(file_name)
+        identity = self._upload_identity(query)
+        with uploads_lock:
+            upload = uploads.get(path)
+            if not upload or (upload.identity != identity and
+                              not upload.lock.locked()):
+                # Start over if the partial file belongs to another file
+                upload = uploads[path] = Upload.resume(path, identity)
+        if upload.identity != identity or \
+                not upload.lock.acquire(blocking=False):
+            self.send_error(409, "The file is being uploaded by another request")
+            return
+        with uploads_lock:
+            replaced = uploads.get(path) is not upload
+        if replaced:
+            upload.lock.release()
+            self.send_error(409, "The file is being uploaded by another request")
+            return
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+            if offset != upload.offset:
+                # Let the client resume from the bytes which were received
+                self._set_response(code=409, type='application/json')
+                self.wfile.write(json.dumps({'offset': upload.offset}).encode())
+                return
+            with open(path, 'ab') as output_file:
+                upload.write_from(
+                    self.rfile, int(self.headers['Content-Length']), output_file)
+            if query.get('complete', ['0'])[0] != '1':
+                self._set_response(type='application/json')
+                self.wfile.write(json.dumps({'offset': upload.offset}).encode())
+                return
+            with uploads_lock:
+                del uploads[path]
+            upload.remove_identity(path)
+            try:
+                build, added = add_uploaded_build(
+                    file_name, path, upload.sha256.hexdigest())
+            except BuildFileInvalidError as e:
+                self.send_error(400, "Invalid build", str(e))
+                return
+            self._set_response(code=201 if added else 200,
+                               type='application/json')
+            self.wfile.write(json.dumps(build.to_dict()).encode())
+        finally:
+            upload.lock.release()
+
     def do_POST(self):
         if self.path.startswith('/run'):
             content_type, _ = cgi.parse_header(self.headers['content-type'])
@@ -117,7 +408,7 @@ class RequestHandler(CORSSimpleHTTPHandler):
                 self._set_response(code=200)
                 self.send_header("Content-Type", 'application/json')
                 self.wfile.write(json.dumps(
-                    {"success": True, "msg": "OTA Generator started running"}).encode())
+                    {"success": True, "msg": "OTA Generator job queued"}).encode())
             except Exception as e:
                 logging.warning(
                     "Failed to run ota_from_target_files %s", e.__traceback__)
@@ -128,33 +419,31 @@ class RequestHandler(CORSSimpleHTTPHandler):
                 str(self.path), str(self.headers),
                 json.dumps(post_data)
             )
+        elif self.path.startswith('/cancel'):
+            if jobs.cancel(self.path[8:]):
+                self._set_response(type='application/json')
+                self.wfile.write(json.dumps(
+                    {"success": True, "msg": "OTA Generator job cancelled"}).encode())
+            else:
+                self.send_error(
+                    404, "No queued or running job with this id")
         elif self.path.startswith('/file'):
-            file_name = os.path.join('target', self.path[6:])
-            file_length = int(self.headers['Content-Length'])
-            with open(file_name, 'wb') as output_file:
-                # Unwrap the uploaded file first (due to the usage of FormData)
-                # The wrapper has a boundary line at the top and bottom
-                # and some file information in the beginning
-                # There are a file content line, a file name line, and an empty line
-                # The boundary line in the bottom is 4 bytes longer than the top one
-                # Please refer to the following links for more details:
-                # https://stackoverflow.com/questions/8659808/how-does-http-file-upload-work
-                # https://datatracker.ietf.org/doc/html/rfc1867
-                upper_boundary = self.rfile.readline()
-                file_length -= len(upper_boundary) * 2 + 4
-                file_length -= len(self.rfile.readline())
-                file_length -= len(self.rfile.readline())
-                file_length -= len(self.rfile.readline())
-                BUFFER_SIZE = 1024*1024
-                for offset in range(0, file_length, BUFFER_SIZE):
-                    chunk = self.rfile.read(
-                        min(file_length-offset, BUFFER_SIZE))
-                    output_file.write(chunk)
-                target_lib.new_build(self.path[6:], file_name)
-            self._set_response(code=201)
+            file_name = os.path.basename(unquote(self.path[6:]))
+            path = self._upload_path(file_name)
+            upload = Upload()
+            with open(path, 'wb') as output_file:
+                self._receive_form_data(upload, output_file)
+            try:
+                build, added = add_uploaded_build(
+                    file_name, path, upload.sha256.hexdigest())
+            except BuildFileInvalidError as e:
+                self.send_error(400, "Invalid build", str(e))
+                return
+            self._set_response(code=201 if added else 200)
             self.wfile.write(
-                "File received, saved into {}".format(
-                    file_name).encode('utf-8')
+                "File {}, saved into {}".format(
+                    'received' if added else 'already uploaded',
+                    build.path).encode('utf-8')
             )
         else:
             self.send_error(400)
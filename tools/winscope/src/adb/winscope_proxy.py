@@ -17,7 +17,7 @@
 #
 # This is an ADB proxy for Winscope.
 #
-# Requirements: python3.5 and ADB installed and in system PATH.
+# Requirements: python3.7 and ADB installed and in system PATH.
 #
 # Usage:
 #     run: python3 winscope_proxy.py
@@ -29,14 +29,16 @@ import os
 import re
 import secrets
 import signal
+import struct
 import subprocess
 import sys
 import threading
-import time
+import zlib
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from http import HTTPStatus
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from tempfile import NamedTemporaryFile
 import base64
 
@@ -47,7 +49,7 @@ LOG_LEVEL = logging.DEBUG
 PORT = 5544
 
 # Keep in sync with ProxyClient#VERSION in Winscope
-VERSION = '1.0'
+VERSION = '1.1'
 
 WINSCOPE_VERSION_HEADER = "Winscope-Proxy-Version"
 WINSCOPE_TOKEN_HEADER = "Winscope-Token"
@@ -66,6 +68,12 @@ WINSCOPE_DIR = "/data/misc/wmtrace/"
 # Max interval between the client keep-alive requests in seconds
 KEEP_ALIVE_INTERVAL_S = 5
 
+# Size of the chunks streamed from the device to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Max number of files fetched from a device concurrently
+FETCH_WORKERS = 4
+
 logging.basicConfig(stream=sys.stderr, level=LOG_LEVEL,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger("ADBProxy")
@@ -462,6 +470,36 @@ def call_adb_outfile(params: str, outfile, device: str = None, stdin: bytes = No
             'Error executing adb command: adb {}\n{}'.format(params, repr(ex)))
 
 
+def stream_adb(params: str, device: str = None, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Yields the stdout of an adb command in chunks as it arrives"""
+    command = ['adb'] + (['-s', device] if device else []) + params.split(' ')
+    log.debug("Call: " + ' '.join(command))
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as ex:
+        log.debug('Error executing adb command: adb {}\n{}'.format(
+            params, repr(ex)))
+        raise AdbError(
+            'Error executing adb command: adb {}\n{}'.format(params, repr(ex)))
+    try:
+        while True:
+            chunk = process.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        err = process.stderr.read()
+        process.wait()
+        if process.returncode != 0:
+            log.debug('Error executing adb command: adb {}\n'.format(params) + err.decode('utf-8'))
+            raise AdbError('Error executing adb command: adb {}\n'.format(params) + err.decode('utf-8'))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
 class CheckWaylandServiceEndpoint(RequestEndpoint):
     _listDevicesEndpoint = None
 
@@ -517,36 +555,52 @@ class DeviceRequestEndpoint(RequestEndpoint):
         return json.loads(server.rfile.read(length).decode("utf-8"))
 
 
+def get_target_files(target: str):
+    if target in TRACE_TARGETS:
+        return TRACE_TARGETS[target].files
+    elif target in DUMP_TARGETS:
+        return DUMP_TARGETS[target].files
+    raise BadRequest("Unknown file specified")
+
+
+def find_target_files(files, device_id):
+    """Returns the (file type, device path) pairs of all matchers, in order.
+
+    Each matcher runs its own adb commands, so they are resolved concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        paths = list(executor.map(lambda f: f.get_filepaths(device_id), files))
+    return [(f.get_filetype(), file_path)
+            for f, file_paths in zip(files, paths) for file_path in file_paths]
+
+
+def fetch_file(file_path: str, device_id: str) -> bytes:
+    with NamedTemporaryFile() as tmp:
+        log.debug(
+            f"Fetching file {file_path} from device to {tmp.name}")
+        call_adb_outfile('exec-out su root cat ' +
+                         file_path, tmp, device_id)
+        log.debug(f"Deleting file {file_path} from device")
+        call_adb('shell su root rm ' + file_path, device_id)
+        log.debug(f"Uploading file {tmp.name}")
+        return tmp.read()
+
+
 class FetchFilesEndpoint(DeviceRequestEndpoint):
     def process_with_device(self, server, path, device_id):
         if len(path) != 1:
             raise BadRequest("File not specified")
-        if path[0] in TRACE_TARGETS:
-            files = TRACE_TARGETS[path[0]].files
-        elif path[0] in DUMP_TARGETS:
-            files = DUMP_TARGETS[path[0]].files
-        else:
-            raise BadRequest("Unknown file specified")
+        target_files = find_target_files(get_target_files(path[0]), device_id)
 
         file_buffers = dict()
 
-        for f in files:
-            file_type = f.get_filetype()
-            file_paths = f.get_filepaths(device_id)
-
-            for file_path in file_paths:
-                with NamedTemporaryFile() as tmp:
-                    log.debug(
-                        f"Fetching file {file_path} from device to {tmp.name}")
-                    call_adb_outfile('exec-out su root cat ' +
-                                     file_path, tmp, device_id)
-                    log.debug(f"Deleting file {file_path} from device")
-                    call_adb('shell su root rm ' + file_path, device_id)
-                    log.debug(f"Uploading file {tmp.name}")
-                    if file_type not in file_buffers:
-                        file_buffers[file_type] = []
-                    buf = base64.encodebytes(tmp.read()).decode("utf-8")
-                    file_buffers[file_type].append(buf)
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            contents = executor.map(lambda t: fetch_file(t[1], device_id), target_files)
+            for (file_type, _), content in zip(target_files, contents):
+                if file_type not in file_buffers:
+                    file_buffers[file_type] = []
+                buf = base64.encodebytes(content).decode("utf-8")
+                file_buffers[file_type].append(buf)
 
         if (len(file_buffers) == 0):
             log.error("Proxy didn't find any file to fetch")
@@ -557,6 +611,87 @@ class FetchFilesEndpoint(DeviceRequestEndpoint):
         server.respond(HTTPStatus.OK, j.encode("utf-8"), "text/json")
 
 
+class FrameWriter:
+    """Writes the framing of the streamed fetch response.
+
+    Every frame is a one byte tag, the little endian 32-bit payload length and
+    the payload:
+        F <file type>  starts a new file, followed by its C frames
+        C <data>       a chunk of the current file
+        E <message>    an error, ends the stream
+        D              end of the stream
+
+    The frames are optionally gzip compressed on the fly as the response body.
+    """
+
+    def __init__(self, out, compress: bool) -> None:
+        self.out = out
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def __write(self, data: bytes) -> None:
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            self.out.write(data)
+
+    def frame(self, tag: bytes, payload: bytes = b'') -> None:
+        self.__write(tag + struct.pack('<I', len(payload)))
+        self.__write(payload)
+
+    def close(self) -> None:
+        if self.compressor:
+            self.out.write(self.compressor.flush())
+        self.out.flush()
+
+
+class FetchFilesStreamEndpoint(DeviceRequestEndpoint):
+    """Streams the trace files straight from the device to the client.
+
+    Unlike FetchFilesEndpoint, the files are never buffered on the host, so
+    the proxy memory stays constant no matter how big the traces are.
+    Appending /gzip to the path compresses the response on the fly.
+    """
+
+    def process_with_device(self, server, path, device_id):
+        if len(path) not in (1, 2) or (len(path) == 2 and path[1] != 'gzip'):
+            raise BadRequest("File not specified")
+        target_files = find_target_files(get_target_files(path[0]), device_id)
+        compress = len(path) == 2
+
+        # The length is unknown until the last file is sent, so the end of the
+        # body is marked by closing the connection.
+        server.send_response(HTTPStatus.OK)
+        server.send_header('Content-type', 'application/octet-stream')
+        if compress:
+            server.send_header('Content-Encoding', 'gzip')
+        server.send_header('Connection', 'close')
+        add_standard_headers(server)
+        server.close_connection = True
+
+        writer = FrameWriter(server.wfile, compress)
+        try:
+            for file_type, file_path in target_files:
+                log.debug(f"Streaming file {file_path} from device")
+                writer.frame(b'F', file_type.encode('utf-8'))
+                for chunk in stream_adb('exec-out su root cat ' + file_path, device_id):
+                    writer.frame(b'C', chunk)
+                log.debug(f"Deleting file {file_path} from device")
+                call_adb('shell su root rm ' + file_path, device_id)
+        except ConnectionError:
+            log.warning("Client closed the connection while streaming")
+            return
+        except Exception as ex:
+            # The status line is already sent, so report the error in-band.
+            error = str(ex) if isinstance(ex, AdbError) else repr(ex)
+            log.error("Streaming failed: " + error)
+            writer.frame(b'E', error.encode('utf-8'))
+        else:
+            if not target_files:
+                log.error("Proxy didn't find any file to fetch")
+            writer.frame(b'D')
+        writer.close()
+
+
 def check_root(device_id):
     log.debug("Checking root access on {}".format(device_id))
     return int(call_adb('shell su root id -u', device_id)) == 0
@@ -566,6 +701,18 @@ TRACE_THREADS = {}
 
 
 class TraceThread(threading.Thread):
+    WAIT_FOR_CLEANUP_COMMAND = """
+for i in $(seq 50); do
+  if [ "$(su root cat /data/local/tmp/winscope_status 2>/dev/null)" = "TRACE_OK" ]; then
+    su root rm /data/local/tmp/winscope_status
+    echo "TRACE_OK"
+    exit 0
+  fi
+  sleep 0.1
+done
+echo "TRACE_TIMEOUT"
+"""
+
     def __init__(self, device_id, command):
         self._keep_alive_timer = None
         self.trace_command = command
@@ -622,17 +769,15 @@ class TraceThread(threading.Thread):
         self.reset_timer()
         self.out, self.err = self.process.communicate(self.trace_command)
         log.debug("Trace ended on {}, waiting for cleanup".format(self._device_id))
-        time.sleep(0.2)
-        for i in range(50):
-            if call_adb("shell su root cat /data/local/tmp/winscope_status", device=self._device_id) == 'TRACE_OK\n':
-                call_adb(
-                    "shell su root rm /data/local/tmp/winscope_status", device=self._device_id)
-                log.debug("Trace finished successfully on {}".format(
-                    self._device_id))
-                self._success = True
-                break
-            log.debug("Still waiting for cleanup on {}".format(self._device_id))
-            time.sleep(0.1)
+        # Wait on the device, so that a single adb command covers all checks.
+        status = call_adb("shell", device=self._device_id,
+                          stdin=TraceThread.WAIT_FOR_CLEANUP_COMMAND.encode('utf-8'))
+        if status.strip() == 'TRACE_OK':
+            log.debug("Trace finished successfully on {}".format(
+                self._device_id))
+            self._success = True
+        else:
+            log.debug("Timed out waiting for cleanup on {}".format(self._device_id))
 
     def success(self):
         return self._success
@@ -806,11 +951,13 @@ class WindowManagerSelectedConfigTrace(DeviceRequestEndpoint):
 
 class StatusEndpoint(DeviceRequestEndpoint):
     def process_with_device(self, server, path, device_id):
-        if device_id not in TRACE_THREADS:
+        # Requests are served concurrently, so the trace may end meanwhile.
+        trace_thread = TRACE_THREADS.get(device_id)
+        if trace_thread is None:
             raise BadRequest("No trace in progress for {}".format(device_id))
-        TRACE_THREADS[device_id].reset_timer()
+        trace_thread.reset_timer()
         server.respond(HTTPStatus.OK, str(
-            TRACE_THREADS[device_id].is_alive()).encode("utf-8"), "text/plain")
+            trace_thread.is_alive()).encode("utf-8"), "text/plain")
 
 
 class DumpEndpoint(DeviceRequestEndpoint):
@@ -850,6 +997,8 @@ class ADBWinscopeProxy(BaseHTTPRequestHandler):
             RequestType.GET, "status", StatusEndpoint())
         self.router.register_endpoint(
             RequestType.GET, "fetch", FetchFilesEndpoint())
+        self.router.register_endpoint(
+            RequestType.GET, "fetchstream", FetchFilesStreamEndpoint())
         self.router.register_endpoint(RequestType.POST, "start", StartTrace())
         self.router.register_endpoint(RequestType.POST, "end", EndTrace())
         self.router.register_endpoint(RequestType.POST, "dump", DumpEndpoint())
@@ -889,7 +1038,7 @@ class ADBWinscopeProxy(BaseHTTPRequestHandler):
 if __name__ == '__main__':
     print("Winscope ADB Connect proxy version: " + VERSION)
     print('Winscope token: ' + secret_token)
-    httpd = HTTPServer(('localhost', PORT), ADBWinscopeProxy)
+    httpd = ThreadingHTTPServer(('localhost', PORT), ADBWinscopeProxy)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
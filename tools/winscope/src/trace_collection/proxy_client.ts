@@ -40,6 +40,7 @@ export enum ProxyEndpoint {
   SELECTED_SF_CONFIG_TRACE = '/selectedsfconfigtrace/',
   DUMP = '/dump/',
   FETCH = '/fetch/',
+  FETCH_STREAM = '/fetchstream/',
   STATUS = '/status/',
   CHECK_WAYLAND = '/checkwayland/',
 }
@@ -212,35 +213,66 @@ class ProxyRequest {
     }
   };
 
-  async fetchFiles(dev: string, adbParams: AdbParams): Promise<void> {
+  async fetchFiles(dev: string, adbParams: AdbParams): Promise<File[]> {
     const files = adbParams.files;
     const idx = adbParams.idx;
+    let fetched: File[] = [];
 
     await proxyRequest.call(
       'GET',
-      `${ProxyEndpoint.FETCH}${dev}/${files[idx]}/`,
+      `${ProxyEndpoint.FETCH_STREAM}${dev}/${files[idx]}/`,
       async (request: XMLHttpRequest) => {
         try {
-          const enc = new TextDecoder('utf-8');
-          const resp = enc.decode(request.response);
-          const filesByType = JSON.parse(resp);
-
-          for (const filetype of Object.keys(filesByType)) {
-            const files = filesByType[filetype];
-            for (const encodedFileBuffer of files) {
-              const buffer = Uint8Array.from(atob(encodedFileBuffer), (c) => c.charCodeAt(0));
-              const blob = new Blob([buffer]);
-              const newFile = new File([blob], filetype);
-              proxyClient.adbData.push(newFile);
-            }
-          }
+          fetched = proxyRequest.parseFetchStream(request.response);
         } catch (error) {
-          proxyClient.setState(ProxyState.ERROR, request.responseText);
+          proxyClient.setState(ProxyState.ERROR, String(error));
           throw error;
         }
       },
       'arraybuffer'
     );
+    return fetched;
+  }
+
+  // Splits the framed response of the fetchstream endpoint into files. Every
+  // frame is a tag byte, a little endian uint32 payload length and the payload.
+  parseFetchStream(response: ArrayBuffer): File[] {
+    const files: File[] = [];
+    const view = new DataView(response);
+    const decoder = new TextDecoder('utf-8');
+    let fileType: string | undefined;
+    let chunks: Uint8Array[] = [];
+    const flush = () => {
+      if (fileType !== undefined) {
+        files.push(new File([new Blob(chunks)], fileType));
+      }
+      chunks = [];
+    };
+
+    let offset = 0;
+    while (offset + 5 <= response.byteLength) {
+      const tag = String.fromCharCode(view.getUint8(offset));
+      const length = view.getUint32(offset + 1, true);
+      const payload = new Uint8Array(response, offset + 5, length);
+      offset += 5 + length;
+      switch (tag) {
+        case 'F':
+          flush();
+          fileType = decoder.decode(payload);
+          break;
+        case 'C':
+          chunks.push(payload);
+          break;
+        case 'E':
+          throw new Error(decoder.decode(payload));
+        case 'D':
+          flush();
+          return files;
+        default:
+          throw new Error(`Unknown frame ${tag} in proxy response`);
+      }
+    }
+    throw new Error('Truncated proxy response');
   }
 }
 export const proxyRequest = new ProxyRequest();
@@ -254,7 +286,7 @@ interface AdbParams {
 // stores all the changing variables from proxy and sets up calls from ProxyRequest
 export class ProxyClient {
   readonly WINSCOPE_PROXY_URL = 'http://localhost:5544';
-  readonly VERSION = '1.0';
+  readonly VERSION = '1.1';
   state: ProxyState = ProxyState.CONNECTING;
   stateChangeListeners: Array<{(param: ProxyState, errorText: string): void}> = [];
   refresh_worker: NodeJS.Timer | null = null;
@@ -299,14 +331,24 @@ export class ProxyClient {
   }
 
   async updateAdbData(files: string[], traceType: string, progressCallback: OnProgressUpdateType) {
-    for (let idx = 0; idx < files.length; idx++) {
-      const adbParams = {
-        files,
-        idx,
-        traceType,
-      };
-      await proxyRequest.fetchFiles(this.selectedDevice, adbParams);
-      progressCallback((100 * (idx + 1)) / files.length);
+    // The proxy serves requests concurrently, so fetch all targets at once and
+    // keep the files in the requested order.
+    let done = 0;
+    const fetched = await Promise.all(
+      files.map(async (file, idx) => {
+        const adbParams = {
+          files,
+          idx,
+          traceType,
+        };
+        const result = await proxyRequest.fetchFiles(this.selectedDevice, adbParams);
+        done++;
+        progressCallback((100 * done) / files.length);
+        return result;
+      })
+    );
+    for (const targetFiles of fetched) {
+      this.adbData.push(...targetFiles);
     }
   }
 }
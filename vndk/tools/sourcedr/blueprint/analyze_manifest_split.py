@@ -60,9 +60,9 @@ class DirProjectMatcher(object):
         return None
 
 
-def parse_blueprint(root_bp_path):
+def parse_blueprint(root_bp_path, jobs=1, cache_path=None):
     """Parse Android.bp files."""
-    parser = RecursiveParser()
+    parser = RecursiveParser(jobs, cache_path)
     parser.parse_file(root_bp_path)
     parsed_items = evaluate_defaults(parser.modules)
     return fill_module_namespaces(root_bp_path, parsed_items)
@@ -119,6 +119,10 @@ def _parse_args():
                         help='Path to root Android.bp')
     parser.add_argument('-m', '--manifest', required=True,
                         help='Path to repo manifest xml file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes parsing Android.bp files')
+    parser.add_argument('--cache',
+                        help='Path to a file caching parsed Android.bp files')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--skip-no-overlaps', action='store_true',
                        help='Skip projects without overlaps')
@@ -153,7 +157,7 @@ def main():
 
     has_error = False
 
-    for rule, attrs in parse_blueprint(args.blueprint):
+    for rule, attrs in parse_blueprint(args.blueprint, args.jobs, args.cache):
         path = _get_property(attrs, '_path')[root_prefix_len:]
         project = dir_matcher.find(path)
         if project is None:
@@ -18,10 +18,14 @@
 
 """This module implements a Android.bp parser."""
 
+import bisect
 import collections
 import glob
+import hashlib
 import itertools
+import multiprocessing
 import os
+import pickle
 import re
 import sys
 
@@ -117,11 +121,13 @@ class Token(Enum):  # pylint: disable=too-few-public-methods
 class LexerError(ValueError):
     """Lexer error exception class."""
 
-    def __init__(self, buf, pos, message):
+    def __init__(self, buf, pos, message, line_column=None):
         """Create a lexer error exception object."""
         super(LexerError, self).__init__(message)
         self.message = message
-        self.line, self.column = Lexer.compute_line_column(buf, pos)
+        if line_column is None:
+            line_column = Lexer.compute_line_column(buf, pos)
+        self.line, self.column = line_column
 
 
     def __str__(self):
@@ -149,6 +155,9 @@ class Lexer(object):
         self.literal = None
         self.path = path
 
+        # Start positions of the lines found so far. See line_column().
+        self._line_starts = [0]
+
         self._next()
 
 
@@ -160,22 +169,48 @@ class Lexer(object):
                 self._next()
             else:
                 raise LexerError(self.buf, self.start,
-                                 'unexpected token ' + self.token.name)
+                                 'unexpected token ' + self.token.name,
+                                 self.line_column(self.start))
 
 
     def _next(self):
         """Read next non-comment non-space token."""
 
-        buf_len = len(self.buf)
-        while self.end < buf_len:
-            self.start = self.end
-            self.token, self.end, self.literal = self.lex(self.buf, self.start)
-            if self.token != Token.SPACE and self.token != Token.COMMENT:
-                return
+        buf = self.buf
+        match = self.NEXT_TOKEN_MATCHER.match(buf, self.end)
+        if not match:
+            pos = self.SKIP_MATCHER.match(buf, self.end).end()
+            raise LexerError(buf, pos, 'unknown token', self.line_column(pos))
+
+        group = match.lastgroup
+        self.start = match.start(group)
+        self.end = match.end()
+        self.token = self.NEXT_TOKEN_GROUPS[group]
+        if group == 'STRING':
+            self.literal = buf[self.start + 1:self.end - 1]
+        elif group == 'STRING_START':
+            self.end, self.literal = self.lex_string(buf, self.start)
+        elif group == 'IDENT' or group == 'INTEGER':
+            self.literal = match.group(group)
+        else:
+            self.literal = None
 
-        self.start = self.end
-        self.token = Token.EOF
-        self.literal = None
+
+    def line_column(self, pos):
+        """Compute the line number and the column number of a given position.
+
+        Unlike compute_line_column(), the line starts are only scanned once,
+        so this is cheap to call for many positions."""
+
+        line_starts = self._line_starts
+        if pos > line_starts[-1]:
+            buf = self.buf
+            newline_pos = buf.find('\n', line_starts[-1])
+            while newline_pos != -1 and newline_pos < pos:
+                line_starts.append(newline_pos + 1)
+                newline_pos = buf.find('\n', newline_pos + 1)
+        line = bisect.bisect_right(line_starts, pos)
+        return (line, pos - line_starts[line - 1] + 1)
 
 
     @staticmethod
@@ -183,11 +218,10 @@ class Lexer(object):
         """Compute the line number and the column number of a given position in
         the buffer."""
 
-        prior = buf[0:pos]
-        newline_pos = prior.rfind('\n')
+        newline_pos = buf.rfind('\n', 0, pos)
         if newline_pos == -1:
             return (1, pos + 1)
-        return (prior.count('\n') + 1, pos - newline_pos)
+        return (buf.count('\n', 0, pos) + 1, pos - newline_pos)
 
 
     UNICODE_CHARS_PATTERN = re.compile('[^\\\\\\n"]+')
@@ -344,6 +378,48 @@ class Lexer(object):
         '(' + pattern + ')' for _, pattern in LEXER_PATTERNS))
 
 
+    # Spaces and comments skipped before a token. Every alternative consumes
+    # input in one way only, so a failed match neither backtracks
+    # exponentially nor ends in the middle of a comment.
+    SKIP_PATTERN = \
+        '(?:\\s|//[^\\n]*(?![^\\n])|/\\*[^*]*\\*+(?:[^/*][^*]*\\*+)*/)*'
+
+
+    SKIP_MATCHER = re.compile(SKIP_PATTERN)
+
+
+    # Token patterns for _next(), which finds the next token with a single
+    # match. STRING matches the strings without escape sequences whose
+    # literal is the text between the quotes. Other strings start with
+    # STRING_START and are decoded by lex_string().
+    NEXT_TOKEN_PATTERNS = (
+        ('IDENT', Token.IDENT, '[A-Za-z_][0-9A-Za-z_]*'),
+        ('STRING', Token.STRING, '"[^"\\\\\\n]*"|`[^`]*`'),
+        ('STRING_START', Token.STRING, '["`]'),
+        ('LPAREN', Token.LPAREN, '\\('),
+        ('RPAREN', Token.RPAREN, '\\)'),
+        ('LBRACKET', Token.LBRACKET, '\\['),
+        ('RBRACKET', Token.RBRACKET, '\\]'),
+        ('LBRACE', Token.LBRACE, '\\{'),
+        ('RBRACE', Token.RBRACE, '\\}'),
+        ('COLON', Token.COLON, ':'),
+        ('ASSIGN', Token.ASSIGN, '='),
+        ('ASSIGNPLUS', Token.ASSIGNPLUS, '\\+='),
+        ('PLUS', Token.PLUS, '\\+'),
+        ('COMMA', Token.COMMA, ','),
+        ('INTEGER', Token.INTEGER, '-{0,1}[0-9]+'),
+        ('EOF', Token.EOF, '\\Z'),
+    )
+
+
+    NEXT_TOKEN_MATCHER = re.compile(SKIP_PATTERN + '(?:' + '|'.join(
+        '(?P<' + name + '>' + pattern + ')'
+        for name, _, pattern in NEXT_TOKEN_PATTERNS) + ')')
+
+
+    NEXT_TOKEN_GROUPS = {name: token for name, token, _ in NEXT_TOKEN_PATTERNS}
+
+
     @classmethod
     def lex(cls, buf, offset):
         """Tokenize a token from buf[offset].
@@ -561,7 +637,7 @@ class ParseError(ValueError):
         super(ParseError, self).__init__(message)
         self.message = message
         self.line, self.column = \
-            Lexer.compute_line_column(lexer.buf, lexer.start)
+            lexer.line_column(lexer.start)
 
 
     def __str__(self):
@@ -757,10 +833,20 @@ class RecursiveParser(object):
     _DEFAULT_SUB_NAME = 'Android.bp'
 
 
-    def __init__(self):
-        """Initialize a recursive parser."""
+    def __init__(self, jobs=1, cache_path=None):
+        """Initialize a recursive parser.
+
+        Args:
+            jobs: Number of processes parsing the files found by scanning the
+                source tree.
+            cache_path: Path to a file which keeps the parsed files between
+                runs, or None to disable the cache.
+        """
         self.visited = set()
         self.modules = []
+        self.jobs = jobs
+        self.cache_path = cache_path
+        self._file_modules = []
 
 
     @staticmethod
@@ -819,6 +905,7 @@ class RecursiveParser(object):
         if evaluate:
             modules = [(ident, attrs.eval(env)) for ident, attrs in modules]
         self.modules += modules
+        self._file_modules.append((path, modules))
         return sub_env
 
 
@@ -845,20 +932,18 @@ class RecursiveParser(object):
         return sub_env
 
 
-    def _scan_and_parse_all_file_recursive(self, filename, path, env, evaluate):
-        """Scan all files with the specified name and parse them."""
-
-        rootdir = os.path.dirname(path)
-        assert rootdir, 'rootdir is empty but must be non-empty'
+    @staticmethod
+    def _scan_all_files(filename, rootdir):
+        """Find all files with the specified name in one pass and return a
+        list of (path, index of the file in the nearest parent directory)."""
 
-        envs = [(rootdir, env)]
-        assert env is not None
+        files = []
+        parents = [(rootdir, None)]
 
-        # Scan directories for all blueprint files
         for basedir, dirnames, filenames in os.walk(rootdir):
-            # Drop irrelevant environments
-            while not basedir.startswith(envs[-1][0]):
-                envs.pop()
+            # Drop irrelevant parents
+            while not basedir.startswith(parents[-1][0]):
+                parents.pop()
 
             # Filter sub directories
             if '.out-dir' in filenames:
@@ -874,17 +959,75 @@ class RecursiveParser(object):
                 new_dirnames.append(name)
             dirnames[:] = new_dirnames
 
-            # Parse blueprint files
             if filename in filenames:
-                try:
-                    path = os.path.join(basedir, filename)
-                    sys.stdout.flush()
-                    sub_env = self._parse_file_recursive(path, envs[-1][1],
-                                                         evaluate, False)
-                    assert sub_env is not None
-                    envs.append((basedir, sub_env))
-                except IOError:
-                    pass
+                files.append((os.path.join(basedir, filename), parents[-1][1]))
+                parents.append((basedir, len(files) - 1))
+        return files
+
+
+    def _scan_and_parse_all_file_recursive(self, filename, path, env, evaluate):
+        """Scan all files with the specified name and parse them."""
+
+        rootdir = os.path.dirname(path)
+        assert rootdir, 'rootdir is empty but must be non-empty'
+        assert env is not None
+
+        files = self._scan_all_files(filename, rootdir)
+
+        # A file inherits the environment of the file in the nearest parent
+        # directory, so parse the files in waves by depth. The files of a wave
+        # are independent of each other and are parsed concurrently.
+        depths = []
+        for _, parent in files:
+            depths.append(0 if parent is None else depths[parent] + 1)
+
+        results = [None] * len(files)
+
+        def _get_env(index):
+            while index is not None:
+                if results[index] is not None:
+                    return results[index][1]
+                index = files[index][1]
+            return env
+
+        cache = _ParseCache(self.cache_path, evaluate)
+        pool = multiprocessing.Pool(self.jobs) if self.jobs > 1 else None
+        try:
+            for depth in range(max(depths) + 1 if depths else 0):
+                indices = [i for i, file_depth in enumerate(depths)
+                           if file_depth == depth]
+                tasks = []
+                for i in indices:
+                    file_path, file_env = files[i][0], _get_env(files[i][1])
+                    results[i] = cache.get(file_path, file_env)
+                    if results[i] is None:
+                        tasks.append((i, (file_path, file_env, evaluate,
+                                          cache.path is not None)))
+                args = [task for _, task in tasks]
+                if pool:
+                    parsed = pool.map(_parse_scanned_file, args, chunksize=8)
+                else:
+                    parsed = [_parse_scanned_file(arg) for arg in args]
+                for (i, (file_path, file_env, _, _)), result in \
+                        zip(tasks, parsed):
+                    results[i] = cache.put(file_path, file_env, result)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        cache.save()
+
+        # Merge the results in the scanning order.
+        for result in results:
+            if result is None:
+                continue
+            file_modules = result[0]
+            for i, (file_path, modules) in enumerate(file_modules):
+                if i > 0 and file_path in self.visited:
+                    continue
+                self.visited.add(file_path)
+                self.modules += modules
+                self._file_modules.append((file_path, modules))
 
 
     def parse_file(self, path, env=None, evaluate=True,
@@ -905,6 +1048,114 @@ class RecursiveParser(object):
                 default_sub_name, path, env, evaluate)
 
 
+def _parse_scanned_file(args):
+    """Parse a scanned file and the files it includes in a worker process.
+
+    Returns the (path, modules) list, the environment for the files in sub
+    directories and the stamps of the parsed files, or None if the file can't
+    be read.  The stamps are only computed if the result will be cached."""
+
+    path, env, evaluate, with_stamps = args
+    parser = RecursiveParser()
+    try:
+        sub_env = parser._parse_file_recursive(path, env, evaluate, False)
+    except IOError:
+        return None
+    stamps = None
+    if with_stamps:
+        stamps = [_ParseCache.get_stamp(file_path)
+                  for file_path, _ in parser._file_modules]
+    return (parser._file_modules, sub_env, stamps)
+
+
+class _ParseCache(object):
+    """Keeps the results of _parse_scanned_file() between runs.
+
+    A result is reused if the inherited environment is the same and all
+    parsed files have the same modification time or the same content hash.
+    """
+
+    _VERSION = 1
+
+
+    def __init__(self, path, evaluate):
+        self.path = path
+        self.evaluate = evaluate
+        self.entries = {}
+        self.used_entries = {}
+        self.dirty = False
+        if path is None:
+            return
+        try:
+            with open(path, 'rb') as cache_file:
+                version, entries = pickle.load(cache_file)
+            if version == self._VERSION:
+                self.entries = entries
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+
+    @staticmethod
+    def get_stamp(path):
+        """Return the (path, mtime, size, content hash) of a file."""
+        stat = os.stat(path)
+        with open(path, 'rb') as input_file:
+            digest = hashlib.sha1(input_file.read()).hexdigest()
+        return (path, stat.st_mtime, stat.st_size, digest)
+
+
+    @staticmethod
+    def _is_up_to_date(stamp):
+        path, mtime, size, digest = stamp
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime == mtime and stat.st_size == size:
+                return True
+            return _ParseCache.get_stamp(path)[3] == digest
+        except (IOError, OSError):
+            return False
+
+
+    def _get_key(self, env):
+        return hashlib.sha1(pickle.dumps(
+            (self.evaluate, sorted(env.items())), 2)).hexdigest()
+
+
+    def get(self, path, env):
+        """Return the cached result for a file or None."""
+        if self.path is None:
+            return None
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != self._get_key(env):
+            return None
+        result = entry[1]
+        if not all(self._is_up_to_date(stamp) for stamp in result[2]):
+            return None
+        self.used_entries[path] = entry
+        return result
+
+
+    def put(self, path, env, result):
+        """Add a new result to the cache and return it."""
+        if self.path is not None and result is not None:
+            self.used_entries[path] = (self._get_key(env), result)
+            self.dirty = True
+        return result
+
+
+    def save(self):
+        """Write the results of this run, dropping the unused ones."""
+        if self.path is None:
+            return
+        if not self.dirty and len(self.used_entries) == len(self.entries):
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump((self._VERSION, self.used_entries), cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+
 #------------------------------------------------------------------------------
 # Transformation
 #------------------------------------------------------------------------------
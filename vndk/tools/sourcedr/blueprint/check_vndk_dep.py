@@ -96,6 +96,10 @@ def _parse_args():
                         help='path to Android.bp in ANDROID_BUILD_TOP')
     parser.add_argument('--namespace', action='append', default=[''],
                         help='extra module namespaces')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes parsing blueprint files')
+    parser.add_argument('--cache',
+                        help='path to a file caching parsed blueprint files')
     return parser.parse_args()
 
 
@@ -105,7 +109,7 @@ def main():
     args = _parse_args()
 
     module_dicts = vndk.ModuleClassifier.create_from_root_bp(
-        args.root_bp, args.namespace)
+        args.root_bp, args.namespace, args.jobs, args.cache)
 
     all_bad_deps = _check_modules_deps(module_dicts)
     for name, bad_deps in all_bad_deps:
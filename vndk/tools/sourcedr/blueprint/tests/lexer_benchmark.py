@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Microbenchmark for the Lexer.
+
+Tokenizes the test data (or the files given on the command line) with the
+Lexer class, which finds each token with a single match, and with a loop over
+Lexer.lex(), which matches spaces and comments as separate tokens.
+
+Usage:
+    python3 tests/lexer_benchmark.py [-n REPEAT] [FILE ...]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blueprint import Lexer, Token  # pylint: disable=wrong-import-position
+
+
+def _find_testdata():
+    """List the files in the testdata directory."""
+    testdata_dir = os.path.join(os.path.dirname(__file__), 'testdata')
+    paths = []
+    for basedir, _, filenames in os.walk(testdata_dir):
+        paths.extend(os.path.join(basedir, name) for name in sorted(filenames))
+    return sorted(paths)
+
+
+def lex_with_lexer(buf):
+    """Count the tokens with the Lexer class."""
+    lexer = Lexer(buf)
+    count = 0
+    while lexer.token != Token.EOF:
+        lexer.consume(lexer.token)
+        count += 1
+    return count
+
+
+def lex_with_lex(buf):
+    """Count the tokens with a Lexer.lex() loop."""
+    pos = 0
+    count = 0
+    buf_len = len(buf)
+    while pos < buf_len:
+        token, pos, _ = Lexer.lex(buf, pos)
+        if token != Token.SPACE and token != Token.COMMENT:
+            count += 1
+    return count
+
+
+def _bench(name, func, bufs, repeat):
+    """Run func over all buffers and print the token throughput."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = sum(func(buf) for buf in bufs)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:16} {:8d} tokens {:10.3f} ms {:12.0f} tokens/s'.format(
+        name, count, best * 1000, count / best if best else 0))
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*',
+                        help='files to tokenize (default: tests/testdata)')
+    parser.add_argument('-n', '--repeat', type=int, default=200,
+                        help='number of runs (the best one is reported)')
+    args = parser.parse_args()
+
+    bufs = []
+    for path in args.files or _find_testdata():
+        with open(path, 'r') as input_file:
+            bufs.append(input_file.read())
+
+    _bench('Lexer', lex_with_lexer, bufs, args.repeat)
+    _bench('Lexer.lex()', lex_with_lex, bufs, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""This module contains the unit tests to check the parallel and cached
+parsing of RecursiveParser."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import blueprint
+from blueprint import RecursiveParser
+
+
+#------------------------------------------------------------------------------
+# Scanning Recursive Parser
+#------------------------------------------------------------------------------
+
+class ScanAndParseTest(unittest.TestCase):
+    """Test cases for parsing all blueprint files under a directory."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root_bp = self._write('Android.bp', '')
+        self._write('a/Android.bp', 'x = ["1"]\n'
+                                    'cc_library { name: "liba", srcs: x }\n')
+        self._write('a/b/Android.bp', 'x += ["2"]\n'
+                                      'cc_library { name: "libb", srcs: x }\n')
+        self._write('c/Android.bp', 'cc_library { name: "libc" }\n')
+        self._write('out/Android.bp', 'cc_library { name: "libout" }\n')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, path, content):
+        path = os.path.join(self.tmp_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as bp_file:
+            bp_file.write(content)
+        return path
+
+
+    def _parse(self, **kwargs):
+        parser = RecursiveParser(**kwargs)
+        parser.parse_file(self.root_bp)
+        return [(attrs['name'], list(attrs.get('srcs', [])))
+                for ident, attrs in parser.modules]
+
+
+    def test_serial(self):
+        self.assertEqual(
+            [('liba', ['1']), ('libb', ['1', '2']), ('libc', [])],
+            sorted(self._parse()))
+
+
+    def test_parallel(self):
+        self.assertEqual(self._parse(), self._parse(jobs=2))
+
+
+    def test_cache(self):
+        cache_path = os.path.join(self.tmp_dir, 'cache')
+        expected = self._parse()
+        self.assertEqual(expected, self._parse(cache_path=cache_path))
+        self.assertTrue(os.path.exists(cache_path))
+        self.assertEqual(expected, self._parse(cache_path=cache_path))
+
+        # Changes to a file invalidate the files inheriting its variables.
+        self._write('a/Android.bp', 'x = ["3", "4"]\n'
+                                    'cc_library { name: "liba", srcs: x }\n')
+        modules = dict(self._parse(cache_path=cache_path))
+        self.assertEqual(['3', '4', '2'], modules['libb'])
+
+
+    def test_no_stamps_without_cache(self):
+        def _get_stamp(path):
+            raise AssertionError('unexpected stamp of ' + path)
+
+        get_stamp = blueprint._ParseCache.get_stamp
+        blueprint._ParseCache.get_stamp = staticmethod(_get_stamp)
+        try:
+            self.assertEqual(3, len(self._parse()))
+        finally:
+            blueprint._ParseCache.get_stamp = staticmethod(get_stamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
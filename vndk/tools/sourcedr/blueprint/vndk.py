@@ -173,12 +173,13 @@ class ModuleClassifier(object):
                 continue
 
 
-    def parse_root_bp(self, root_bp_path, namespaces=None):
+    def parse_root_bp(self, root_bp_path, namespaces=None, jobs=1,
+                      cache_path=None):
         """Parse blueprint files and add module definitions."""
 
         namespaces = {''} if namespaces is None else set(namespaces)
 
-        parser = RecursiveParser()
+        parser = RecursiveParser(jobs, cache_path)
         parser.parse_file(root_bp_path)
         parsed_items = evaluate_defaults(parser.modules)
         parsed_items = fill_module_namespaces(root_bp_path, parsed_items)
@@ -187,8 +188,9 @@ class ModuleClassifier(object):
 
 
     @classmethod
-    def create_from_root_bp(cls, root_bp_path, namespaces=None):
+    def create_from_root_bp(cls, root_bp_path, namespaces=None, jobs=1,
+                            cache_path=None):
         """Create a ModuleClassifier from a root blueprint file."""
         result = cls()
-        result.parse_root_bp(root_bp_path, namespaces)
+        result.parse_root_bp(root_bp_path, namespaces, jobs, cache_path)
         return result
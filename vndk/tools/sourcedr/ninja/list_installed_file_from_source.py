@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import itertools
 import os
 import posixpath
 import re
@@ -23,6 +22,12 @@ def _parse_args():
     parser.add_argument('--cwd', help='working directory for ninja')
     parser.add_argument('--encoding', default='utf-8',
                         help='ninja file encoding')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache lexed ninja files in')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of processes to parse subninja files')
+    parser.add_argument('--compact', action='store_true',
+                        help='store paths as integer IDs to save memory')
 
     # Options
     parser.add_argument(
@@ -55,53 +60,16 @@ def main():
         '|'.join('(?:' + re.escape(posixpath.normpath(path)) + ')'
                  for path in args.source_filter.split(':')))
 
-    manifest = ninja.load_manifest_from_args(args)
-
-    # Build lookup map
-    outs = {}
-    for build in manifest.builds:
-        for path in build.explicit_outs:
-            outs[path] = build
-        for path in build.implicit_outs:
-            outs[path] = build
-
-    # Compute transitive input files
-    outs_from_vendor_cache = {}
-
-    def _are_inputs_from_vendor(build):
-        # Check whether the input files are matched by source_filter first.
-        gen_paths = []
-        paths = itertools.chain(
-            build.explicit_ins, build.implicit_ins, build.depfile_implicit_ins)
-        for path in paths:
-            if source_filter.match(path):
-                return True
-            if out_pattern.match(path):
-                gen_paths.append(path)
-
-        # Check whether the input files transitively depend on source_filter.
-        for path in gen_paths:
-            if is_from_vendor(path):
-                return True
-
-        return False
-
-    def is_from_vendor(out_path):
-        matched = outs_from_vendor_cache.get(out_path, None)
-        if matched is not None:
-            return matched
-
-        build = outs.get(out_path)
-        if build:
-            matched = _are_inputs_from_vendor(build)
-        else:
-            matched = bool(source_filter.match(path))
-        outs_from_vendor_cache[out_path] = matched
-        return matched
+    graph = ninja.load_graph_from_args(args)
+
+    # Collect the outputs which transitively depend on the source files.
+    # Only the files under the output directory are followed.
+    source_paths = [
+        path for path in graph.inputs() if source_filter.match(path)]
+    outs_from_vendor = graph.reverse_reachable(source_paths, out_pattern.match)
 
     matched_paths = [
-        path for path in outs
-        if installed_filter.match(path) and is_from_vendor(path)]
+        path for path in outs_from_vendor if installed_filter.match(path)]
 
     matched_paths.sort()
 
@@ -3,9 +3,9 @@
 """List all transitive build rules of a target."""
 
 import argparse
-import itertools
 import posixpath
 import re
+import sys
 
 try:
     import cPickle as pickle  # Python 2
@@ -26,6 +26,12 @@ def _parse_args():
     parser.add_argument('--cwd', help='working directory for ninja')
     parser.add_argument('--encoding', default='utf-8',
                         help='ninja file encoding')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache lexed ninja files in')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of processes to parse subninja files')
+    parser.add_argument('--compact', action='store_true',
+                        help='store paths as integer IDs to save memory')
 
     # Options
     parser.add_argument('target', help='build target')
@@ -33,49 +39,15 @@ def _parse_args():
     return parser.parse_args()
 
 
-def collect_build_targets(graph, target):
-    """Collect the transitive build targets."""
-
-    # Search for the first target
-    build = graph[target]
-
-    # Collect all source files
-    dfs = [build]
-
-    visited = {build}
-    stack = [build]
-    while stack:
-        build = stack.pop()
-        for dep in itertools.chain(build.explicit_ins, build.implicit_ins,
-                                   build.depfile_implicit_ins):
-            dep = graph.get(dep)
-            if not dep:
-                continue
-            if dep not in visited:
-                visited.add(dep)
-                dfs.append(dep)
-                stack.append(dep)
-
-    return dfs
-
-
 def main():
     args = _parse_args()
 
-    # Build lookup map
-    manifest = ninja.load_manifest_from_args(args)
-    graph = {}
-    for build in manifest.builds:
-        for path in build.explicit_outs:
-            graph[path] = build
-        for path in build.implicit_outs:
-            graph[path] = build
-
     # List all transitive targets
+    graph = ninja.load_graph_from_args(args)
     try:
-        builds = collect_build_targets(graph, args.target)
+        builds = graph.transitive_builds(args.target)
     except KeyError:
-        print('error: Failed to find the target {}'.format(arg.target),
+        print('error: Failed to find the target {}'.format(args.target),
               file=sys.stderr)
         sys.exit(1)
 
@@ -3,7 +3,7 @@
 """List all source file of a installed module."""
 
 import argparse
-import itertools
+import collections
 import posixpath
 import re
 
@@ -26,6 +26,12 @@ def _parse_args():
     parser.add_argument('--cwd', help='working directory for ninja')
     parser.add_argument('--encoding', default='utf-8',
                         help='ninja file encoding')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache lexed ninja files in')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of processes to parse subninja files')
+    parser.add_argument('--compact', action='store_true',
+                        help='store paths as integer IDs to save memory')
 
     # Options
     parser.add_argument(
@@ -37,47 +43,69 @@ def _parse_args():
     return parser.parse_args()
 
 
-def collect_source_files(graph, start, out_dir_pattern, out_host_dir_pattern):
-    """Collect the transitive dependencies of a target."""
+class SourceFileCollector(object):
+    """Collect the transitive dependencies of installed files.
 
-    source_files = []
+    All queries share one skip predicate, so that the graph can reuse the
+    dependencies collected for one target when it reaches them from
+    another.
+    """
 
-    # Extract the file name of the target file.  We need this file name to
-    # allow the strip/copy build rules while leaving other shared libraries
-    # alone.
-    start_basename = posixpath.basename(start)
+    def __init__(self, graph, out_dir_pattern, out_host_dir_pattern):
+        self._graph = graph
+        self._out_dir_pattern = out_dir_pattern
+        self._out_host_dir_pattern = out_host_dir_pattern
 
-    # Collect all source files
-    visited = {start}
-    stack = [start]
-    while stack:
-        cur = stack.pop()
+        # The shared libraries by file name.  We need these to allow the
+        # strip/copy build rules while leaving other shared libraries alone.
+        self._shared_libs = collections.defaultdict(list)
+        for path in graph.inputs():
+            if path.endswith('.so') and not self._is_build_tool(path):
+                self._shared_libs[posixpath.basename(path)].append(path)
 
-        if not out_dir_pattern.match(cur):
-            source_files.append(cur)
 
-        build = graph.get(cur)
-        if build:
-            for dep in itertools.chain(build.explicit_ins, build.implicit_ins,
-                                       build.depfile_implicit_ins):
-                # Skip the binaries for build process
-                if dep.startswith('prebuilts/'):
-                    continue
-                if out_host_dir_pattern.match(dep):
-                    continue
+    def _is_build_tool(self, dep):
+        # Skip the binaries for build process
+        return dep.startswith('prebuilts/') or \
+               bool(self._out_host_dir_pattern.match(dep))
 
-                # Skip the shared libraries
-                if dep.endswith('.toc'):
-                    continue
-                if dep.endswith('.so'):
-                    if posixpath.basename(dep) != start_basename:
-                        continue
 
-                if dep not in visited:
-                    visited.add(dep)
-                    stack.append(dep)
+    def _skip(self, dep):
+        if self._is_build_tool(dep):
+            return True
 
-    return sorted(source_files)
+        # Skip the shared libraries
+        return dep.endswith('.toc') or dep.endswith('.so')
+
+
+    def _is_consumed_by(self, path, outs):
+        return any(out in outs
+                   for build in self._graph.get_consumers(path)
+                   for out in build.explicit_outs + build.implicit_outs)
+
+
+    def collect(self, start):
+        """Collect the source files of a target."""
+
+        # Follow the shared libraries with the file name of the target until
+        # no more of them are reached.
+        deps = set(self._graph.transitive_inputs(start, self._skip))
+        deps.add(start)
+        libs = [path for path in
+                self._shared_libs.get(posixpath.basename(start), ())
+                if path not in deps]
+        found = True
+        while found:
+            found = False
+            for lib in list(libs):
+                if self._is_consumed_by(lib, deps):
+                    libs.remove(lib)
+                    deps.add(lib)
+                    deps.update(self._graph.transitive_inputs(lib, self._skip))
+                    found = True
+
+        return sorted(path for path in deps
+                      if not self._out_dir_pattern.match(path))
 
 
 def main():
@@ -97,23 +125,17 @@ def main():
     installed_filter = re.compile(
         '|'.join('(?:' + p + ')' for p in installed_filter))
 
-    manifest = ninja.load_manifest_from_args(args)
-
-    # Build lookup map
-    graph = {}
-    for build in manifest.builds:
-        for path in build.explicit_outs:
-            graph[path] = build
-        for path in build.implicit_outs:
-            graph[path] = build
+    graph = ninja.load_graph_from_args(args)
 
     # Collect all matching outputs
-    matched_files = [path for path in graph if installed_filter.match(path)]
+    matched_files = [path for path in graph.outputs()
+                     if installed_filter.match(path)]
     matched_files.sort()
 
+    collector = SourceFileCollector(
+            graph, out_dir_pattern, out_host_dir_pattern)
     for path in matched_files:
-        source_files = collect_source_files(
-            graph, path, out_dir_pattern, out_host_dir_pattern)
+        source_files = collector.collect(path)
         print(path)
         for dep in source_files:
             print('\t' + dep)
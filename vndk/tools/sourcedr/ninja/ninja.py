@@ -6,10 +6,15 @@
 from __future__ import print_function
 
 import argparse
+import array
+import codecs
 import collections
+import hashlib
+import itertools
+import mmap
+import multiprocessing
 import os
 import re
-import struct
 import sys
 
 try:
@@ -17,11 +22,6 @@ try:
 except ImportError:
     import pickle  # Python 3
 
-try:
-    from cStringIO import StringIO  # Python 2
-except ImportError:
-    from io import StringIO  # Python 3
-
 try:
     from sys import intern
 except ImportError:
@@ -38,24 +38,130 @@ if sys.version_info < (3,):
 
 
 class EvalEnv(dict):
-    __slots__ = ('parent')
+    """Variable scope.
+
+    Variable lookups through the parent scopes and evaluated variable values
+    are memoized per scope.  All memos are stamped with a global version,
+    which is bumped whenever a scope that may be visible to a memo is
+    mutated or re-parented.  Mutating a scope which is neither memoized nor
+    the parent of another scope keeps the memos.
+    """
+
+    __slots__ = ('_parent', '_shared', '_memo')
+
+    # Global version of all memos.
+    _version = 0
 
 
     def __init__(self, *args, **kwargs):
         super(EvalEnv, self).__init__(*args, **kwargs)
-        self.parent = None
+        self._parent = None
+        self._shared = False
+        self._memo = None
+
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),), (self._parent,))
+
+
+    def __setstate__(self, state):
+        self.parent, = state
+
+
+    def _invalidate(self):
+        if self._shared:
+            EvalEnv._version += 1
+
+
+    @property
+    def parent(self):
+        return self._parent
+
+
+    @parent.setter
+    def parent(self, parent):
+        self._invalidate()
+        if parent is not None:
+            parent._shared = True
+        self._parent = parent
+
+
+    def __setitem__(self, key, value):
+        self._invalidate()
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        self._invalidate()
+        dict.__delitem__(self, key)
+
+
+    def __ior__(self, other):
+        self._invalidate()
+        return dict.__ior__(self, other)
+
+
+    def update(self, *args, **kwargs):
+        self._invalidate()
+        dict.update(self, *args, **kwargs)
+
+
+    def setdefault(self, key, default=None):
+        self._invalidate()
+        return dict.setdefault(self, key, default)
+
+
+    def pop(self, *args):
+        self._invalidate()
+        return dict.pop(self, *args)
+
+
+    def popitem(self):
+        self._invalidate()
+        return dict.popitem(self)
+
+
+    def clear(self):
+        self._invalidate()
+        dict.clear(self)
+
+
+    def _get_memo(self):
+        """Get the memo tuple ``(version, evaluated values, lookups)``."""
+        memo = self._memo
+        if memo is None or memo[0] != EvalEnv._version:
+            self._shared = True
+            memo = self._memo = (EvalEnv._version, {}, {})
+        return memo
 
 
     def get_recursive(self, key, default=None):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # Take the memo even without a parent, so that adding a parent
+        # later invalidates the memos which have seen this scope.
+        lookups = self._get_memo()[2]
+        parent = self._parent
+        if parent is None:
+            return default
+
         try:
-            return self[key]
+            value = lookups[key]
         except KeyError:
-            if self.parent:
-                return self.parent.get_recursive(key, default)
-            return default
+            value = lookups[key] = parent.get_recursive(key)
+        return default if value is None else value
 
 
 class BuildEvalEnv(EvalEnv):
+    """Scope of a build statement.
+
+    Values are evaluated with the bindings of a single build, so nothing is
+    memoized here.  Lookups which fall through to the file scope use the
+    memo of the file scope, which is shared by all builds.
+    """
+
     __slots__ = ('_build_env', '_rule_env')
 
 
@@ -64,20 +170,23 @@ class BuildEvalEnv(EvalEnv):
         self._rule_env = rule_env
 
 
+    def _get_memo(self):
+        return None
+
+
     def get_recursive(self, key, default=None):
-        try:
-            return self._build_env[key]
-        except KeyError:
-            pass
+        value = self._build_env.get(key)
+        if value is not None:
+            return value
 
         if self._rule_env:
-            try:
-                return self._rule_env[key]
-            except KeyError:
-                pass
+            value = self._rule_env.get(key)
+            if value is not None:
+                return value
 
-        if self._build_env.parent:
-            return self._build_env.parent.get_recursive(key, default)
+        parent = self._build_env._parent
+        if parent is not None:
+            return parent.get_recursive(key, default)
         return default
 
 
@@ -116,35 +225,60 @@ class EvalString(tuple):
         return zip(descs, curr_iter)
 
 
-def _eval_string(s, env, expanded_vars, result_buf):
-    """Evaluate each segments in ``EvalString`` and write result to the
-    given StringIO buffer.
+def _eval_var(varname, env, expanded_vars):
+    """Evaluate a variable in an environment.  The result is memoized in the
+    environment (except in a ``BuildEvalEnv``) until a scope visible from it
+    is mutated."""
+    memo = env._get_memo()
+    if memo is not None:
+        memo = memo[1]
+        try:
+            return memo[varname]
+        except KeyError:
+            pass
+
+    if varname in expanded_vars:
+        raise EvalCircularError(expanded_vars + [varname])
+    expanded_vars.append(varname)
+    try:
+        value = env.get_recursive(varname)
+        value = _eval_string(value, env, expanded_vars) if value else ''
+    finally:
+        expanded_vars.pop()
+    if memo is not None:
+        memo[varname] = value
+    return value
+
+
+def _eval_string(s, env, expanded_vars):
+    """Evaluate each segments in ``EvalString``.
 
     Args:
         env: A ``dict`` that maps a name to ``EvalString`` object.
         expanded_vars: A ``list`` that keeps the variable under evaluation.
-        result_buf: Output buffer.
+
+    Returns:
+        str: The result of evaluation.
     """
     if type(s) is str:
-        result_buf.write(s)
-        return
+        return s
+
+    # Fast paths for a single segment, e.g. ``path`` or ``$var``.
+    descs = s[0]
+    if descs == 't':
+        return s[1]
+    if descs == 'v':
+        return _eval_var(s[1], env, expanded_vars)
 
-    for desc, seg in s.create_iters():
+    result = []
+    for i, desc in enumerate(descs, 1):
         if desc == 't':
             # Append raw text
-            result_buf.write(seg)
+            result.append(s[i])
         else:
             # Substitute variables
-            varname = seg
-            if varname in expanded_vars:
-                raise EvalCircularError(expanded_vars + [varname])
-            expanded_vars.append(varname)
-            try:
-                next_es = env.get_recursive(varname)
-                if next_es:
-                    _eval_string(next_es, env, expanded_vars, result_buf)
-            finally:
-                expanded_vars.pop()
+            result.append(_eval_var(s[i], env, expanded_vars))
+    return ''.join(result)
 
 
 def eval_string(s, env):
@@ -160,10 +294,7 @@ def eval_string(s, env):
         EvalNameError: Unknown variable name occurs.
         EvalCircularError: Circular variable substitution occurs.
     """
-    expanded_vars = []
-    result_buf = StringIO()
-    _eval_string(s, env, expanded_vars, result_buf)
-    return result_buf.getvalue()
+    return _eval_string(s, env, [])
 
 
 def eval_path_strings(strs, env):
@@ -179,6 +310,11 @@ def eval_path_strings(strs, env):
     return [intern(os.path.normpath(eval_string(s, env))) for s in strs]
 
 
+def _eval_path_strings_no_intern(strs, env):
+    """Same as ``eval_path_strings`` but leaves interning to the caller."""
+    return [os.path.normpath(eval_string(s, env)) for s in strs]
+
+
 class EvalStringBuilder(object):
     def __init__(self):
         self._segs = ['']
@@ -210,6 +346,275 @@ class Build(object):
                  'depfile_implicit_ins')
 
 
+class PathTable(object):
+    """A table which maps each distinct path to an integer ID.
+
+    While a manifest is being parsed, the table keeps a ``list`` of paths and
+    a ``dict`` from paths to IDs.  Once parsing is done, ``freeze()`` packs
+    all paths into a single ``bytes`` object with an ``array`` of end
+    offsets and an ``array`` of IDs sorted by encoded path, so that paths
+    are decoded on access and looked up with a binary search.  Paths which
+    are added to a frozen table are kept in the ``list`` and the ``dict``
+    until the next ``freeze()``.
+    """
+
+    __slots__ = ('_paths', '_ids', '_blob', '_ends', '_order')
+
+
+    if sys.version_info < (3,):
+        @staticmethod
+        def _encode(path):
+            return path
+
+        @staticmethod
+        def _decode(buf):
+            return buf
+    else:
+        @staticmethod
+        def _encode(path):
+            return path.encode('utf-8')
+
+        @staticmethod
+        def _decode(buf):
+            return buf.decode('utf-8')
+
+
+    def __init__(self, paths=()):
+        self._paths = []
+        self._ids = {}
+        self._blob = b''
+        self._ends = array.array('L')
+        self._order = array.array('I')
+        for path in paths:
+            self.get_id(path)
+
+
+    def __len__(self):
+        return len(self._ends) + len(self._paths)
+
+
+    def __getstate__(self):
+        self.freeze()
+        return (self._blob, self._ends, self._order)
+
+
+    def __setstate__(self, state):
+        self._paths = []
+        self._ids = {}
+        self._blob, self._ends, self._order = state
+
+
+    def freeze(self):
+        """Pack the paths into a single string to save memory."""
+        if not self._paths:
+            return
+        num_packed = len(self._ends)
+        encoded = [self._encode(path) for path in self._paths]
+
+        ends = self._ends
+        end = ends[-1] if ends else 0
+        for buf in encoded:
+            end += len(buf)
+            ends.append(end)
+
+        # Merge the IDs of the new paths into the sorted order.  The
+        # insertion points are looked up before the blob is extended.
+        new_ids = sorted(range(len(encoded)), key=encoded.__getitem__)
+        order = self._order
+        merged = array.array('I')
+        start = 0
+        for new_id in new_ids:
+            pos = self._bisect(encoded[new_id])
+            merged.extend(order[start:pos])
+            merged.append(num_packed + new_id)
+            start = pos
+        merged.extend(order[start:])
+
+        self._blob += b''.join(encoded)
+        self._order = merged
+        self._paths = []
+        self._ids = {}
+
+
+    def _get_encoded(self, path_id):
+        start = self._ends[path_id - 1] if path_id else 0
+        return self._blob[start:self._ends[path_id]]
+
+
+    def _bisect(self, buf):
+        """Find the position of ``buf`` in the sorted order of the packed
+        paths."""
+        order = self._order
+        lo = 0
+        hi = len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_encoded(order[mid]) < buf:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def find_encoded_id(self, buf):
+        """Get the ID of a packed UTF-8 encoded path or ``None``.  Paths
+        which were added after ``freeze()`` are not searched."""
+        pos = self._bisect(buf)
+        if pos < len(self._order):
+            path_id = self._order[pos]
+            if self._get_encoded(path_id) == buf:
+                return path_id
+        return None
+
+
+    def get_id(self, path):
+        """Get the ID of a path, adding it to the table if necessary."""
+        path_id = self.find_id(path)
+        if path_id is None:
+            path_id = len(self)
+            self._paths.append(path)
+            self._ids[path] = path_id
+        return path_id
+
+
+    def find_id(self, path):
+        """Get the ID of a path or ``None`` if it is not in the table."""
+        path_id = self._ids.get(path)
+        if path_id is None and self._ends:
+            path_id = self.find_encoded_id(self._encode(path))
+        return path_id
+
+
+    def get_path(self, path_id):
+        num_packed = len(self._ends)
+        if path_id >= num_packed:
+            return self._paths[path_id - num_packed]
+        return self._decode(self._get_encoded(path_id))
+
+
+    def get_paths(self, path_ids):
+        if not self._ends:
+            paths = self._paths
+            return [paths[path_id] for path_id in path_ids]
+        return [self.get_path(path_id) for path_id in path_ids]
+
+
+class CompactBuild(object):
+    """A memory efficient alternative to ``Build``.
+
+    All paths of a build are stored as IDs in a ``PathTable``, in a single
+    ``array`` which starts with the end offsets of the path groups.  The
+    path lists are only materialized on access.
+    """
+
+    __slots__ = ('rule', 'bindings', '_table', '_path_ids', '_depfile_ids')
+
+    # Order of the path groups in ``_path_ids``.
+    _GROUPS = ('explicit_outs', 'implicit_outs', 'explicit_ins',
+               'implicit_ins', 'prerequisites')
+
+
+    def __init__(self, table, rule, bindings, path_groups):
+        """Create a build.
+
+        Args:
+            table: ``PathTable`` shared by all builds of a manifest.
+            path_groups: Lists of paths in the order of ``_GROUPS``.
+        """
+        self.rule = rule
+        self.bindings = bindings
+        self._table = table
+        num_groups = len(self._GROUPS)
+        path_ids = array.array('I', [0] * num_groups)
+        for index, paths in enumerate(path_groups):
+            path_ids.extend(table.get_id(path) for path in paths)
+            path_ids[index] = len(path_ids)
+        self._path_ids = path_ids
+        self._depfile_ids = None
+
+
+    @classmethod
+    def from_build(cls, table, build):
+        result = cls(table, build.rule, build.bindings,
+                     [getattr(build, group) for group in cls._GROUPS])
+        result.depfile_implicit_ins = build.depfile_implicit_ins
+        return result
+
+
+    def __getstate__(self):
+        return (self.rule, self.bindings, self._table, self._path_ids,
+                self._depfile_ids)
+
+
+    def __setstate__(self, state):
+        (self.rule, self.bindings, self._table, self._path_ids,
+         self._depfile_ids) = state
+
+
+    def _get_range(self, index):
+        start = self._path_ids[index - 1] if index else len(self._GROUPS)
+        return start, self._path_ids[index]
+
+
+    def get_path_ids(self, group):
+        """Get the path IDs of a group, e.g. ``'explicit_ins'``."""
+        if group == 'depfile_implicit_ins':
+            return self._depfile_ids or array.array('I')
+        start, end = self._get_range(self._GROUPS.index(group))
+        return self._path_ids[start:end]
+
+
+    def _get_paths(self, index):
+        start, end = self._get_range(index)
+        return self._table.get_paths(self._path_ids[start:end])
+
+
+    @property
+    def explicit_outs(self):
+        return self._get_paths(0)
+
+
+    @property
+    def implicit_outs(self):
+        return self._get_paths(1)
+
+
+    @property
+    def explicit_ins(self):
+        return self._get_paths(2)
+
+
+    @property
+    def implicit_ins(self):
+        return self._get_paths(3)
+
+
+    @property
+    def prerequisites(self):
+        return self._get_paths(4)
+
+
+    @property
+    def depfile_implicit_ins(self):
+        if not self._depfile_ids:
+            return tuple()
+        return tuple(self._table.get_paths(self._depfile_ids))
+
+
+    def set_depfile_path_ids(self, path_ids):
+        """Set ``depfile_implicit_ins`` to an ``array('I')`` of path IDs."""
+        self._depfile_ids = path_ids or None
+
+
+    @depfile_implicit_ins.setter
+    def depfile_implicit_ins(self, paths):
+        if paths:
+            self._depfile_ids = array.array(
+                    'I', [self._table.get_id(path) for path in paths])
+        else:
+            self._depfile_ids = None
+
+
 class Rule(object):
     __slots__ = ('name', 'bindings')
 
@@ -266,6 +671,11 @@ class ParseError(ValueError):
         self.reason = reason
 
 
+    def __reduce__(self):
+        # Keep the attributes when the error is passed between processes.
+        return (ParseError, (self.path, self.line, self.column, self.reason))
+
+
     def __repr__(self):
         s = 'ParseError: {}:{}:{}'.format(self.path, self.line, self.column)
         if self.reason:
@@ -290,6 +700,12 @@ class Lexer(object):
         self._next_pos = None
 
 
+    @property
+    def position(self):
+        """The (line, column) of the current position."""
+        return (self._line, self._line_pos + 1)
+
+
     def raise_error(self, reason=None):
         raise ParseError(self.path, self._line, self._line_pos + 1, reason)
 
@@ -477,6 +893,117 @@ class Lexer(object):
 Manifest = collections.namedtuple('Manifest', 'builds rules pools defaults')
 
 
+class ParseCache(object):
+    """Cache of the statements lexed from each ninja file.
+
+    Each ninja file is fingerprinted by its size, modification time and
+    content hash.  The statements of a file only depend on its content, so
+    they can be reused as long as the fingerprint is unchanged, even if the
+    variables or rules they refer to have changed in other files.  The
+    statements are still evaluated in the environment of each parse.
+
+    The cache is a directory with one pickle file per ninja file.
+    """
+
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def _get_cache_path(self, path, encoding):
+        key = hashlib.sha1(
+                (os.path.abspath(path) + '\0' + encoding).encode('utf-8'))
+        return os.path.join(self._cache_dir, key.hexdigest() + '.pickle')
+
+
+    @staticmethod
+    def _hash_file(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            while True:
+                buf = fp.read(1 << 20)
+                if not buf:
+                    break
+                digest.update(buf)
+        return digest.hexdigest()
+
+
+    def load(self, path, encoding):
+        """Load the cached statements for a file.
+
+        Returns:
+            The list of statements, or ``None`` if the file is not in the
+            cache or has changed since it was cached.
+        """
+        cache_path = self._get_cache_path(path, encoding)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        st = os.stat(path)
+        if entry['size'] != st.st_size:
+            return None
+        if entry['mtime'] != st.st_mtime:
+            # The file was touched.  Reuse the statements if its content is
+            # unchanged, and remember the new modification time.
+            if entry['digest'] != self._hash_file(path):
+                return None
+            entry['mtime'] = st.st_mtime
+            self._write(cache_path, entry)
+        return entry['stmts']
+
+
+    def store(self, path, encoding, stmts):
+        """Store the statements lexed from a file."""
+        st = os.stat(path)
+        entry = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'digest': self._hash_file(path),
+            'stmts': stmts,
+        }
+        self._write(self._get_cache_path(path, encoding), entry)
+
+
+    @staticmethod
+    def _write(cache_path, entry):
+        # Write to a temporary file first so that concurrent readers never
+        # see a partially written entry.
+        tmp_path = cache_path + '.tmp' + str(os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(entry, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+
+
+class STMT(object):
+    """Statement kind enumerations.
+
+    Lexed statements are tuples whose first element is one of these kinds:
+
+        (BINDING, key, value)
+        (RULE, name, bindings)
+        (BUILD, line, column, explicit_outs, implicit_outs, rule_name,
+         explicit_ins, implicit_ins, prerequisites, bindings)
+        (DEFAULT, outs)
+        (POOL, name, bindings)
+        (INCLUDE, path, is_subninja)
+
+    where values and paths are ``EvalString`` objects and bindings are lists
+    of (key, value) pairs.
+    """
+
+    BINDING = 0
+    RULE = 1
+    BUILD = 2
+    DEFAULT = 3
+    POOL = 4
+    INCLUDE = 5
+
+
 class Parser(object):
     """Ninja Manifest Parser
 
@@ -500,15 +1027,41 @@ class Parser(object):
         >>> manifest = Parser().parse('build.ninja', 'utf-8')
         >>> print(manifest.builds)
 
+    Parsing happens in two phases for each file.  The file is first lexed
+    into a list of statements, which only depends on the content of the
+    file.  The statements are then evaluated in the current environment.
+    If ``cache_dir`` is specified, the statements of each file are cached
+    there and the first phase is skipped for unchanged files.
+
+    If ``jobs`` is greater than one, ``subninja`` files are parsed by a pool
+    of worker processes.  A subninja file cannot change the bindings of its
+    parent, so each one is parsed against a snapshot of the parent
+    environment taken at the ``subninja`` statement, and the results are
+    merged back in the original order.  The resulting manifest is the same
+    as the one from the serial parser.
+
+    If ``compact`` is true, the builds are ``CompactBuild`` objects whose
+    paths are stored as integer IDs in a shared ``PathTable``, which takes
+    several times less memory for large manifests.
     """
 
 
-    def __init__(self, base_dir=None):
+    def __init__(self, base_dir=None, cache_dir=None, jobs=None,
+                 compact=False):
         if base_dir is None:
             self._base_dir = os.getcwd()
         else:
             self._base_dir = base_dir
 
+        self._cache_dir = cache_dir
+        self._cache = ParseCache(cache_dir) if cache_dir else None
+
+        self._jobs = jobs
+        self._pool = None
+        self._pending_subninjas = []
+
+        self._path_table = PathTable() if compact else None
+
         # File context
         self._context = []
         self._lexer = None
@@ -555,7 +1108,17 @@ class Parser(object):
             Manifest: Parsed manifest for the given ninja-build manifest file.
         """
 
-        self._parse_internal(path, encoding, EvalEnv())
+        if self._jobs and self._jobs > 1:
+            self._pool = multiprocessing.Pool(self._jobs)
+        try:
+            self._parse_internal(path, encoding, EvalEnv())
+            self._merge_pending_subninjas()
+        finally:
+            if self._pool:
+                self._pool.terminate()
+                self._pool = None
+        if self._path_table is not None:
+            self._path_table.freeze()
         if depfile:
             self.parse_dep_file(depfile, encoding)
         return Manifest(self._builds, self._rules, self._pools, self._defaults)
@@ -566,19 +1129,51 @@ class Parser(object):
         with open(path, 'r', encoding=encoding) as fp:
             self._push_context(Lexer(fp, path, encoding), env)
             try:
-                self._parse_all_top_level_stmts()
+                stmts = self._load_stmts(path, encoding)
+                self._eval_stmts(stmts)
             finally:
                 self._pop_context()
 
 
+    def _load_stmts(self, path, encoding):
+        """Lex the statements of the current file or load them from the
+        cache.
+
+        Returns:
+            An iterable of statements.  Unless they are being cached, the
+            statements are lexed lazily so that they do not all have to be
+            kept in memory.
+        """
+
+        if not self._cache:
+            return self._parse_all_top_level_stmts()
+
+        stmts = self._cache.load(path, encoding)
+        if stmts is None:
+            stmts = list(self._parse_all_top_level_stmts())
+            self._cache.store(path, encoding, stmts)
+        return stmts
+
+
     def _parse_all_top_level_stmts(self):
-        """Parse all top-level statements in a file."""
-        while self._parse_top_level_stmt():
-            pass
+        """Parse all top-level statements in a file.
+
+        Returns:
+            A generator of statements.
+        """
+        return self._iter_top_level_stmts()
 
 
-    def _parse_top_level_stmt(self):
-        """Parse a top level statement."""
+    def _iter_top_level_stmts(self):
+        stmts = []
+        while self._parse_top_level_stmt(stmts):
+            for stmt in stmts:
+                yield stmt
+            del stmts[:]
+
+
+    def _parse_top_level_stmt(self, stmts):
+        """Parse a top level statement and append it to stmts."""
 
         token = self._lexer.peek()
         if not token:
@@ -592,17 +1187,17 @@ class Parser(object):
         elif token.kind == TK.IDENT:
             ident = token.value
             if ident == 'rule':
-                self._parse_rule_stmt()
+                stmts.append(self._parse_rule_stmt())
             elif ident == 'build':
-                self._parse_build_stmt()
+                stmts.append(self._parse_build_stmt())
             elif ident == 'default':
-                self._parse_default_stmt()
+                stmts.append(self._parse_default_stmt())
             elif ident == 'pool':
-                self._parse_pool_stmt()
+                stmts.append(self._parse_pool_stmt())
             elif ident in {'subninja', 'include'}:
-                self._parse_include_stmt()
+                stmts.append(self._parse_include_stmt())
             else:
-                self._parse_global_binding_stmt()
+                stmts.append(self._parse_global_binding_stmt())
         else:
             # An unexpected trivial token occurs.  Raise an error.
             self._lexer.raise_error()
@@ -648,8 +1243,7 @@ class Parser(object):
         """
 
         key, value = self._parse_binding_stmt()
-        value = eval_string(value, self._env)
-        self._env[key] = value
+        return (STMT.BINDING, key, value)
 
 
     def _parse_local_binding_block(self):
@@ -659,14 +1253,13 @@ class Parser(object):
             SPACE IDENT1 = STRING1
             SPACE IDENT2 = STRING2
         """
-        result = EvalEnv()
+        result = []
         while True:
             token = self._lexer.peek()
             if not token or token.kind != TK.SPACE:
                 break
             self._lexer.lex()
-            key, value = self._parse_binding_stmt()
-            result[key] = value
+            result.append(self._parse_binding_stmt())
         return result
 
 
@@ -683,8 +1276,6 @@ class Parser(object):
         token = self._lexer.lex_match({TK.IDENT})
         assert token.value == 'build'
 
-        build = Build()
-
         # Parse explicit outs
         explicit_outs = self._parse_path_list({TK.PIPE, TK.COLON})
 
@@ -698,14 +1289,11 @@ class Parser(object):
 
         self._lexer.lex_match({TK.COLON})
 
-        # Parse rule name for this build statement
-        build.rule = self._lexer.lex_match({TK.IDENT}).value
-        try:
-            rule_env = self._rules_dict[build.rule].bindings
-        except KeyError:
-            if build.rule != 'phony':
-                self._lexer.raise_error('undeclared rule name')
-            rule_env = self._env
+        # Parse rule name for this build statement.  Remember the position
+        # after the rule name, which is where an undeclared rule name is
+        # reported.
+        rule_name = self._lexer.lex_match({TK.IDENT}).value
+        line, column = self._lexer.position
 
         # Parse explicit ins
         explicit_ins = self._parse_path_list(
@@ -731,24 +1319,9 @@ class Parser(object):
 
         # Parse local bindings
         bindings = self._parse_local_binding_block()
-        bindings.parent = self._env
-        if bindings:
-            build.bindings = bindings
-        else:
-            # Don't keep the empty ``dict`` object if there are no bindings
-            build.bindings = None
 
-        # Evaluate all paths
-        env = BuildEvalEnv(bindings, rule_env)
-
-        build.explicit_outs = eval_path_strings(explicit_outs, env)
-        build.implicit_outs = eval_path_strings(implicit_outs, env)
-        build.explicit_ins = eval_path_strings(explicit_ins, env)
-        build.implicit_ins = eval_path_strings(implicit_ins, env)
-        build.prerequisites = eval_path_strings(prerequisites, env)
-        build.depfile_implicit_ins = tuple()
-
-        self._builds.append(build)
+        return (STMT.BUILD, line, column, explicit_outs, implicit_outs,
+                rule_name, explicit_ins, implicit_ins, prerequisites, bindings)
 
 
     def _parse_rule_stmt(self):
@@ -763,13 +1336,11 @@ class Parser(object):
         token = self._lexer.lex_match({TK.IDENT})
         assert token.value == 'rule'
 
-        rule = Rule()
-        rule.name = self._lexer.lex_match({TK.IDENT}).value
+        name = self._lexer.lex_match({TK.IDENT}).value
         self._lexer.lex_match({TK.NEWLINE, TK.EOF})
-        rule.bindings = self._parse_local_binding_block()
+        bindings = self._parse_local_binding_block()
 
-        self._rules.append(rule)
-        self._rules_dict[rule.name] = rule
+        return (STMT.RULE, name, bindings)
 
 
     def _parse_default_stmt(self):
@@ -782,13 +1353,11 @@ class Parser(object):
         token = self._lexer.lex_match({TK.IDENT})
         assert token.value == 'default'
 
-        default = Default()
         outs = self._parse_path_list({TK.NEWLINE, TK.EOF})
-        default.outs = eval_path_strings(outs, self._env)
 
         self._lexer.lex_match({TK.NEWLINE, TK.EOF})
 
-        self._defaults.append(default)
+        return (STMT.DEFAULT, outs)
 
 
     def _parse_pool_stmt(self):
@@ -802,17 +1371,15 @@ class Parser(object):
         token = self._lexer.lex_match({TK.IDENT})
         assert token.value == 'pool'
 
-        pool = Pool()
-
         token = self._lexer.lex()
         assert token.kind == TK.IDENT
-        pool.name = token.value
+        name = token.value
 
         self._lexer.lex_match({TK.NEWLINE, TK.EOF})
 
-        pool.bindings = self._parse_local_binding_block()
+        bindings = self._parse_local_binding_block()
 
-        self._pools.append(pool)
+        return (STMT.POOL, name, bindings)
 
 
     def _parse_include_stmt(self):
@@ -825,13 +1392,135 @@ class Parser(object):
 
         token = self._lexer.lex_match({TK.IDENT})
         assert token.value in {'include', 'subninja'}
-        wrap_env = token.value == 'subninja'
+        is_subninja = token.value == 'subninja'
 
         token = self._lexer.lex_path()
-        path = eval_string(token.value, self._env)  # XXX: Check lookup order
         self._lexer.lex_match({TK.NEWLINE, TK.EOF})
 
-        if wrap_env:
+        return (STMT.INCLUDE, token.value, is_subninja)
+
+
+    def _eval_stmts(self, stmts):
+        """Evaluate the statements of the current file."""
+
+        for stmt in stmts:
+            kind = stmt[0]
+            if kind == STMT.BUILD:
+                self._eval_build_stmt(stmt)
+            elif kind == STMT.BINDING:
+                self._eval_global_binding_stmt(stmt)
+            elif kind == STMT.RULE:
+                self._eval_rule_stmt(stmt)
+            elif kind == STMT.DEFAULT:
+                self._eval_default_stmt(stmt)
+            elif kind == STMT.POOL:
+                self._eval_pool_stmt(stmt)
+            else:
+                assert kind == STMT.INCLUDE
+                self._eval_include_stmt(stmt)
+
+
+    @staticmethod
+    def _create_binding_env(bindings):
+        return EvalEnv(bindings)
+
+
+    def _eval_global_binding_stmt(self, stmt):
+        _, key, value = stmt
+        self._env[key] = eval_string(value, self._env)
+
+
+    def _eval_build_stmt(self, stmt):
+        (_, line, column, explicit_outs, implicit_outs, rule_name,
+         explicit_ins, implicit_ins, prerequisites, bindings) = stmt
+
+        if rule_name not in self._rules_dict:
+            # The rule may come from a subninja file parsed by a worker.
+            self._merge_pending_subninjas()
+        try:
+            rule_env = self._rules_dict[rule_name].bindings
+        except KeyError:
+            if rule_name != 'phony':
+                raise ParseError(self._lexer.path, line, column,
+                                 'undeclared rule name')
+            rule_env = self._env
+
+        bindings = self._create_binding_env(bindings)
+        bindings.parent = self._env
+
+        # Evaluate all paths
+        env = BuildEvalEnv(bindings, rule_env)
+        if self._path_table is not None:
+            # The path table takes care of deduplication.
+            eval_paths = _eval_path_strings_no_intern
+        else:
+            eval_paths = eval_path_strings
+        path_groups = [eval_paths(paths, env)
+                       for paths in (explicit_outs, implicit_outs,
+                                     explicit_ins, implicit_ins,
+                                     prerequisites)]
+
+        # Don't keep the empty ``dict`` object if there are no bindings
+        if not bindings:
+            bindings = None
+
+        if self._path_table is not None:
+            build = CompactBuild(self._path_table, rule_name, bindings,
+                                 path_groups)
+        else:
+            build = Build()
+            build.rule = rule_name
+            build.bindings = bindings
+            (build.explicit_outs, build.implicit_outs, build.explicit_ins,
+             build.implicit_ins, build.prerequisites) = path_groups
+            build.depfile_implicit_ins = tuple()
+
+        self._builds.append(build)
+
+
+    def _eval_rule_stmt(self, stmt):
+        _, name, bindings = stmt
+
+        # Rules defined by pending subninja files come first.
+        self._merge_pending_subninjas()
+
+        rule = Rule()
+        rule.name = name
+        rule.bindings = self._create_binding_env(bindings)
+
+        self._rules.append(rule)
+        self._rules_dict[rule.name] = rule
+
+
+    def _eval_default_stmt(self, stmt):
+        _, outs = stmt
+
+        default = Default()
+        default.outs = eval_path_strings(outs, self._env)
+
+        self._defaults.append(default)
+
+
+    def _eval_pool_stmt(self, stmt):
+        _, name, bindings = stmt
+
+        pool = Pool()
+        pool.name = name
+        pool.bindings = self._create_binding_env(bindings)
+
+        self._pools.append(pool)
+
+
+    def _eval_include_stmt(self, stmt):
+        _, path, is_subninja = stmt
+
+        path = eval_string(path, self._env)  # XXX: Check lookup order
+
+        if is_subninja and self._pool:
+            self._submit_subninja(path, self._lexer.encoding)
+            return
+
+        if is_subninja:
             env = EvalEnv()
             env.parent = self._env
         else:
@@ -839,15 +1528,187 @@ class Parser(object):
         self._parse_internal(path, self._lexer.encoding, env)
 
 
+    def _submit_subninja(self, path, encoding):
+        """Parse a subninja file in a worker process."""
+
+        snapshot = pickle.dumps((self._env, self._rules_dict),
+                                pickle.HIGHEST_PROTOCOL)
+        result = self._pool.apply_async(
+                _parse_subninja,
+                (self._base_dir, self._cache_dir, path, encoding, snapshot))
+        self._pending_subninjas.append(
+                (result, path, encoding, snapshot, self._env, len(self._builds),
+                 len(self._rules), len(self._pools), len(self._defaults)))
+
+
+    def _merge_pending_subninjas(self):
+        """Wait for the pending subninja files and merge their results at
+        the positions of their ``subninja`` statements."""
+
+        if not self._pending_subninjas:
+            return
+        pending = self._pending_subninjas
+        self._pending_subninjas = []
+
+        builds = []
+        rules = []
+        pools = []
+        defaults = []
+        prev = (0, 0, 0, 0)
+        # Names of the rules defined by the subninja files merged so far.
+        # The workers of the later ones didn't see them.
+        merged_rule_names = set()
+        for (result, path, encoding, snapshot, parent_env,
+             num_builds, num_rules, num_pools, num_defaults) in pending:
+            try:
+                parsed = result.get()
+            except ParseError:
+                parsed = None
+            else:
+                if merged_rule_names and any(
+                        build.rule in merged_rule_names for build in parsed[1]):
+                    parsed = None
+            if parsed is None:
+                # The subninja file depends on the rules of an earlier
+                # subninja file.  Parse it again against the merged rules to
+                # get the same result (or error) as the serial parser.
+                parsed = self._parse_subninja_serially(path, encoding,
+                                                       snapshot)
+            env, sub_builds, sub_rules, sub_pools, sub_defaults = parsed
+
+            # Link the results to the real parent environment.
+            env.parent = parent_env
+
+            if self._path_table is not None:
+                sub_builds = [CompactBuild.from_build(self._path_table, build)
+                              for build in sub_builds]
+
+            builds.extend(self._builds[prev[0]:num_builds])
+            builds.extend(sub_builds)
+            rules.extend(self._rules[prev[1]:num_rules])
+            rules.extend(sub_rules)
+            pools.extend(self._pools[prev[2]:num_pools])
+            pools.extend(sub_pools)
+            defaults.extend(self._defaults[prev[3]:num_defaults])
+            defaults.extend(sub_defaults)
+            prev = (num_builds, num_rules, num_pools, num_defaults)
+
+            for rule in sub_rules:
+                self._rules_dict[rule.name] = rule
+                merged_rule_names.add(rule.name)
+
+        builds.extend(self._builds[prev[0]:])
+        rules.extend(self._rules[prev[1]:])
+        pools.extend(self._pools[prev[2]:])
+        defaults.extend(self._defaults[prev[3]:])
+
+        # Update the lists in place since the parse() callers share them.
+        self._builds[:] = builds
+        self._rules[:] = rules
+        self._pools[:] = pools
+        self._defaults[:] = defaults
+
+
+    def _parse_subninja_serially(self, path, encoding, snapshot):
+        parent_env, _ = pickle.loads(snapshot)
+        parser = Parser(self._base_dir, self._cache_dir)
+        parser._rules_dict = dict(self._rules_dict)
+        env = EvalEnv()
+        env.parent = parent_env
+        parser._parse_internal(path, encoding, env)
+        return (env, parser._builds, parser._rules, parser._pools,
+                parser._defaults)
+
+
     def parse_dep_file(self, path, encoding):
-        depfile = DepFileParser().parse(path, encoding)
+        deps_log = DepFileParser().parse(path, encoding)
+        try:
+            if self._path_table is not None:
+                self._join_dep_file_ids(deps_log, encoding)
+                return
+            records = deps_log.get_records_by_output()
+            for build in self._builds:
+                path_ids = set()
+                for explicit_out in build.explicit_outs:
+                    deps = records.get(explicit_out)
+                    if deps:
+                        path_ids.update(deps.implicit_ins)
+                build.depfile_implicit_ins = tuple(
+                        sorted(deps_log.get_paths(path_ids)))
+        finally:
+            deps_log.close()
+
+
+    def _join_dep_file_ids(self, deps_log, encoding):
+        """Join the deps records with the compact builds on path IDs.
+
+        Deps log paths are looked up in the frozen path table in their
+        encoded form, so neither the manifest paths nor the deps log paths
+        which are already in the table are decoded.  Paths which only occur
+        in the deps log are added to the path table.
+        """
+        table = self._path_table
+        if sys.version_info < (3,) or \
+                codecs.lookup(encoding).name == 'utf-8':
+            get_encoded_path = deps_log.get_raw_path
+        else:
+            def get_encoded_path(path_id):
+                return deps_log.get_path(path_id).encode('utf-8')
+
+        records = {}
+        for deps in deps_log.records():
+            table_id = table.find_encoded_id(
+                    get_encoded_path(deps.explicit_out))
+            if table_id is not None:
+                records[table_id] = deps
+
+        # Maps deps log path IDs to ``(encoded path, table ID)``.
+        dep_paths = {}
+
+        def get_dep_path(path_id):
+            try:
+                return dep_paths[path_id]
+            except KeyError:
+                pass
+            buf = get_encoded_path(path_id)
+            table_id = table.find_encoded_id(buf)
+            if table_id is None:
+                table_id = table.get_id(deps_log.get_path(path_id))
+            dep_path = dep_paths[path_id] = (buf, table_id)
+            return dep_path
+
         for build in self._builds:
-            depfile_implicit_ins = set()
-            for explicit_out in build.explicit_outs:
-                deps = depfile.get(explicit_out)
+            path_ids = set()
+            for explicit_out in build.get_path_ids('explicit_outs'):
+                deps = records.get(explicit_out)
                 if deps:
-                    depfile_implicit_ins.update(deps.implicit_ins)
-            build.depfile_implicit_ins = tuple(sorted(depfile_implicit_ins))
+                    path_ids.update(deps.implicit_ins)
+            # UTF-8 byte order is code point order, so this sorts like the
+            # decoded paths.
+            build.set_depfile_path_ids(array.array('I', [
+                    table_id for _, table_id in
+                    sorted(get_dep_path(path_id) for path_id in path_ids)]))
+        table.freeze()
+
+
+def _parse_subninja(base_dir, cache_dir, path, encoding, snapshot):
+    """Parse a subninja file in a worker process.
+
+    Args:
+        snapshot: The pickled parent environment and rules.
+
+    Returns:
+        The environment of the subninja file and the builds, rules, pools
+        and defaults parsed from it.
+    """
+    parent_env, rules_dict = pickle.loads(snapshot)
+    parser = Parser(base_dir, cache_dir)
+    parser._rules_dict = rules_dict
+    env = EvalEnv()
+    env.parent = parent_env
+    parser._parse_internal(path, encoding, env)
+    return (env, parser._builds, parser._rules, parser._pools,
+            parser._defaults)
 
 
 class DepFileError(ValueError):
@@ -855,6 +1716,10 @@ class DepFileError(ValueError):
 
 
 class DepFileRecord(object):
+    """A deps record.  ``explicit_out`` is a path ID and ``implicit_ins`` is
+    an ``array('I')`` of path IDs.  Use :meth:`DepFile.get_path` to decode
+    them."""
+
     __slots__ = ('id', 'explicit_out', 'mtime', 'implicit_ins')
 
 
@@ -865,121 +1730,473 @@ class DepFileRecord(object):
         self.implicit_ins = implicit_ins
 
 
-class DepFileParser(object):
-    """Ninja deps log parser which parses ``.ninja_deps`` file.
+class DepFile(object):
+    """Parsed ``.ninja_deps`` file.
+
+    Paths are referred to by integer IDs and only decoded when they are
+    accessed.  The file stays memory-mapped until :meth:`close` is called.
     """
 
 
-    def __init__(self):
-        self._deps = []
-        self._paths = []
-        self._path_deps = {}
+    def __init__(self, buf, encoding, path_starts, path_ends, deps):
+        self._buf = buf
+        self._encoding = encoding
+        self._path_starts = path_starts
+        self._path_ends = path_ends
+        self._paths = [None] * len(path_starts)
+        self._deps = deps
+        self._records_by_output = None
 
 
-    def parse(self, path, encoding):
-        with open(path, 'rb') as fp:
-            return self._parse(fp, encoding)
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
 
 
-    @staticmethod
-    def _unpack_uint32(buf):
-        return struct.unpack('<I', buf)[0]
+    def __len__(self):
+        return len(self._deps)
 
 
-    @staticmethod
-    def _unpack_uint32_iter(buf):
-        for p in struct.iter_unpack('<I', buf):
-            yield p[0]
+    def records(self):
+        """Iterate over the latest deps record of each output."""
+        return iter(self._deps.values())
+
+
+    def get_raw_path(self, path_id):
+        """Get a path as the undecoded bytes stored in the file."""
+        path = self._buf[self._path_starts[path_id]:self._path_ends[path_id]]
+        # Remove the padding (at most 3 null characters)
+        stripped = path.rstrip(b'\0')
+        if len(path) - len(stripped) > 3:
+            stripped = path[0:len(path) - 3]
+        return stripped
+
+
+    def get_path(self, path_id):
+        path = self._paths[path_id]
+        if path is None:
+            path = intern(self._decode(self.get_raw_path(path_id),
+                                       self._encoding))
+            self._paths[path_id] = path
+        return path
 
 
     if sys.version_info < (3,):
         @staticmethod
-        def _extract_path(s, encoding):
-            pos = len(s)
-            count = 3
-            while count > 0 and pos > 0 and s[pos - 1] == b'\0':
-                pos -= 1
-                count -= 1
-            return intern(s[0:pos])
+        def _decode(s, encoding):
+            return s
     else:
         @staticmethod
-        def _extract_path(s, encoding):
-            pos = len(s)
-            count = 3
-            while count > 0 and pos > 0 and s[pos - 1] == 0:
-                pos -= 1
-                count -= 1
-            return intern(s[0:pos].decode(encoding))
+        def _decode(s, encoding):
+            return s.decode(encoding)
+
+
+    def get_paths(self, path_ids):
+        return [self.get_path(path_id) for path_id in path_ids]
+
+
+    def get_records_by_output(self):
+        """Get a dict which maps output paths to deps records.  Only the
+        output paths are decoded."""
+        if self._records_by_output is None:
+            self._records_by_output = {
+                self.get_path(deps.explicit_out): deps
+                for deps in self._deps.values()}
+        return self._records_by_output
+
+
+    def get(self, path, default=None):
+        return self.get_records_by_output().get(path, default)
+
+
+class DepFileParser(object):
+    """Ninja deps log parser which parses ``.ninja_deps`` file.
+
+    The file is memory-mapped and scanned as an array of 32-bit words, which
+    is possible because every record is padded to a multiple of 4 bytes.
+    """
 
+    _MAGIC = b'# ninjadeps\n'
+    _MAX_RECORD_SIZE = (1 << 19) - 1
 
-    def _get_path(self, index):
+
+    def parse(self, path, encoding):
+        with open(path, 'rb') as fp:
+            try:
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                raise DepFileError('bad magic word')
         try:
-            return self._paths[index]
-        except IndexError:
-            raise DepFileError('path index overflow')
+            return self._parse(buf, encoding)
+        except Exception:
+            buf.close()
+            raise
 
 
-    def _parse(self, fp, encoding):
+    @staticmethod
+    def _get_words(buf, num_words):
+        if sys.version_info >= (3,) and sys.byteorder == 'little':
+            return memoryview(buf)[0:num_words * 4].cast('I')
+
+        # Fall back to a copy if the mapping can't be viewed as words.
+        words = array.array('I')
+        if sys.version_info < (3,):
+            words.fromstring(buf[0:num_words * 4])
+        else:
+            words.frombytes(buf[0:num_words * 4])
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words
+
+
+    def _parse(self, buf, encoding):
         # Check the magic word
-        if fp.readline() != b'# ninjadeps\n':
+        magic_size = len(self._MAGIC)
+        if buf[0:magic_size] != self._MAGIC:
             raise DepFileError('bad magic word')
 
-        # Check the file format version
-        version = self._unpack_uint32(fp.read(4))
-        if version != 3:
-            raise DepFileError('unsupported deps log version: ' + str(version))
+        words = self._get_words(buf, len(buf) // 4)
+        try:
+            path_starts, path_ends, deps = self._scan(words)
+        finally:
+            # Release the mapping so that it can be closed.
+            if isinstance(words, memoryview):
+                words.release()
 
-        # Read the records
-        MAX_RECORD_SIZE = (1 << 19) - 1
-        while True:
-            buf = fp.read(4)
-            if not buf:
-                break
+        return DepFile(buf, encoding, path_starts, path_ends, deps)
 
-            record_size = self._unpack_uint32(buf)
-            is_dep = bool(record_size >> 31)
-            record_size &= (1 << 31) - 1
 
-            if record_size > MAX_RECORD_SIZE:
+    def _scan(self, words):
+        # Check the file format version
+        pos = len(self._MAGIC) // 4
+        if len(words) <= pos:
+            raise DepFileError('missing deps log version')
+        version = words[pos]
+        if version != 3:
+            raise DepFileError(
+                    'unsupported deps log version: ' + str(version))
+        pos += 1
+
+        # Read the records.  A truncated record at the end of the file (e.g.
+        # left behind by an interrupted build) is ignored like ninja does.
+        if isinstance(words, memoryview):
+            def _get_array(begin, end):
+                result = array.array('I')
+                result.frombytes(words[begin:end].cast('B'))
+                return result
+        else:
+            def _get_array(begin, end):
+                return words[begin:end]
+
+        path_starts = array.array('L')
+        path_ends = array.array('L')
+        deps = {}
+        num_deps = 0
+        num_words = len(words)
+        while pos < num_words:
+            record_size = words[pos]
+            is_dep = record_size >> 31
+            record_size &= (1 << 31) - 1
+            if record_size > self._MAX_RECORD_SIZE:
                 raise DepFileError('record size overflow')
 
+            begin = pos + 1
+            end = begin + record_size // 4
+            if end > num_words:
+                break
+
             if is_dep:
                 if record_size % 4 != 0 or record_size < 8:
                     raise DepFileError('corrupted deps record')
 
-                buf = fp.read(record_size)
+                explicit_out = words[begin]
+                mtime = words[begin + 1]
+                implicit_ins = _get_array(begin + 2, end)
 
-                dep_iter = self._unpack_uint32_iter(buf)
+                num_paths = len(path_starts)
+                if explicit_out >= num_paths or \
+                        (implicit_ins and max(implicit_ins) >= num_paths):
+                    raise DepFileError('path index overflow')
 
-                idx = len(self._deps)
-                explicit_out = self._get_path(next(dep_iter))
-                mtime = next(dep_iter)
-                implicit_ins = [self._get_path(p) for p in dep_iter]
-
-                deps = DepFileRecord(idx, explicit_out, mtime, implicit_ins)
-
-                old_deps = self._path_deps.get(explicit_out)
-                if not old_deps:
-                    self._deps.append(deps)
-                    self._path_deps[explicit_out] = deps
-                elif old_deps.mtime > deps.mtime:
-                    self._deps.append(None)
-                else:
-                    self._deps[old_deps.id] = None
-                    self._deps.append(deps)
-                    self._path_deps[explicit_out] = deps
+                old_deps = deps.get(explicit_out)
+                if old_deps is None or old_deps.mtime <= mtime:
+                    deps[explicit_out] = DepFileRecord(
+                            num_deps, explicit_out, mtime, implicit_ins)
+                num_deps += 1
             else:
-                if record_size < 4:
+                if record_size % 4 != 0 or record_size < 4:
                     raise DepFileError('corrupted path record')
-                buf = fp.read(record_size - 4)
-                path = self._extract_path(buf, encoding)
-                buf = fp.read(4)
-                checksum = 0xffffffff ^ self._unpack_uint32(buf)
-                if len(self._paths) != checksum:
+                checksum = 0xffffffff ^ words[end - 1]
+                if len(path_starts) != checksum:
                     raise DepFileError('bad path record checksum')
-                self._paths.append(path)
+                path_starts.append(begin * 4)
+                path_ends.append((end - 1) * 4)
 
-        return self._path_deps
+            pos = end
+
+        return (path_starts, path_ends, deps)
+
+
+class BuildGraph(object):
+    """Dependency graph index over the builds of a manifest.
+
+    The index maps every output path to the build which generates it and
+    every input path to the builds which consume it, so that forward and
+    reverse queries do not have to scan all builds.  Paths are keyed by
+    their IDs in the ``PathTable`` of the builds; builds which are not
+    ``CompactBuild`` are converted.  An index can be saved with
+    :meth:`save` and loaded with :meth:`load` to skip manifest parsing.
+    """
+
+    # Header of saved indexes.  Bump the version when the pickled state
+    # changes.
+    _MAGIC = b'# ninjagraph v1\n'
+
+    _INPUT_GROUPS = ('explicit_ins', 'implicit_ins', 'depfile_implicit_ins')
+
+
+    def __init__(self, builds):
+        table = None
+        for build in builds:
+            if isinstance(build, CompactBuild):
+                table = build._table
+                break
+        if table is None:
+            table = PathTable()
+        self.builds = [
+                build if isinstance(build, CompactBuild)
+                else CompactBuild.from_build(table, build)
+                for build in builds]
+        table.freeze()
+        self._table = table
+        self._closures = {}
+
+        # ``_outs[path_id]`` is the index of the build which generates the
+        # path or -1.  The consumers of a path are
+        # ``_consumers[_consumer_starts[path_id]:_consumer_starts[path_id + 1]]``.
+        num_paths = len(table)
+        outs = array.array('i', [-1]) * num_paths
+        starts = array.array('L', [0]) * (num_paths + 1)
+        for idx, build in enumerate(self.builds):
+            for path_id in build.get_path_ids('explicit_outs'):
+                outs[path_id] = idx
+            for path_id in build.get_path_ids('implicit_outs'):
+                outs[path_id] = idx
+            for path_id in set(self._get_input_ids(build)):
+                starts[path_id + 1] += 1
+        for path_id in range(num_paths):
+            starts[path_id + 1] += starts[path_id]
+
+        consumers = array.array('I', [0]) * starts[num_paths]
+        ends = array.array('L', starts[:num_paths])
+        for idx, build in enumerate(self.builds):
+            for path_id in set(self._get_input_ids(build)):
+                consumers[ends[path_id]] = idx
+                ends[path_id] += 1
+
+        self._outs = outs
+        self._consumer_starts = starts
+        self._consumers = consumers
+
+
+    def __getstate__(self):
+        return (self.builds, self._table, self._outs, self._consumer_starts,
+                self._consumers)
+
+
+    def __setstate__(self, state):
+        (self.builds, self._table, self._outs, self._consumer_starts,
+         self._consumers) = state
+        self._closures = {}
+
+
+    def save(self, path):
+        """Save the index to a file which starts with ``_MAGIC``."""
+        with open(path, 'wb') as index_file:
+            index_file.write(self._MAGIC)
+            pickle.dump(self, index_file, pickle.HIGHEST_PROTOCOL)
+
+
+    @classmethod
+    def is_index(cls, path):
+        """Check whether ``path`` is an index saved by :meth:`save`."""
+        try:
+            with open(path, 'rb') as index_file:
+                return index_file.read(len(cls._MAGIC)) == cls._MAGIC
+        except (IOError, OSError):
+            return False
+
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as index_file:
+            if index_file.read(len(cls._MAGIC)) != cls._MAGIC:
+                raise ValueError('not a build graph index: ' + path)
+            return pickle.load(index_file)
+
+
+    @staticmethod
+    def get_inputs(build):
+        """Iterate over the input paths of a build (except order-only ones)."""
+        return itertools.chain(build.explicit_ins, build.implicit_ins,
+                               build.depfile_implicit_ins)
+
+
+    @classmethod
+    def _get_input_ids(cls, build):
+        return itertools.chain.from_iterable(
+                build.get_path_ids(group) for group in cls._INPUT_GROUPS)
+
+
+    def _find_id(self, path):
+        path_id = self._table.find_id(path)
+        if path_id is None or path_id >= len(self._outs):
+            return None
+        return path_id
+
+
+    def _get_consumer_idxs(self, path_id):
+        starts = self._consumer_starts
+        return self._consumers[starts[path_id]:starts[path_id + 1]]
+
+
+    def outputs(self):
+        """Iterate over all output paths."""
+        get_path = self._table.get_path
+        return (get_path(path_id) for path_id, idx in enumerate(self._outs)
+                if idx >= 0)
+
+
+    def inputs(self):
+        """Iterate over all input paths."""
+        get_path = self._table.get_path
+        starts = self._consumer_starts
+        return (get_path(path_id) for path_id in range(len(self._outs))
+                if starts[path_id] != starts[path_id + 1])
+
+
+    def get_build(self, path):
+        """Get the build which generates ``path`` or None."""
+        path_id = self._find_id(path)
+        if path_id is None:
+            return None
+        idx = self._outs[path_id]
+        return None if idx < 0 else self.builds[idx]
+
+
+    def get_consumers(self, path):
+        """Get the builds which take ``path`` as an input."""
+        path_id = self._find_id(path)
+        if path_id is None:
+            return []
+        return [self.builds[idx] for idx in self._get_consumer_idxs(path_id)]
+
+
+    def transitive_builds(self, path):
+        """Collect the builds which ``path`` transitively depends on.
+
+        The build which generates ``path`` comes first and the others are
+        listed in the order they are discovered.  Raises KeyError if
+        ``path`` is not generated by any build.
+        """
+        path_id = self._find_id(path)
+        start = -1 if path_id is None else self._outs[path_id]
+        if start < 0:
+            raise KeyError(path)
+        outs = self._outs
+        visited = {start}
+        order = [start]
+        stack = [start]
+        while stack:
+            for dep_id in self._get_input_ids(self.builds[stack.pop()]):
+                idx = outs[dep_id]
+                if idx >= 0 and idx not in visited:
+                    visited.add(idx)
+                    order.append(idx)
+                    stack.append(idx)
+        return [self.builds[idx] for idx in order]
+
+
+    def transitive_inputs(self, path, skip=None):
+        """Collect the paths which ``path`` transitively depends on.
+
+        Args:
+            skip: An optional predicate.  Dependencies for which it returns
+                True are neither collected nor followed.
+
+        Returns:
+            A frozenset of paths (excluding ``path`` itself).  Results are
+            memoized per ``skip`` predicate, and later queries with the
+            same predicate reuse them instead of visiting those
+            dependencies again.
+        """
+        path_id = self._find_id(path)
+        if path_id is None:
+            return frozenset()
+        closures = self._closures.get(skip)
+        if closures is None:
+            closures = self._closures[skip] = {}
+        closure = closures.get(path_id)
+        if closure is not None:
+            return closure[1]
+
+        get_path = self._table.get_path
+        outs = self._outs
+        visited = set()
+        stack = [path_id]
+        while stack:
+            idx = outs[stack.pop()]
+            if idx < 0:
+                continue
+            for dep_id in self._get_input_ids(self.builds[idx]):
+                if dep_id in visited or dep_id == path_id:
+                    continue
+                if skip is not None and skip(get_path(dep_id)):
+                    continue
+                visited.add(dep_id)
+                closure = closures.get(dep_id)
+                if closure is None:
+                    stack.append(dep_id)
+                else:
+                    visited.update(closure[0])
+
+        closure = (frozenset(visited),
+                   frozenset(get_path(dep_id) for dep_id in visited))
+        closures[path_id] = closure
+        return closure[1]
+
+
+    def reverse_reachable(self, paths, follow=None):
+        """Collect the outputs which transitively depend on any of ``paths``.
+
+        Args:
+            follow: An optional predicate.  Outputs for which it returns
+                False are collected but their consumers are not visited.
+
+        Returns:
+            A set of output paths.
+        """
+        visited_builds = set()
+        outs = set()
+        stack = [path_id for path_id in map(self._find_id, paths)
+                 if path_id is not None]
+        while stack:
+            for idx in self._get_consumer_idxs(stack.pop()):
+                if idx in visited_builds:
+                    continue
+                visited_builds.add(idx)
+                build = self.builds[idx]
+                for out_id in itertools.chain(
+                        build.get_path_ids('explicit_outs'),
+                        build.get_path_ids('implicit_outs')):
+                    if out_id in outs:
+                        continue
+                    outs.add(out_id)
+                    if follow is None or follow(self._table.get_path(out_id)):
+                        stack.append(out_id)
+        return set(self._table.get_paths(outs))
 
 
 def _parse_args():
@@ -994,6 +2211,12 @@ def _parse_args():
         parser.add_argument('--cwd', help='working directory for ninja')
         parser.add_argument('--encoding', default='utf-8',
                             help='ninja file encoding')
+        parser.add_argument('--cache-dir',
+                            help='directory to cache lexed ninja files in')
+        parser.add_argument('-j', '--jobs', type=int,
+                            help='number of processes to parse subninja files')
+        parser.add_argument('--compact', action='store_true',
+                            help='store paths as integer IDs to save memory')
 
     # dump sub-command
     parser_dump = subparsers.add_parser('dump', help='dump dependency graph')
@@ -1007,6 +2230,25 @@ def _parse_args():
     parser_pickle.add_argument('-o', '--output', required=True,
                                help='output file')
 
+    # index sub-command
+    parser_index = subparsers.add_parser(
+            'index', help='save a dependency graph index for queries')
+    _register_input_file_args(parser_index)
+    parser_index.add_argument('-o', '--output', required=True,
+                              help='output file')
+
+    # query sub-command
+    parser_query = subparsers.add_parser(
+            'query', help='query the dependency graph')
+    _register_input_file_args(parser_query)
+    parser_query.add_argument(
+            'kind', choices=('inputs', 'consumers', 'dependents'),
+            help='inputs: transitive inputs; consumers: builds which use '
+                 'the path directly; dependents: transitive outputs')
+    parser_query.add_argument(
+            'paths', nargs='*',
+            help='paths to query (read from stdin if not specified)')
+
     # Parse arguments and check sub-command
     args = parser.parse_args()
     if args.command is None:
@@ -1027,8 +2269,20 @@ def load_manifest_from_args(args):
             return pickle.load(pickle_file)
 
     # Parse the ninja file
-    return Parser(args.cwd).parse(args.input_file, args.encoding,
-                                  args.ninja_deps)
+    return Parser(args.cwd, args.cache_dir, args.jobs, args.compact).parse(
+            args.input_file, args.encoding, args.ninja_deps)
+
+
+def load_graph_from_args(args):
+    """Load the dependency graph index specified by command line options.
+
+    The input file may be a ninja file, a pickled manifest or an index saved
+    by the index sub-command.
+    """
+
+    if BuildGraph.is_index(args.input_file):
+        return BuildGraph.load(args.input_file)
+    return BuildGraph(load_manifest_from_args(args).builds)
 
 
 def dump_manifest(manifest, file):
@@ -1076,6 +2330,37 @@ def command_pickle_main(args):
         pickle.dump(load_manifest_from_args(args), output_file)
 
 
+def command_index_main(args):
+    """Main function for the index sub-command"""
+    load_graph_from_args(args).save(args.output)
+
+
+def _query_graph(graph, kind, path):
+    if kind == 'inputs':
+        return graph.transitive_inputs(path)
+    if kind == 'consumers':
+        return [out for build in graph.get_consumers(path)
+                for out in build.explicit_outs]
+    return graph.reverse_reachable([path])
+
+
+def command_query_main(args):
+    """Main function for the query sub-command"""
+    graph = load_graph_from_args(args)
+    if args.paths:
+        paths = args.paths
+    else:
+        paths = (line.strip() for line in sys.stdin)
+    for path in paths:
+        if not path:
+            continue
+        print(path)
+        for result in sorted(_query_graph(graph, args.kind, path)):
+            print('\t' + result)
+        print()
+        sys.stdout.flush()
+
+
 def main():
     """Main function for the executable"""
     args = _parse_args()
@@ -1083,6 +2368,10 @@ def main():
         command_dump_main(args)
     elif args.command == 'pickle':
         command_pickle_main(args)
+    elif args.command == 'index':
+        command_index_main(args)
+    elif args.command == 'query':
+        command_query_main(args)
     else:
         raise KeyError('unknown command ' + args.command)
 
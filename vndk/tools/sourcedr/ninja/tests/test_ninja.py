@@ -2,9 +2,18 @@
 
 import ninja
 
+import argparse
 import os
+import shutil
+import struct
+import tempfile
 import unittest
 
+try:
+    from cStringIO import StringIO  # Python 2
+except ImportError:
+    from io import StringIO  # Python 3
+
 
 TEST_DIR = os.path.abspath(os.path.dirname(__file__))
 TEST_DATA_DIR = os.path.join(TEST_DIR, 'testdata')
@@ -122,6 +131,98 @@ class EvalStringTest(unittest.TestCase):
 
         self.assertEqual('adc', ninja.eval_string(s, env))
 
+    def test_memo_invalidation(self):
+        parent = ninja.EvalEnv()
+        parent['a'] = 'x'
+        env = ninja.EvalEnv()
+        env.parent = parent
+
+        s = ninja.EvalStringBuilder().append_var('a').getvalue()
+        self.assertEqual('x', ninja.eval_string(s, env))
+
+        parent['a'] = 'y'
+        self.assertEqual('y', ninja.eval_string(s, env))
+        env['a'] = 'z'
+        self.assertEqual('z', ninja.eval_string(s, env))
+        del env['a']
+        self.assertEqual('y', ninja.eval_string(s, env))
+
+        for mutate in (lambda: env.setdefault('a', 'z'),
+                       lambda: env.pop('a'),
+                       lambda: env.update(a='z'),
+                       env.popitem,
+                       lambda: parent.update(a='w'),
+                       parent.clear):
+            before = env.get('a') or parent.get('a') or ''
+            self.assertEqual(before, ninja.eval_string(s, env))
+            mutate()
+            after = env.get('a') or parent.get('a') or ''
+            self.assertEqual(after, ninja.eval_string(s, env))
+
+    def test_memo_per_scope(self):
+        parent = ninja.EvalEnv(a='x')
+        env = ninja.EvalEnv()
+        env.parent = parent
+        s = ninja.EvalStringBuilder().append_var('a').getvalue()
+        self.assertEqual('x', ninja.eval_string(s, env))
+        memo = env._get_memo()
+
+        # Mutating an unrelated scope keeps the memo.
+        ninja.EvalEnv()['b'] = 'y'
+        self.assertIs(memo, env._get_memo())
+
+        other = ninja.EvalEnv(a='y')
+        env.parent = other
+        self.assertIsNot(memo, env._get_memo())
+        self.assertEqual('y', ninja.eval_string(s, env))
+
+    def test_memo_reparent(self):
+        # Replacing a parent must invalidate the memo even when the new
+        # parent has been mutated fewer times than the old one.
+        parent = ninja.EvalEnv()
+        parent['a'] = 'x'
+        env = ninja.EvalEnv()
+        env.parent = parent
+        self.assertEqual('x', env.get_recursive('a'))
+        env.parent = ninja.EvalEnv(a='y')
+        self.assertEqual('y', env.get_recursive('a'))
+
+        # Also for the parent of the parent.
+        grandparent = ninja.EvalEnv()
+        self.assertIsNone(env.get_recursive('b'))
+        env.parent.parent = grandparent
+        grandparent['b'] = 'z'
+        self.assertEqual('z', env.get_recursive('b'))
+
+    def test_memo_shared_by_builds(self):
+        file_env = ninja.EvalEnv()
+        file_env.parent = ninja.EvalEnv(a='x')
+        s = ninja.EvalStringBuilder().append_var('a').append_var('b') \
+                .getvalue()
+        memos = []
+        for b in ('1', '2'):
+            build_env = ninja.EvalEnv(b=b)
+            build_env.parent = file_env
+            env = ninja.BuildEvalEnv(build_env, None)
+            self.assertEqual('x' + b, ninja.eval_string(s, env))
+            self.assertIsNone(env._get_memo())
+            memos.append(file_env._get_memo())
+        self.assertIs(memos[0], memos[1])
+        self.assertEqual({'a': 'x'}, memos[0][2])
+
+    def test_pickle_env(self):
+        parent = ninja.EvalEnv(a='x')
+        env = ninja.EvalEnv(b='y')
+        env.parent = parent
+        s = ninja.EvalStringBuilder().append_var('a').append_var('b') \
+                .getvalue()
+        self.assertEqual('xy', ninja.eval_string(s, env))
+
+        loaded = ninja.pickle.loads(ninja.pickle.dumps(env))
+        self.assertEqual({'b': 'y'}, loaded)
+        self.assertEqual({'a': 'x'}, loaded.parent)
+        self.assertEqual('xy', ninja.eval_string(s, loaded))
+
 
 class ParseErrorTest(unittest.TestCase):
     def test_repr(self):
@@ -589,6 +690,447 @@ class ParserTest(unittest.TestCase):
         self.assertEqual(2, len(manifest.builds))
 
 
+class CountingParser(ninja.Parser):
+    def __init__(self, *args, **kwargs):
+        super(CountingParser, self).__init__(*args, **kwargs)
+        self.lexed_files = []
+
+    def _parse_all_top_level_stmts(self):
+        self.lexed_files.append(os.path.basename(self._lexer.path))
+        return super(CountingParser, self)._parse_all_top_level_stmts()
+
+
+class ParserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        shutil.copytree(TEST_DATA_DIR, self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _parse(self):
+        parser = CountingParser(self.data_dir, self.cache_dir)
+        manifest = parser.parse('subninja.ninja', ENCODING)
+        outs = [build.explicit_outs for build in manifest.builds]
+        return outs, sorted(parser.lexed_files)
+
+    def test_reuse_unchanged(self):
+        outs, lexed_files = self._parse()
+        self.assertEqual([['out1'], ['out2']], outs)
+        self.assertEqual(['sub.ninja', 'subninja.ninja'], lexed_files)
+
+        outs, lexed_files = self._parse()
+        self.assertEqual([['out1'], ['out2']], outs)
+        self.assertEqual([], lexed_files)
+
+    def test_reparse_changed(self):
+        self._parse()
+
+        with open(os.path.join(self.data_dir, 'sub.ninja'), 'a') as fp:
+            fp.write('build out3 : phony prebuilt_out3\n')
+
+        outs, lexed_files = self._parse()
+        self.assertEqual([['out1'], ['out3'], ['out2']], outs)
+        self.assertEqual(['sub.ninja'], lexed_files)
+
+    def test_reuse_touched(self):
+        self._parse()
+
+        path = os.path.join(self.data_dir, 'sub.ninja')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+
+        outs, lexed_files = self._parse()
+        self.assertEqual([['out1'], ['out2']], outs)
+        self.assertEqual([], lexed_files)
+
+
+class ParallelParserTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.tmp_dir, name), 'w') as fp:
+            fp.write(content)
+
+    def _dump(self, jobs, compact=False):
+        manifest = ninja.Parser(self.tmp_dir, jobs=jobs, compact=compact).parse(
+                'build.ninja', ENCODING)
+        buf = StringIO()
+        ninja.dump_manifest(manifest, buf)
+        return buf.getvalue()
+
+    def test_same_as_serial(self):
+        self._write('build.ninja',
+                    'a = top\n'
+                    'rule cc\n'
+                    '  command = cc $in\n'
+                    'build top1 : cc $a\n'
+                    'subninja sub1.ninja\n'
+                    'a = changed\n'
+                    'build top2 : cc $a\n'
+                    'default top2\n'
+                    'subninja sub2.ninja\n'
+                    'build top3 : sub_rule top2\n'
+                    'rule ld\n'
+                    '  command = ld $in\n'
+                    'build top4 : ld top3\n')
+        self._write('sub1.ninja',
+                    'rule sub_rule\n'
+                    '  command = sub $in\n'
+                    'build sub1 : cc $a\n'
+                    'default sub1\n')
+        self._write('sub2.ninja',
+                    'a = sub2\n'
+                    'include inc.ninja\n'
+                    'build sub2 : sub_rule $a\n')
+        self._write('inc.ninja',
+                    'pool inc_pool\n'
+                    '  depth = 1\n'
+                    'build inc : phony $a\n')
+
+        serial = self._dump(None)
+        self.assertIn('explicit_in: top', serial)
+        self.assertEqual(serial, self._dump(2))
+        self.assertEqual(serial, self._dump(2, compact=True))
+
+    def test_rule_redefined_by_subninja(self):
+        self._write('build.ninja',
+                    'rule cc\n'
+                    '  dir = top\n'
+                    'subninja sub1.ninja\n'
+                    'subninja sub2.ninja\n')
+        self._write('sub1.ninja',
+                    'rule cc\n'
+                    '  dir = sub1\n'
+                    'build $dir/a : cc a.c\n')
+        self._write('sub2.ninja',
+                    'build $dir/b : cc b.c\n')
+
+        serial = self._dump(1)
+        self.assertIn('explicit_out: sub1/b', serial)
+        self.assertEqual(serial, self._dump(2))
+
+    def test_error(self):
+        self._write('build.ninja', 'subninja sub.ninja\n')
+        self._write('sub.ninja', 'build out : undeclared_rule in\n')
+        with self.assertRaises(ninja.ParseError) as ctx:
+            ninja.Parser(self.tmp_dir, jobs=2).parse('build.ninja', ENCODING)
+        self.assertEqual(os.path.join(self.tmp_dir, 'sub.ninja'),
+                         ctx.exception.path)
+        self.assertEqual(1, ctx.exception.line)
+
+    def test_dep_file(self):
+        self._write('build.ninja', 'subninja sub.ninja\n')
+        self._write('sub.ninja', 'build out.o : phony in.c\n')
+        # A deps log with the paths out.o, in.c and in.h and the deps of out.o
+        deps_path = os.path.join(self.tmp_dir, '.ninja_deps')
+        with open(deps_path, 'wb') as fp:
+            fp.write(b'# ninjadeps\n' + struct.pack('<I', 3))
+            for i, path in enumerate([b'out.o', b'in.c', b'in.h']):
+                path += b'\0' * (-len(path) % 4)
+                fp.write(struct.pack('<I', len(path) + 4) + path +
+                         struct.pack('<I', 0xffffffff ^ i))
+            fp.write(struct.pack('<5I', 16 | (1 << 31), 0, 1, 2, 1))
+        for jobs in (None, 2):
+            manifest = ninja.Parser(self.tmp_dir, jobs=jobs).parse(
+                    'build.ninja', ENCODING, deps_path)
+            self.assertEqual(('in.c', 'in.h'),
+                             manifest.builds[0].depfile_implicit_ins)
+
+
+class PathTableTest(unittest.TestCase):
+    def test_get_id(self):
+        table = ninja.PathTable()
+        self.assertEqual(0, table.get_id('a'))
+        self.assertEqual(1, table.get_id('b/c'))
+        self.assertEqual(0, table.get_id('a'))
+        self.assertEqual(1, table.find_id('b/c'))
+        self.assertIsNone(table.find_id('d'))
+        self.assertEqual(2, len(table))
+
+    def test_freeze(self):
+        table = ninja.PathTable(['a', 'b/c', 'd'])
+        table.freeze()
+        self.assertEqual(3, len(table))
+        self.assertEqual('b/c', table.get_path(1))
+        self.assertEqual(['d', 'a'], table.get_paths([2, 0]))
+
+        # Paths are looked up without unpacking the table.
+        self.assertEqual(1, table.find_id('b/c'))
+        self.assertIsNone(table.find_id('b'))
+        self.assertEqual([], table._paths)
+
+        # Paths added to a frozen table get new IDs.
+        self.assertEqual(3, table.get_id('c'))
+        self.assertEqual(0, table.get_id('a'))
+        self.assertEqual(3, table.find_id('c'))
+        self.assertEqual(['a', 'b/c', 'd', 'c'], table.get_paths(range(4)))
+
+        # Freezing again merges them into the sorted order.
+        table.freeze()
+        self.assertEqual([], table._paths)
+        self.assertEqual(3, table.find_id('c'))
+        self.assertEqual(2, table.find_id('d'))
+        self.assertEqual(['a', 'b/c', 'd', 'c'], table.get_paths(range(4)))
+
+    def test_encoded(self):
+        table = ninja.PathTable(['a', 'b/c'])
+        self.assertIsNone(table.find_encoded_id(b'a'))
+        table.freeze()
+        self.assertEqual(1, table.find_encoded_id(b'b/c'))
+        self.assertIsNone(table.find_encoded_id(b'b'))
+
+    def test_pickle(self):
+        table = ninja.PathTable(['b', 'a'])
+        loaded = ninja.pickle.loads(ninja.pickle.dumps(table, 2))
+        self.assertEqual(1, loaded.find_id('a'))
+        self.assertEqual(['b', 'a'], loaded.get_paths(range(2)))
+
+
+class CompactParserTest(unittest.TestCase):
+    def _dump(self, manifest):
+        buf = StringIO()
+        ninja.dump_manifest(manifest, buf)
+        return buf.getvalue()
+
+    def test_same_as_build(self):
+        input_path = os.path.join(TEST_DATA_DIR, 'build.ninja')
+        manifest = ninja.Parser().parse(input_path, ENCODING)
+        compact_manifest = ninja.Parser(compact=True).parse(
+                input_path, ENCODING)
+
+        build = compact_manifest.builds[0]
+        self.assertIsInstance(build, ninja.CompactBuild)
+        self.assertEqual(['explicit_out1', 'explicit_out2'],
+                         build.explicit_outs)
+        self.assertEqual(['order_only1', 'order_only2'], build.prerequisites)
+        self.assertEqual(('t', '1',), build.bindings['a'])
+        self.assertEqual(self._dump(manifest), self._dump(compact_manifest))
+
+    def test_path_ids(self):
+        input_path = os.path.join(TEST_DATA_DIR, 'build.ninja')
+        manifest = ninja.Parser(compact=True).parse(input_path, ENCODING)
+        build = manifest.builds[0]
+        build.depfile_implicit_ins = ('explicit_in1', 'dep1')
+
+        ids = build.get_path_ids('explicit_ins')
+        self.assertEqual(['explicit_in1', 'explicit_in2'],
+                         [build._table.get_path(i) for i in ids])
+        ids = build.get_path_ids('depfile_implicit_ins')
+        self.assertEqual(ids[0], build.get_path_ids('explicit_ins')[0])
+        self.assertEqual(('explicit_in1', 'dep1'), build.depfile_implicit_ins)
+
+    def test_pickle(self):
+        input_path = os.path.join(TEST_DATA_DIR, 'build.ninja')
+        manifest = ninja.Parser(compact=True).parse(input_path, ENCODING)
+        loaded = ninja.pickle.loads(ninja.pickle.dumps(manifest, 2))
+        self.assertEqual(self._dump(manifest), self._dump(loaded))
+
+
+class BuildGraphTest(unittest.TestCase):
+    def setUp(self):
+        input_path = os.path.join(TEST_DATA_DIR, 'graph.ninja')
+        manifest = ninja.Parser().parse(input_path, ENCODING)
+        self.graph = ninja.BuildGraph(manifest.builds)
+
+
+    def test_get_build(self):
+        build = self.graph.get_build('out/lib.so.toc')
+        self.assertEqual(['out/lib.so'], build.explicit_outs)
+        self.assertIsNone(self.graph.get_build('a.c'))
+        consumers = self.graph.get_consumers('out/lib.so')
+        self.assertEqual([['out/app']], [b.explicit_outs for b in consumers])
+        self.assertEqual([], self.graph.get_consumers('out/order'))
+
+
+    def test_transitive_builds(self):
+        outs = [build.explicit_outs[0]
+                for build in self.graph.transitive_builds('out/app')]
+        self.assertEqual('out/app', outs[0])
+        self.assertEqual(['out/a.o', 'out/app', 'out/b.o', 'out/lib.so'],
+                         sorted(outs))
+        self.assertRaises(KeyError, self.graph.transitive_builds, 'a.c')
+
+
+    def test_transitive_inputs(self):
+        expected = {'main.c', 'out/lib.so', 'out/a.o', 'out/b.o', 'a.c', 'a.h',
+                    'b.c'}
+        deps = self.graph.transitive_inputs('out/app')
+        self.assertEqual(expected, deps)
+        self.assertIs(deps, self.graph.transitive_inputs('out/app'))
+
+        def skip(path):
+            return path == 'out/b.o'
+        deps = self.graph.transitive_inputs('out/app', skip)
+        self.assertEqual(expected - {'out/b.o', 'b.c'}, deps)
+        self.assertIs(deps, self.graph.transitive_inputs('out/app', skip))
+
+
+    def test_transitive_inputs_reuse(self):
+        lib_deps = self.graph.transitive_inputs('out/lib.so')
+        self.assertEqual({'out/a.o', 'out/b.o', 'a.c', 'a.h', 'b.c'}, lib_deps)
+
+        # The memoized dependencies of out/lib.so are not visited again.
+        self.graph.builds[0] = None
+        self.assertEqual(lib_deps | {'main.c', 'out/lib.so'},
+                         self.graph.transitive_inputs('out/app'))
+
+
+    def test_reverse_reachable(self):
+        self.assertEqual(
+                {'out/a.o', 'out/lib.so', 'out/lib.so.toc', 'out/app'},
+                self.graph.reverse_reachable(['a.h']))
+        self.assertEqual({'out/a.o'},
+                         self.graph.reverse_reachable(
+                                 ['a.h'], lambda path: path != 'out/a.o'))
+        self.assertEqual(set(), self.graph.reverse_reachable(['out/app']))
+
+
+    def test_compact(self):
+        input_path = os.path.join(TEST_DATA_DIR, 'graph.ninja')
+        manifest = ninja.Parser(compact=True).parse(input_path, ENCODING)
+        graph = ninja.BuildGraph(manifest.builds)
+        self.assertEqual(manifest.builds, graph.builds)
+        self.assertEqual(sorted(self.graph.outputs()), sorted(graph.outputs()))
+        self.assertEqual(sorted(self.graph.inputs()), sorted(graph.inputs()))
+        self.assertEqual(self.graph.transitive_inputs('out/app'),
+                         graph.transitive_inputs('out/app'))
+        self.assertEqual(self.graph.reverse_reachable(['a.h']),
+                         graph.reverse_reachable(['a.h']))
+
+
+    def test_index_round_trip(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            args = argparse.Namespace(
+                    input_file=os.path.join(TEST_DATA_DIR, 'graph.ninja'),
+                    ninja_deps=None, cwd=None, encoding=ENCODING,
+                    cache_dir=None, jobs=None, compact=False,
+                    output=os.path.join(tmp_dir, 'graph.idx'))
+            ninja.command_index_main(args)
+            self.assertTrue(ninja.BuildGraph.is_index(args.output))
+            self.assertFalse(ninja.BuildGraph.is_index(args.input_file))
+
+            args.input_file = args.output
+            graph = ninja.load_graph_from_args(args)
+            self.assertIsInstance(graph, ninja.BuildGraph)
+            self.assertEqual(self.graph.transitive_inputs('out/app'),
+                             graph.transitive_inputs('out/app'))
+            self.assertRaises(ValueError, ninja.BuildGraph.load,
+                              os.path.join(TEST_DATA_DIR, 'graph.ninja'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_pickle(self):
+        self.graph.transitive_inputs('out/app')
+        loaded = ninja.pickle.loads(ninja.pickle.dumps(self.graph, 2))
+        self.assertEqual({}, loaded._closures)
+        self.assertEqual(self.graph.transitive_inputs('out/app'),
+                         loaded.transitive_inputs('out/app'))
+
+
+def _make_deps_log(paths, deps):
+    """Build the content of a ``.ninja_deps`` file.  ``deps`` is a list of
+    (output, mtime, inputs) tuples which refer to ``paths`` by index."""
+    buf = [b'# ninjadeps\n', struct.pack('<I', 3)]
+    for i, path in enumerate(paths):
+        path = path.encode(ENCODING)
+        path += b'\0' * (-len(path) % 4)
+        buf.append(struct.pack('<I', len(path) + 4))
+        buf.append(path)
+        buf.append(struct.pack('<I', 0xffffffff ^ i))
+    for out, mtime, ins in deps:
+        buf.append(struct.pack('<I', ((len(ins) + 2) * 4) | (1 << 31)))
+        buf.append(struct.pack('<{}I'.format(len(ins) + 2), out, mtime, *ins))
+    return b''.join(buf)
+
+
+class DepFileParserTest(unittest.TestCase):
+    PATHS = ['out/a.o', 'a.c', 'a.h', 'sys.h', 'old.h', 'out/unknown.o']
+
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.deps_path = os.path.join(self.tmp_dir, '.ninja_deps')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _write(self, content):
+        with open(self.deps_path, 'wb') as deps_file:
+            deps_file.write(content)
+
+
+    def test_parse(self):
+        self._write(_make_deps_log(
+                self.PATHS, [(0, 1, [1, 4]), (5, 1, [1]), (0, 2, [1, 2, 3])]))
+        deps_log = ninja.DepFileParser().parse(self.deps_path, ENCODING)
+        try:
+            self.assertEqual(2, len(deps_log))
+            deps = deps_log.get('out/a.o')
+            self.assertEqual(2, deps.id)
+            self.assertEqual(['a.c', 'a.h', 'sys.h'],
+                             deps_log.get_paths(deps.implicit_ins))
+            self.assertIsNone(deps_log.get('a.c'))
+        finally:
+            deps_log.close()
+
+
+    def test_truncated_record(self):
+        content = _make_deps_log(self.PATHS, [(0, 1, [1])])
+        self._write(content + struct.pack('<3I', (16 | (1 << 31)), 0, 1))
+        deps_log = ninja.DepFileParser().parse(self.deps_path, ENCODING)
+        self.assertEqual(['a.c'], deps_log.get_paths(
+                deps_log.get('out/a.o').implicit_ins))
+        deps_log.close()
+
+
+    def test_bad_input(self):
+        parser = ninja.DepFileParser()
+
+        self._write(b'')
+        self.assertRaises(ninja.DepFileError, parser.parse, self.deps_path,
+                          ENCODING)
+
+        content = _make_deps_log(self.PATHS, [(0, 1, [len(self.PATHS)])])
+        self._write(content)
+        self.assertRaises(ninja.DepFileError, parser.parse, self.deps_path,
+                          ENCODING)
+
+        content = _make_deps_log(self.PATHS, [])
+        self._write(content[:-4] + struct.pack('<I', 0))
+        self.assertRaises(ninja.DepFileError, parser.parse, self.deps_path,
+                          ENCODING)
+
+
+    def test_parse_dep_file(self):
+        self._write(_make_deps_log(
+                self.PATHS, [(0, 1, [4]), (0, 2, [2, 1, 3])]))
+        input_path = os.path.join(TEST_DATA_DIR, 'graph.ninja')
+        for compact in (False, True):
+            manifest = ninja.Parser(compact=compact).parse(
+                    input_path, ENCODING, self.deps_path)
+            builds = {build.explicit_outs[0]: build
+                      for build in manifest.builds}
+            self.assertEqual(('a.c', 'a.h', 'sys.h'),
+                             builds['out/a.o'].depfile_implicit_ins)
+            self.assertEqual((), builds['out/b.o'].depfile_implicit_ins)
+            if compact:
+                # Paths which only occur in the deps log are packed too.
+                table = builds['out/a.o']._table
+                self.assertEqual([], table._paths)
+                self.assertIsNotNone(table.find_encoded_id(b'sys.h'))
+
+
 class ParserTestWithBadInput(unittest.TestCase):
     def test_unexpected_trivial_token(self):
         input_path = os.path.join(TEST_DATA_DIR, 'bad_trivial.ninja')